@@ -7,18 +7,40 @@ Templates embebidos para evitar problemas de despliegue.
 
 import os
 import re
+import string
 import io
+import csv
+import itertools
+import unicodedata
+from html import escape as _escape_html
+import json
+import random
+import cProfile
+import pstats
 import calendar
 import secrets
-from datetime import datetime, timedelta
+import queue
+import atexit
+import threading
+import time
+import zipfile
+from collections import OrderedDict
+from contextlib import contextmanager
+from datetime import datetime, timedelta, time as dtime
 from functools import wraps
 
+import click
+
 from flask import (
     Flask, request, redirect, url_for,
-    session, flash, jsonify, send_file, abort, make_response
+    session, flash, jsonify, send_file, abort, make_response,
+    g, has_request_context, Response, stream_with_context
 )
 from markupsafe import Markup
 from werkzeug.security import generate_password_hash, check_password_hash
+from itsdangerous import URLSafeTimedSerializer, BadSignature
+import openpyxl
+from openpyxl.utils.exceptions import InvalidFileException
 import sqlite3
 import xlsxwriter
 
@@ -27,7 +49,51 @@ import xlsxwriter
 # ==============================================================================
 app = Flask(__name__)
 app.secret_key = os.environ.get('SECRET_KEY', secrets.token_hex(32))
-DB_PATH = os.path.join('/data', 'citas.db') if os.path.isdir('/data') else os.path.join('/tmp', 'citas.db')
+# Backend de datos: DATABASE_URL=sqlite:///relativa.db o sqlite:////ruta/absoluta.db (reemplaza a CITAS_DB);
+# el esquema elige la implementación en BACKENDS_DATOS
+DATABASE_URL = os.environ.get('DATABASE_URL', '')
+BACKEND_DATOS = DATABASE_URL.split(':', 1)[0] if DATABASE_URL else 'sqlite'
+DB_PATH = (DATABASE_URL[len('sqlite:///'):] if DATABASE_URL.startswith('sqlite:///') else os.environ.get('CITAS_DB')) or \
+    (os.path.join('/data', 'citas.db') if os.path.isdir('/data') else os.path.join('/tmp', 'citas.db'))
+# Segundos que un operador retiene un cupo mientras llena el formulario de agendar
+RETENCION_SEGUNDOS = int(os.environ.get('RETENCION_SEGUNDOS', 180))
+# Horas que se guarda la respuesta de una solicitud con clave de idempotencia
+IDEMPOTENCIA_HORAS = int(os.environ.get('IDEMPOTENCIA_HORAS', 24))
+# Conexiones de solo lectura que se reutilizan para reportes y exportaciones
+LECTURA_POOL = int(os.environ.get('LECTURA_POOL', 4))
+# Si es > 0, los reportes leen una copia (snapshot) de la BD refrescada cada N segundos
+SNAPSHOT_SEGUNDOS = int(os.environ.get('SNAPSHOT_SEGUNDOS', 0))
+# Mantenimiento automático: checkpoint del WAL, PRAGMA optimize y respaldos rotativos
+MANTENIMIENTO_TICK = int(os.environ.get('MANTENIMIENTO_TICK', 60))  # 0 = desactivado
+BACKUP_DIR = os.environ.get('BACKUP_DIR', os.path.join(os.path.dirname(DB_PATH), 'backups'))
+BACKUP_HORAS = int(os.environ.get('BACKUP_HORAS', 24))
+BACKUP_ROTACION = int(os.environ.get('BACKUP_ROTACION', 7))
+# Métricas Prometheus en /metrics (METRICAS=1). METRICAS_TOKEN permite leerlas sin sesión de admin
+METRICAS = os.environ.get('METRICAS', '0') == '1'
+METRICAS_TOKEN = os.environ.get('METRICAS_TOKEN', '')
+# Perfil de SQL (PERFIL_SQL=1): tiempos por sentencia, plan de ejecución y registro de lentas
+PERFIL_SQL = os.environ.get('PERFIL_SQL', '0') == '1'
+SQL_LENTO_MS = float(os.environ.get('SQL_LENTO_MS', 100))
+# Perfiles cProfile por solicitud: muestreo (0-1), carpeta y cantidad máxima de .pstats
+PERFIL_MUESTREO = float(os.environ.get('PERFIL_MUESTREO', 0))
+PERFILES_DIR = os.environ.get('PERFILES_DIR', os.path.join(os.path.dirname(DB_PATH), 'perfiles'))
+PERFILES_MAX = int(os.environ.get('PERFILES_MAX', 50))
+# Años cerrados se mueven a citas_AAAA.db cuando terminan hace más de ARCHIVO_MESES meses
+ARCHIVO_DIR = os.environ.get('ARCHIVO_DIR', os.path.dirname(DB_PATH))
+ARCHIVO_MESES = int(os.environ.get('ARCHIVO_MESES', 12))
+# Caché de respuestas de reportes y APIs de lectura, por worker (MB; 0 = desactivado)
+CACHE_MB = float(os.environ.get('CACHE_MB', 16))
+# Auditoría: los eventos de historial se encolan y se escriben por lotes cada
+# HISTORIAL_FLUSH_MS o al juntar HISTORIAL_LOTE; HISTORIAL_ASYNC=0 los escribe al momento
+HISTORIAL_ASYNC = os.environ.get('HISTORIAL_ASYNC', '1') == '1'
+HISTORIAL_FLUSH_MS = int(os.environ.get('HISTORIAL_FLUSH_MS', 500))
+HISTORIAL_LOTE = int(os.environ.get('HISTORIAL_LOTE', 200))
+HISTORIAL_COLA = int(os.environ.get('HISTORIAL_COLA', 10000))
+# Varias sedes en un despliegue: "norte=Centro Norte,sur=Centro Sur". La primera usa
+# la BD de arriba; cada una de las demás, <clave>.db en la misma carpeta
+SEDES = os.environ.get('SEDES', '')
+# Minutos sin uso tras los que se cierran el pool y la caché de una sede
+SEDE_INACTIVA_MIN = int(os.environ.get('SEDE_INACTIVA_MIN', 15))
 
 PROF_PALETTE = {
     "HUAPAYA ESPINOZA GIRALDO WILFREDO":    {'bg': '#203764', 'font': 'white'},
@@ -152,6 +218,8 @@ table.citas-table{width:100%;border-collapse:collapse;font-size:.85rem}
 .flash-warning{background:#fffbeb;color:#92400e;border:1px solid #fef3c7}
 .flash-info{background:#eff6ff;color:#1e40af;border:1px solid #dbeafe}
 .flash-close{background:none;border:none;font-size:1.2rem;cursor:pointer;opacity:.5;padding:0 .3rem}
+.aviso-offline{padding:.6rem 1rem;border-radius:4px;margin-bottom:1rem;font-size:.88rem;background:#fffbeb;color:#92400e;border:1px solid #fde68a}
+.solo-lectura [onclick^="openModal"],.solo-lectura [onclick^="toggleSihce"],.solo-lectura form[action^="/cita/"]{display:none}
 .login-wrapper{min-height:100vh;display:flex;align-items:center;justify-content:center;background:linear-gradient(135deg,#1a365d 0%,#2b5797 50%,#1a365d 100%);padding:1rem}
 .login-card{background:#fff;border-radius:12px;box-shadow:0 20px 60px rgba(0,0,0,.3);padding:2.5rem;width:100%;max-width:400px}
 .login-header{text-align:center;margin-bottom:1.5rem}
@@ -197,9 +265,14 @@ def navbar_html():
         admin_links = '''
         <a href="/cambiar_turno" class="nav-link">🔄 Cambiar Turno</a>
         <a href="/generar" class="nav-link">⚙️ Generar</a>
+        <a href="/importar" class="nav-link">📤 Importar</a>
         <a href="/profesionales" class="nav-link">👥 Profesionales</a>
         <a href="/usuarios" class="nav-link">🔑 Usuarios</a>
+        <a href="/mantenimiento" class="nav-link">🛠️ Mantenimiento</a>
         '''
+        if PERFIL_SQL: admin_links += '<a href="/sql_lento" class="nav-link">🐢 SQL</a>'
+        admin_links += '<a href="/perfiles" class="nav-link">⏱️ Perfiles</a>'
+        if MULTISEDE: admin_links += '<a href="/reportes/sedes" class="nav-link">🏥 Sedes</a>'
     return f'''<nav class="navbar">
         <div class="nav-brand"><span style="font-size:1.4rem">🏥</span><span class="nav-title">SISTEMA DE CITAS</span></div>
         <div class="nav-links">
@@ -207,10 +280,12 @@ def navbar_html():
             <a href="/reporte_diario" class="nav-link">📋 Reporte Diario</a>
             {admin_links}
             <a href="/reportes" class="nav-link">📊 Reportes</a>
+            <a href="/tendencias" class="nav-link">📈 Tendencias</a>
             <a href="/exportar_form" class="nav-link">📥 Excel</a>
         </div>
         <div class="nav-user">
-            <span class="user-badge">{session.get('user_nombre','')}</span>
+            {f'<span class="user-badge">📍 {esc(sede_actual().nombre)}</span>' if MULTISEDE else ''}
+            <span class="user-badge">{esc(session.get('user_nombre',''))}</span>
             <a href="/logout" class="btn-logout">Salir</a>
         </div>
     </nav>'''
@@ -220,23 +295,348 @@ def page(title, content, flash_msgs=None):
     if flash_msgs:
         flashes = '<div class="flash-container">'
         for cat, msg in flash_msgs:
-            flashes += f'<div class="flash flash-{cat}">{msg}<button class="flash-close" onclick="this.parentElement.remove()">×</button></div>'
+            flashes += f'<div class="flash flash-{cat}">{esc(msg)}<button class="flash-close" onclick="this.parentElement.remove()">×</button></div>'
         flashes += '</div>'
     return f'''<!DOCTYPE html>
 <html lang="es"><head><meta charset="UTF-8"><meta name="viewport" content="width=device-width,initial-scale=1.0">
 <title>{title}</title><style>{CSS}</style></head>
-<body>{navbar_html()}<main class="container">{flashes}{content}</main>
+<body data-uid="{session.get('sede', '')}:{session.get('user_id', '')}">{navbar_html()}<main class="container">{flashes}{content}</main>
 <script>document.querySelectorAll('.flash').forEach(el=>setTimeout(()=>{{el.style.opacity='0';setTimeout(()=>el.remove(),300)}},5000));</script>
 </body></html>'''
 
+# ==============================================================================
+# RENDERIZADO - plantillas de fila compiladas una vez, valores escapados
+# ==============================================================================
+def esc(v):
+    """HTML-escape a DB/user value for text or attribute context"""
+    if v.__class__ is str: return _escape_html(v)
+    return '' if v is None else _escape_html(str(v))
+
+def plantilla(texto):
+    """Compile a row template once, at import, into a plain keyword-only function.
+
+    Every field is escaped except those whose name ends in ``_html``, which
+    carry fragments the caller already built. Callers collect rendered rows
+    in a list and ''.join() them once.
+    """
+    partes, campos = [], []
+    for literal, campo, _, _ in string.Formatter().parse(texto):
+        if literal: partes.append(repr(literal))
+        if campo is None: continue
+        if campo not in campos: campos.append(campo)
+        partes.append(campo if campo.endswith('_html') else f'esc({campo})')
+    espacio = {'esc': esc}
+    exec(f"def render(*, {', '.join(campos)}):\n    return ''.join(({', '.join(partes)},))", espacio)
+    return espacio['render']
+
+_OPCION_PROF = plantilla('<option value="{id}" {sel_html}>{nombre} ({esp})</option>')
+_BADGE_TIPO = {
+    'NUEVO': '<span class="badge badge-new">NUEVO</span>',
+    'CONTINUADOR': '<span class="badge badge-cont">CONTINUADOR</span>',
+    '': '',
+}
+_BADGE_TIPO_OTRO = plantilla('<span class="badge badge-cont">{tipo}</span>')
+
+def badge_tipo(tipo):
+    return _BADGE_TIPO.get(tipo) or _BADGE_TIPO_OTRO(tipo=tipo)
+
+_MARCA_CONTENIDO = '<!--contenido-->'
+
+def page_stream(title, partes, flash_msgs=None):
+    """Streamed page(): the header is sent at once, then each part as it is produced"""
+    inicio, fin = page(title, _MARCA_CONTENIDO, flash_msgs).split(_MARCA_CONTENIDO, 1)
+    def generar():
+        yield inicio
+        yield from partes
+        yield fin
+    return Response(stream_with_context(generar()), mimetype='text/html')
+
+# ==============================================================================
+# MÉTRICAS - formato de texto Prometheus, por proceso (worker)
+# ==============================================================================
+_BUCKETS_SEG = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+_BUCKETS_N = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+_BUCKETS_BYTES = (1e3, 5e3, 1e4, 5e4, 1e5, 5e5, 1e6, 5e6)
+
+class _Metrica:
+    def __init__(self, nombre, ayuda, etiquetas, buckets=None):
+        self.nombre, self.ayuda, self.etiquetas, self.buckets = nombre, ayuda, etiquetas, buckets
+        self.series = {}
+
+    def observar(self, valores, v=1):
+        with _metricas_lock:
+            if self.buckets is None:
+                self.series[valores] = self.series.get(valores, 0) + v
+                return
+            s = self.series.get(valores)
+            if s is None: s = self.series[valores] = [0] * (len(self.buckets) + 2)
+            for i, b in enumerate(self.buckets):
+                if v <= b: s[i] += 1
+            s[-2] += v; s[-1] += 1
+
+    def exponer(self):
+        tipo = 'counter' if self.buckets is None else 'histogram'
+        lineas = [f'# HELP {self.nombre} {self.ayuda}', f'# TYPE {self.nombre} {tipo}']
+        with _metricas_lock:
+            for valores, s in sorted(self.series.items()):
+                et = ','.join(f'{k}="{v}"' for k, v in zip(self.etiquetas, valores))
+                llaves = f'{{{et}}}' if et else ''
+                if self.buckets is None:
+                    lineas.append(f'{self.nombre}{llaves} {s}'); continue
+                sep = ',' if et else ''
+                for b, n in zip(self.buckets, s):
+                    lineas.append(f'{self.nombre}_bucket{{{et}{sep}le="{b:g}"}} {n}')
+                lineas.append(f'{self.nombre}_bucket{{{et}{sep}le="+Inf"}} {s[-1]}')
+                lineas.append(f'{self.nombre}_sum{llaves} {s[-2]:.6f}')
+                lineas.append(f'{self.nombre}_count{llaves} {s[-1]}')
+        return lineas
+
+_metricas_lock = threading.Lock()
+M_REQ_SEG = _Metrica('citas_http_request_duration_seconds', 'Latencia por ruta', ('endpoint', 'method'), _BUCKETS_SEG)
+M_REQ_TOTAL = _Metrica('citas_http_requests_total', 'Solicitudes por ruta y estado', ('endpoint', 'method', 'status'))
+M_RESP_BYTES = _Metrica('citas_http_response_bytes', 'Tamaño de respuesta', ('endpoint',), _BUCKETS_BYTES)
+M_SQL_N = _Metrica('citas_db_queries_per_request', 'Sentencias SQL por solicitud', ('endpoint',), _BUCKETS_N)
+M_SQL_SEG = _Metrica('citas_db_query_seconds_per_request', 'Tiempo total en SQL por solicitud', ('endpoint',), _BUCKETS_SEG)
+M_CONN_SEG = _Metrica('citas_db_connection_wait_seconds', 'Espera para obtener una conexión', ('tipo',), _BUCKETS_SEG)
+M_COMMIT_SEG = _Metrica('citas_db_commit_seconds', 'Duración de COMMIT (incluye espera del lock de escritura)', (), _BUCKETS_SEG)
+M_CACHE = _Metrica('citas_cache_total', 'Caché de respuestas: hit, miss o 304', ('endpoint', 'resultado'))
+M_HIST_SEG = _Metrica('citas_historial_flush_seconds', 'Escritura de un lote de auditoría', (), _BUCKETS_SEG)
+M_HIST_LOTE = _Metrica('citas_historial_flush_eventos', 'Eventos por lote de auditoría', (), _BUCKETS_N)
+M_HIST_PERDIDOS = _Metrica('citas_historial_descartados_total', 'Eventos de auditoría descartados tras fallar la escritura', ())
+METRICAS_TODAS = (M_REQ_SEG, M_REQ_TOTAL, M_RESP_BYTES, M_SQL_N, M_SQL_SEG, M_CONN_SEG, M_COMMIT_SEG, M_CACHE,
+                  M_HIST_SEG, M_HIST_LOTE, M_HIST_PERDIDOS)
+
+def _sumar_sql(t0):
+    if has_request_context():
+        g.sql_n = g.get('sql_n', 0) + 1
+        g.sql_t = g.get('sql_t', 0.0) + time.perf_counter() - t0
+
+class _ConexionMedida(sqlite3.Connection):
+    """Connection that adds every statement to the current request's SQL counters"""
+
+    def execute(self, sql, params=()):
+        t0 = time.perf_counter()
+        try: return super().execute(sql, params)
+        finally:
+            _sumar_sql(t0)
+            if PERFIL_SQL: _perfil_sql(self, sql, params, time.perf_counter() - t0)
+
+    def executemany(self, sql, filas):
+        t0 = time.perf_counter()
+        try: return super().executemany(sql, filas)
+        finally:
+            _sumar_sql(t0)
+            if PERFIL_SQL: _perfil_sql(self, sql, None, time.perf_counter() - t0)
+
+    def executescript(self, *a):
+        t0 = time.perf_counter()
+        try: return super().executescript(*a)
+        finally: _sumar_sql(t0)
+
+    def commit(self):
+        t0 = time.perf_counter()
+        try: return super().commit()
+        finally: M_COMMIT_SEG.observar((), time.perf_counter() - t0)
+
+_ConexionBase = _ConexionMedida if METRICAS or PERFIL_SQL else sqlite3.Connection
+
+# ------------------------------------------------------------------------------
+# Perfil de SQL: agregado por sentencia normalizada, en memoria del worker
+# ------------------------------------------------------------------------------
+_perfil = {}
+_perfil_lock = threading.Lock()
+_PERFIL_MAX = 500
+_TABLAS_VIGILADAS = ('citas', 'historial')
+
+def _normalizar_sql(sql):
+    sql = re.sub(r'\s+', ' ', sql).strip()
+    return re.sub(r'\(\s*\?(\s*,\s*\?)+\s*\)', '(?…)', sql)
+
+def _forma_params(params):
+    if params is None: return 'executemany'
+    if isinstance(params, dict): return '{' + ', '.join(sorted(params)) + '}'
+    return '(' + ', '.join(type(p).__name__ for p in params) + ')'
+
+def _escaneos(conn, sql, params):
+    """EXPLAIN QUERY PLAN once; return (plan lines, full scans of watched tables)"""
+    if not re.match(r'\s*(SELECT|UPDATE|DELETE|WITH)\b', sql, re.I): return [], []
+    try:
+        plan = [r[3] for r in sqlite3.Connection.execute(conn, 'EXPLAIN QUERY PLAN ' + sql, params or ())]
+    except sqlite3.Error as e:
+        return [f'(sin plan: {e})'], []
+    # Alias -> tabla, para reconocer "SCAN c" como escaneo de citas
+    alias = {t: t for t in _TABLAS_VIGILADAS}
+    for tabla, al in re.findall(r'\b(?:FROM|JOIN|UPDATE)\s+(\w+)(?:\s+(?:AS\s+)?(\w+))?', sql, re.I):
+        if tabla in _TABLAS_VIGILADAS and al and al.upper() not in ('WHERE', 'JOIN', 'ON', 'SET', 'LEFT', 'INNER', 'ORDER', 'GROUP'):
+            alias[al] = tabla
+    escaneos = []
+    for linea in plan:
+        m = re.match(r'SCAN (\w+)', linea)
+        if m and m.group(1) in alias and 'COVERING INDEX' not in linea:
+            escaneos.append(alias[m.group(1)])
+    return plan, escaneos
+
+def _perfil_sql(conn, sql, params, seg):
+    clave = _normalizar_sql(sql)
+    ms = seg * 1000
+    with _perfil_lock:
+        e = _perfil.get(clave)
+        nuevo = e is None
+        if nuevo:
+            if len(_perfil) >= _PERFIL_MAX: return
+            e = _perfil[clave] = {'sql': clave, 'n': 0, 'total_ms': 0.0, 'max_ms': 0.0, 'lentas': 0,
+                                  'formas': set(), 'plan': [], 'escaneos': []}
+        e['n'] += 1; e['total_ms'] += ms; e['max_ms'] = max(e['max_ms'], ms)
+        if len(e['formas']) < 5: e['formas'].add(_forma_params(params))
+        if ms >= SQL_LENTO_MS: e['lentas'] += 1
+    if nuevo and params is not None:
+        e['plan'], e['escaneos'] = _escaneos(conn, sql, params)
+        if e['escaneos']:
+            app.logger.warning('SQL con escaneo completo de %s: %s', ', '.join(e['escaneos']), clave)
+    if ms >= SQL_LENTO_MS:
+        app.logger.warning('SQL lenta (%.1f ms) %s %s', ms, _forma_params(params), clave)
+
+@app.before_request
+def _metricas_inicio():
+    if METRICAS: g.t0 = time.perf_counter()
+
+@app.after_request
+def _metricas_fin(resp):
+    if not METRICAS or 't0' not in g: return resp
+    ep = request.endpoint or 'desconocido'
+    M_REQ_SEG.observar((ep, request.method), time.perf_counter() - g.t0)
+    M_REQ_TOTAL.observar((ep, request.method, str(resp.status_code)))
+    if not resp.is_streamed: M_RESP_BYTES.observar((ep,), resp.calculate_content_length() or 0)
+    M_SQL_N.observar((ep,), g.get('sql_n', 0))
+    M_SQL_SEG.observar((ep,), g.get('sql_t', 0.0))
+    return resp
+
+@app.route('/metrics')
+def metrics():
+    if not METRICAS: abort(404)
+    token = request.headers.get('Authorization', '')
+    if not (session.get('user_rol') == 'admin' or (METRICAS_TOKEN and secrets.compare_digest(token, f'Bearer {METRICAS_TOKEN}'))):
+        abort(403)
+    lineas = [f'# worker pid {os.getpid()}']
+    for m in METRICAS_TODAS: lineas.extend(m.exponer())
+    lineas += ['# HELP citas_pool_lectura_libres Conexiones de lectura libres en el pool',
+               '# TYPE citas_pool_lectura_libres gauge',
+               *(f'citas_pool_lectura_libres{{sede="{s.clave}"}} {s.pool.libres.qsize()}' if MULTISEDE
+                 else f'citas_pool_lectura_libres {s.pool.libres.qsize()}' for s in SEDES_REGISTRO.values()),
+               '# HELP citas_historial_cola Eventos de auditoría esperando escribirse',
+               '# TYPE citas_historial_cola gauge',
+               f'citas_historial_cola {auditoria.pendientes()}']
+    resp = make_response('\n'.join(lineas) + '\n')
+    resp.headers['Content-Type'] = 'text/plain; version=0.0.4; charset=utf-8'
+    return resp
+
 # ==============================================================================
 # BASE DE DATOS
 # ==============================================================================
 def get_db():
-    conn = sqlite3.connect(DB_PATH)
+    sede = _sede_en_uso()
+    t0 = time.perf_counter()
+    conn = sqlite3.connect(sede.db_path, factory=_ConexionBase)
+    if METRICAS: M_CONN_SEG.observar(('escritura',), time.perf_counter() - t0)
     conn.row_factory = sqlite3.Row
     conn.execute("PRAGMA journal_mode=WAL")
     conn.execute("PRAGMA foreign_keys=ON")
+    if has_request_context(): g.setdefault('conexiones', []).append(conn)
+    return conn
+
+def _cerrar_conexiones(excepto=None):
+    """Close (rolling back) the write connections this request left open"""
+    for conn in g.pop('conexiones', ()):
+        if conn is not excepto: conn.close()
+
+@app.teardown_request
+def _cerrar_conexiones_solicitud(_exc=None):
+    # Una vista que falla a mitad de camino no debe dejar tomado el lock de escritura
+    _cerrar_conexiones()
+
+class _ConexionLectura(_ConexionBase):
+    """Read-only connection whose close() hands it back to the pool"""
+    generacion = 0
+    pool = None
+
+    def close(self):
+        self.pool.devolver(self)
+
+class _PoolLectura:
+    def __init__(self, tamanio, db_path):
+        self.libres = queue.LifoQueue(maxsize=tamanio)
+        self.generacion = 0
+        self.lock = threading.Lock()
+        self.snapshot_en = 0
+        self.snapshot_id = None  # (inodo, mtime) del snapshot que usan las conexiones actuales
+        self.db_path = db_path
+        self.snapshot_path = db_path + '.snapshot'
+
+    def _ruta(self):
+        if SNAPSHOT_SEGUNDOS > 0:
+            self._refrescar_snapshot()
+            return self.snapshot_path
+        return self.db_path
+
+    def _refrescar_snapshot(self):
+        if time.time() - self.snapshot_en < SNAPSHOT_SEGUNDOS: return
+        with self.lock:
+            if time.time() - self.snapshot_en < SNAPSHOT_SEGUNDOS: return
+            if os.path.exists(self.snapshot_path) and time.time() - os.path.getmtime(self.snapshot_path) < SNAPSHOT_SEGUNDOS:
+                # Otro worker ya lo refrescó: si el archivo cambió, las conexiones abiertas leen el anterior
+                st = os.stat(self.snapshot_path)
+                self.snapshot_en = st.st_mtime
+                if (st.st_ino, st.st_mtime_ns) != self.snapshot_id:
+                    self.snapshot_id = (st.st_ino, st.st_mtime_ns)
+                    self.generacion += 1
+                return
+            tmp = f'{self.snapshot_path}.{os.getpid()}.tmp'
+            src = sqlite3.connect(f'file:{self.db_path}?mode=ro', uri=True)
+            dst = sqlite3.connect(tmp)
+            src.backup(dst)
+            dst.execute("PRAGMA journal_mode=DELETE")
+            dst.close(); src.close()
+            os.replace(tmp, self.snapshot_path)
+            st = os.stat(self.snapshot_path)
+            self.snapshot_en = time.time()
+            self.snapshot_id = (st.st_ino, st.st_mtime_ns)
+            self.generacion += 1
+
+    def obtener(self):
+        ruta = self._ruta()
+        while True:
+            try: conn = self.libres.get_nowait()
+            except queue.Empty: break
+            if conn.generacion == self.generacion: return conn
+            sqlite3.Connection.close(conn)
+        conn = sqlite3.connect(f'file:{ruta}?mode=ro', uri=True, check_same_thread=False, factory=_ConexionLectura)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA query_only=ON")
+        conn.generacion = self.generacion
+        conn.pool = self
+        return conn
+
+    def devolver(self, conn):
+        if conn.in_transaction: conn.rollback()
+        if conn.generacion != self.generacion:
+            sqlite3.Connection.close(conn); return
+        try: self.libres.put_nowait(conn)
+        except queue.Full: sqlite3.Connection.close(conn)
+
+    def vaciar(self):
+        """Close idle connections; the ones in use close when handed back"""
+        self.generacion += 1
+        while True:
+            try: sqlite3.Connection.close(self.libres.get_nowait())
+            except queue.Empty: return
+
+def get_db_lectura():
+    """Read-only connection for reports/exports; never takes write locks"""
+    pool = _sede_en_uso().pool
+    if not METRICAS: return pool.obtener()
+    t0 = time.perf_counter()
+    conn = pool.obtener()
+    M_CONN_SEG.observar(('lectura',), time.perf_counter() - t0)
     return conn
 
 def init_db():
@@ -303,10 +703,67 @@ def init_db():
             detalle TEXT,
             fecha_hora TIMESTAMP DEFAULT CURRENT_TIMESTAMP
         );
+        CREATE TABLE IF NOT EXISTS retenciones (
+            cita_id INTEGER PRIMARY KEY,
+            usuario_id INTEGER NOT NULL,
+            usuario_nombre TEXT DEFAULT '',
+            expira_en TIMESTAMP NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS idempotencia (
+            clave TEXT NOT NULL,
+            usuario_id INTEGER NOT NULL,
+            ruta TEXT NOT NULL,
+            status INTEGER,
+            location TEXT DEFAULT '',
+            mimetype TEXT DEFAULT '',
+            cuerpo BLOB,
+            creado_en TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (clave, usuario_id)
+        );
+        CREATE TABLE IF NOT EXISTS mantenimiento (
+            tarea TEXT PRIMARY KEY,
+            inicio TIMESTAMP,
+            fin TIMESTAMP,
+            ok INTEGER DEFAULT 0,
+            duracion_ms INTEGER DEFAULT 0,
+            detalle TEXT DEFAULT ''
+        );
         CREATE INDEX IF NOT EXISTS idx_citas_fecha ON citas(fecha);
         CREATE INDEX IF NOT EXISTS idx_citas_prof ON citas(profesional_id);
         CREATE INDEX IF NOT EXISTS idx_citas_estado ON citas(estado);
+        CREATE TABLE IF NOT EXISTS version_datos (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            n INTEGER NOT NULL DEFAULT 0
+        );
+        INSERT OR IGNORE INTO version_datos (id, n) VALUES (1, 0);
+        CREATE TABLE IF NOT EXISTS resumen_diario (
+            fecha DATE NOT NULL,
+            profesional_id INTEGER NOT NULL,
+            turno TEXT NOT NULL,
+            slots INTEGER NOT NULL DEFAULT 0,
+            confirmados INTEGER NOT NULL DEFAULT 0,
+            asistieron INTEGER NOT NULL DEFAULT 0,
+            no_asistieron INTEGER NOT NULL DEFAULT 0,
+            nuevos INTEGER NOT NULL DEFAULT 0,
+            continuadores INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (fecha, profesional_id, turno)
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS resumen_pendiente (fecha DATE PRIMARY KEY) WITHOUT ROWID;
+        CREATE TRIGGER IF NOT EXISTS trg_resumen_insert AFTER INSERT ON citas BEGIN
+            INSERT OR IGNORE INTO resumen_pendiente VALUES (NEW.fecha);
+        END;
+        CREATE TRIGGER IF NOT EXISTS trg_resumen_update
+        AFTER UPDATE OF fecha, profesional_id, turno, estado, asistencia, tipo_paciente ON citas BEGIN
+            INSERT OR IGNORE INTO resumen_pendiente VALUES (OLD.fecha);
+            INSERT OR IGNORE INTO resumen_pendiente VALUES (NEW.fecha);
+        END;
+        CREATE TRIGGER IF NOT EXISTS trg_resumen_delete AFTER DELETE ON citas BEGIN
+            INSERT OR IGNORE INTO resumen_pendiente VALUES (OLD.fecha);
+        END;
     ''')
+    # Resumen diario recién creado en una BD con datos: todos los días quedan pendientes
+    if not conn.execute("SELECT 1 FROM resumen_diario LIMIT 1").fetchone():
+        conn.execute("INSERT OR IGNORE INTO resumen_pendiente SELECT DISTINCT fecha FROM citas")
     # Add sihce column if missing (for upgrades)
     try:
         conn.execute("SELECT sihce FROM citas LIMIT 1")
@@ -332,7 +789,8 @@ def init_db():
         conn.execute("INSERT INTO usuarios (username, password_hash, nombre, rol) VALUES (?,?,?,?)",
             ('admin', generate_password_hash('admin123'), 'Administrador', 'admin'))
     count = conn.execute("SELECT COUNT(*) FROM profesionales").fetchone()[0]
-    if count == 0:
+    # La plantilla de profesionales es la del centro original; las demás sedes parten vacías
+    if count == 0 and sede_actual() is SEDE_PRINCIPAL:
         for i, (nombre, colores) in enumerate(PROF_PALETTE.items()):
             esp = 'PSICOLOGÍA'
             for area, profs in SPECIALTY_MAP.items():
@@ -342,13 +800,268 @@ def init_db():
     conn.commit()
     conn.close()
 
+# ==============================================================================
+# ACCESO A DATOS - consultas de las rutas sobre citas, profesionales, roles, usuarios e historial
+# ==============================================================================
+# Las rutas piden y guardan datos a través de repositorio(conn); la conexión y el
+# commit siguen siendo de la ruta, así varias llamadas comparten una transacción.
+# Otro backend implementa los mismos métodos y se registra en BACKENDS_DATOS.
+# Fuera de aquí quedan los procesos masivos atados a SQLite: generación de meses,
+# reportes y exportaciones por cursor, archivo anual (ATTACH) y mantenimiento.
+class DatosSQLite:
+    def __init__(self, conn):
+        self.conn = conn
+
+    # --- usuarios ---
+    def usuario_activo(self, username):
+        return self.conn.execute("SELECT * FROM usuarios WHERE username=? AND activo=1", (username,)).fetchone()
+
+    def usuarios(self):
+        return self.conn.execute("SELECT * FROM usuarios ORDER BY id").fetchall()
+
+    def crear_usuario(self, username, password_hash, nombre, rol):
+        """False when the username is taken"""
+        try:
+            self.conn.execute("INSERT INTO usuarios (username, password_hash, nombre, rol) VALUES (?,?,?,?)",
+                              (username, password_hash, nombre, rol))
+            return True
+        except sqlite3.IntegrityError:
+            return False
+
+    def alternar_usuario(self, usuario_id):
+        return self.conn.execute("UPDATE usuarios SET activo = 1 - activo WHERE id=?", (usuario_id,)).rowcount > 0
+
+    # --- profesionales ---
+    def profesionales(self, activos=False, especialidades=None, ids=None):
+        if ids is not None and not ids: return []
+        filtro, params = [], []
+        if activos: filtro.append('activo=1')
+        if ids is not None:
+            filtro.append(f"id IN ({','.join('?' * len(ids))})"); params += ids
+        if especialidades:
+            filtro.append(f"especialidad IN ({','.join('?' * len(especialidades))})"); params += especialidades
+        donde = f"WHERE {' AND '.join(filtro)}" if filtro else ''
+        return self.conn.execute(f"SELECT * FROM profesionales {donde} ORDER BY orden", params).fetchall()
+
+    def profesional(self, prof_id):
+        return self.conn.execute("SELECT * FROM profesionales WHERE id=?", (prof_id,)).fetchone()
+
+    def nombres_profesionales(self, ids=None):
+        """{id: nombre} for the given ids, or for every professional"""
+        if ids is None: return dict(self.conn.execute("SELECT id, nombre FROM profesionales").fetchall())
+        if not ids: return {}
+        return dict(self.conn.execute(f"SELECT id, nombre FROM profesionales WHERE id IN ({','.join('?' * len(ids))})", list(ids)).fetchall())
+
+    def crear_profesional(self, nombre, especialidad, color_bg, color_font):
+        """Appended at the end of the display order; False when the name is taken"""
+        orden = self.conn.execute("SELECT MAX(orden) FROM profesionales").fetchone()[0] or 0
+        try:
+            self.conn.execute("INSERT INTO profesionales (nombre, especialidad, color_bg, color_font, orden) VALUES (?,?,?,?,?)",
+                              (nombre, especialidad, color_bg, color_font, orden + 1))
+            return True
+        except sqlite3.IntegrityError:
+            return False
+
+    def editar_profesional(self, prof_id, nombre, especialidad, color_bg, color_font):
+        self.conn.execute("UPDATE profesionales SET nombre=?, especialidad=?, color_bg=?, color_font=? WHERE id=?",
+                          (nombre, especialidad, color_bg, color_font, prof_id))
+
+    def alternar_profesional(self, prof_id):
+        return self.conn.execute("UPDATE profesionales SET activo = 1 - activo WHERE id=?", (prof_id,)).rowcount > 0
+
+    # --- citas ---
+    def cita(self, cita_id):
+        return self.conn.execute("SELECT * FROM citas WHERE id=?", (cita_id,)).fetchone()
+
+    def cita_con_profesional(self, cita_id):
+        return self.conn.execute("""SELECT c.*, p.nombre as prof_nombre, p.especialidad
+            FROM citas c JOIN profesionales p ON p.id=c.profesional_id WHERE c.id=?""", (cita_id,)).fetchone()
+
+    def citas_del_dia(self, prof_id, fecha):
+        """The professional's slots for a day, morning first, with the display colours"""
+        return self.conn.execute("""SELECT c.*, p.nombre as prof_nombre, p.color_bg, p.color_font
+            FROM citas c JOIN profesionales p ON p.id=c.profesional_id
+            WHERE c.profesional_id=? AND c.fecha=? ORDER BY
+            CASE c.turno WHEN 'MAÑANA' THEN 1 WHEN 'TARDE' THEN 2 WHEN 'ADMINISTRATIVA' THEN 3 END,
+            c.hora_inicio""", (prof_id, fecha)).fetchall()
+
+    def fechas_con_cupos(self, prof_id):
+        return [r['fecha'] for r in self.conn.execute("SELECT DISTINCT fecha FROM citas WHERE profesional_id=? ORDER BY fecha", (prof_id,))]
+
+    def turnos_del_dia(self, prof_id, fecha):
+        return [r['turno'] for r in self.conn.execute(
+            "SELECT DISTINCT turno FROM citas WHERE profesional_id=? AND fecha=? AND turno!='ADMINISTRATIVA'", (prof_id, fecha))]
+
+    def agendar(self, cita_id, datos, usuario_id):
+        """Book a free slot; False when someone else booked it first"""
+        return self.conn.execute("""UPDATE citas SET paciente=?, dni=?, edad=?, celular=?, observaciones=?, estado='Confirmado',
+            tipo_paciente=?, sihce=?, sihce_prof_id=?, actividad_app=?, creado_por=?, modificado_por=?, modificado_en=CURRENT_TIMESTAMP
+            WHERE id=? AND estado='Disponible'""",
+            (datos['paciente'], datos['dni'], datos['edad'], datos['celular'], datos['observaciones'], datos['tipo_paciente'],
+             datos['sihce'], datos['sihce_prof_id'], datos['actividad_app'], usuario_id, usuario_id, cita_id)).rowcount > 0
+
+    def vaciar_cita(self, cita_id, usuario_id):
+        """Clear the patient data and make the slot available again"""
+        self.conn.execute("""UPDATE citas SET paciente='',dni='',edad='',celular='',observaciones='',estado='Disponible',
+            tipo_paciente='',actividad_app='',asistencia='Pendiente',sihce=0,sihce_prof_id=0,modificado_por=?,
+            modificado_en=CURRENT_TIMESTAMP WHERE id=?""", (usuario_id, cita_id))
+
+    def marcar_asistencia(self, cita_id, estado, usuario_id, version=None):
+        """With version (the row's modificado_en the caller saw), False when the row changed since"""
+        if version is None:
+            self.conn.execute("UPDATE citas SET asistencia=?, modificado_por=?, modificado_en=CURRENT_TIMESTAMP WHERE id=?",
+                              (estado, usuario_id, cita_id))
+            return True
+        return self.conn.execute("""UPDATE citas SET asistencia=?, modificado_por=?, modificado_en=CURRENT_TIMESTAMP
+            WHERE id=? AND estado='Confirmado' AND IFNULL(modificado_en, '')=?""", (estado, usuario_id, cita_id, version)).rowcount > 0
+
+    def marcar_sihce(self, cita_id, valor, usuario_id):
+        self.conn.execute("UPDATE citas SET sihce=?, modificado_por=?, modificado_en=CURRENT_TIMESTAMP WHERE id=?",
+                          (valor, usuario_id, cita_id))
+
+    # --- roles_mensuales ---
+    def rol_guardado(self, anio, mes):
+        """{nombre: {dia: turno}} as last generated for the month"""
+        rol = {}
+        for r in self.conn.execute("""SELECT r.dia, r.turno, p.nombre FROM roles_mensuales r
+                JOIN profesionales p ON p.id=r.profesional_id WHERE r.anio=? AND r.mes=?""", (anio, mes)):
+            rol.setdefault(r['nombre'], {})[r['dia']] = r['turno']
+        return rol
+
+    def turnos_rol(self, prof_id):
+        """{'AAAA-MM-DD': turno} for every day in the professional's saved rosters"""
+        return {f"{r['anio']}-{r['mes']:02d}-{r['dia']:02d}": r['turno'] for r in self.conn.execute(
+            "SELECT dia, turno, mes, anio FROM roles_mensuales WHERE profesional_id=?", (prof_id,))}
+
+    # --- historial ---
+    def registrar_historial(self, eventos):
+        """Rows (cita_id, usuario_id, accion, detalle[, fecha_hora]); without the time the insert's is used"""
+        eventos = list(eventos)
+        if eventos and len(eventos[0]) == 5:
+            self.conn.executemany("INSERT INTO historial (cita_id, usuario_id, accion, detalle, fecha_hora) VALUES (?,?,?,?,?)", eventos)
+        else:
+            self.conn.executemany("INSERT INTO historial (cita_id, usuario_id, accion, detalle) VALUES (?,?,?,?)", eventos)
+
+BACKENDS_DATOS = {'sqlite': DatosSQLite}
+if BACKEND_DATOS not in BACKENDS_DATOS:
+    raise RuntimeError(f'DATABASE_URL usa un backend sin implementar: {BACKEND_DATOS}:// '
+                       f'(disponibles: {", ".join(f"{b}://" for b in BACKENDS_DATOS)})')
+
+def repositorio(conn):
+    """Data access for the configured backend over the caller's connection"""
+    return BACKENDS_DATOS[BACKEND_DATOS](conn)
+
+# ==============================================================================
+# AUDITORÍA - historial de acciones
+# ==============================================================================
+def registrar_historial(conn, eventos):
+    """Audit rows (cita_id, usuario_id, accion, detalle) in the caller's transaction.
+
+    Durable mode: the rows commit (and fsync) together with the change they
+    describe. Used for actions that remove or move patient data; routine
+    bookings go through auditar() after their commit instead.
+    """
+    repositorio(conn).registrar_historial(eventos)
+
+# ------------------------------------------------------------------------------
+# Auditoría diferida: cola acotada por worker, un hilo la vacía con executemany
+# ------------------------------------------------------------------------------
+class _Auditoria:
+    def __init__(self):
+        self.cola = queue.Queue(maxsize=HISTORIAL_COLA)
+        # Lotes que fallaron al escribirse: van primero en el siguiente vaciado, hasta HISTORIAL_COLA
+        self.reintentos = []
+        self.despertar = threading.Event()
+        self.hilo = None
+        self.lock = threading.Lock()
+
+    def encolar(self, eventos):
+        sede = sede_actual()
+        # La hora es la del evento, no la de la escritura del lote
+        ts = time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime())
+        for cita_id, usuario_id, accion, detalle in eventos:
+            fila = (sede, cita_id, usuario_id, accion, detalle, ts)
+            try:
+                self.cola.put_nowait(fila)
+            except queue.Full:
+                # Cola llena: esta solicitud escribe lo pendiente en vez de descartar eventos
+                self.vaciar()
+                self.cola.put(fila)
+        if not HISTORIAL_ASYNC:
+            self.vaciar(); return
+        if self.hilo is None: self._iniciar()
+        if self.cola.qsize() >= HISTORIAL_LOTE: self.despertar.set()
+
+    def _iniciar(self):
+        with self.lock:
+            if self.hilo is not None: return
+            self.hilo = threading.Thread(target=self._ciclo, name='auditoria', daemon=True)
+            self.hilo.start()
+
+    def _ciclo(self):
+        while True:
+            self.despertar.wait(HISTORIAL_FLUSH_MS / 1000)
+            self.despertar.clear()
+            try: self.vaciar()
+            except Exception as e: app.logger.error('Auditoría: %s', e)
+
+    def pendientes(self):
+        return self.cola.qsize() + len(self.reintentos)
+
+    def vaciar(self):
+        """Write the failed batches and everything queued so far, one executemany per site; returns the event count"""
+        with self.lock:
+            lote, self.reintentos = self.reintentos, []
+        while True:
+            try: lote.append(self.cola.get_nowait())
+            except queue.Empty: break
+        if not lote: return 0
+        t0 = time.perf_counter()
+        por_sede = OrderedDict()
+        for sede, *fila in lote: por_sede.setdefault(sede, []).append(fila)
+        for sede, filas in por_sede.items():
+            with con_sede(sede):
+                conn = None
+                try:
+                    conn = get_db()
+                    # Sin fsync por lote: un corte de luz puede perder el último intervalo, nunca corromper
+                    conn.execute("PRAGMA synchronous=NORMAL")
+                    repositorio(conn).registrar_historial(filas)
+                    conn.commit()
+                except sqlite3.Error as e:
+                    with self.lock:
+                        cupo = max(0, HISTORIAL_COLA - len(self.reintentos))
+                        self.reintentos.extend((sede, *f) for f in filas[:cupo])
+                    perdidos = max(0, len(filas) - cupo)
+                    app.logger.error('Auditoría %s: %d eventos sin escribir (%s), %d se reintentan y %d se descartan',
+                                     sede.clave, len(filas), e, len(filas) - perdidos, perdidos)
+                    if perdidos and METRICAS: M_HIST_PERDIDOS.observar((), perdidos)
+                finally:
+                    if conn is not None: conn.close()
+        if METRICAS:
+            M_HIST_SEG.observar((), time.perf_counter() - t0)
+            M_HIST_LOTE.observar((), len(lote))
+        return len(lote)
+
+auditoria = _Auditoria()
+atexit.register(auditoria.vaciar)
+
+def auditar(eventos):
+    """Queue audit rows (cita_id, usuario_id, accion, detalle); call after the change is committed"""
+    auditoria.encolar(eventos)
+
 # ==============================================================================
 # AUTENTICACIÓN
 # ==============================================================================
+def _sesion_valida():
+    """Logged in, and on the site the session was opened for"""
+    if 'user_id' not in session: return False
+    return not MULTISEDE or session.get('sede') == sede_actual().clave
+
 def login_required(f):
     @wraps(f)
     def decorated(*args, **kwargs):
-        if 'user_id' not in session:
+        if not _sesion_valida():
             return redirect('/login')
         return f(*args, **kwargs)
     return decorated
@@ -356,23 +1069,293 @@ def login_required(f):
 def admin_required(f):
     @wraps(f)
     def decorated(*args, **kwargs):
-        if 'user_id' not in session: return redirect('/login')
+        if not _sesion_valida(): return redirect('/login')
         if session.get('user_rol') != 'admin': return redirect('/')
         return f(*args, **kwargs)
     return decorated
 
+# ==============================================================================
+# IDEMPOTENCIA - reintentos y doble envío de formularios
+# ==============================================================================
+def idempotente(f):
+    """Replay the stored response when a POST repeats its idempotency key.
+
+    The key comes from the Idempotency-Key header (fetch calls) or the
+    hidden _idem form field. Requests without a key run normally. Expired
+    keys are swept by the 'idempotencia' maintenance task.
+    """
+    def rechazo(mensaje, status):
+        # Los formularios HTML vuelven a la página con el aviso; fetch recibe JSON
+        if 'Idempotency-Key' in request.headers:
+            return jsonify({'error': mensaje}), status
+        flash(mensaje, 'warning')
+        return redirect(request.referrer or '/')
+
+    @wraps(f)
+    def decorated(*args, **kwargs):
+        clave = request.headers.get('Idempotency-Key') or request.form.get('_idem', '')
+        if not clave:
+            return f(*args, **kwargs)
+        uid = session['user_id']
+        conn = get_db()
+        try:
+            try:
+                conn.execute("INSERT INTO idempotencia (clave, usuario_id, ruta) VALUES (?,?,?)", (clave, uid, request.path))
+                conn.commit()
+            except sqlite3.IntegrityError:
+                prev = conn.execute("SELECT * FROM idempotencia WHERE clave=? AND usuario_id=?", (clave, uid)).fetchone()
+                if prev['ruta'] != request.path:
+                    return rechazo('Clave de idempotencia reutilizada', 422)
+                if prev['status'] is None:
+                    return rechazo('Solicitud en proceso: espere a que termine el envío anterior', 409)
+                if prev['location']:
+                    return redirect(prev['location'], code=prev['status'])
+                return make_response(prev['cuerpo'], prev['status'], {'Content-Type': prev['mimetype']})
+            try:
+                resp = make_response(f(*args, **kwargs))
+            except Exception:
+                # La vista pudo quedar con una transacción abierta que bloquearía este DELETE
+                _cerrar_conexiones(excepto=conn)
+                conn.execute("DELETE FROM idempotencia WHERE clave=? AND usuario_id=?", (clave, uid))
+                conn.commit()
+                raise
+            conn.execute("UPDATE idempotencia SET status=?, location=?, mimetype=?, cuerpo=? WHERE clave=? AND usuario_id=?",
+                (resp.status_code, resp.headers.get('Location', ''), resp.content_type or '', resp.get_data(), clave, uid))
+            conn.commit()
+            return resp
+        finally:
+            conn.close()
+    return decorated
+
+def idem_input():
+    return f'<input type="hidden" name="_idem" value="{secrets.token_hex(12)}">'
+
+# ==============================================================================
+# CACHÉ DE RESPUESTAS - versionada por el contador de escrituras de la BD
+# ==============================================================================
+# Cada worker tiene su propia caché; todos leen el mismo contador version_datos
+# (lo incrementa marcar_cambio() en cada ruta que modifica citas, profesionales
+# o roles), así que una escritura en cualquier worker invalida las de todos.
+_ARRANQUE = format(int(os.path.getmtime(__file__)), 'x')  # un despliegue nuevo cambia el ETag
+
+class _CacheLRU:
+    def __init__(self, limite_bytes):
+        self.limite = limite_bytes
+        self.datos = OrderedDict()
+        self.bytes = 0
+        self.version = None
+        self.lock = threading.Lock()
+
+    def obtener(self, clave, version):
+        with self.lock:
+            if version != self.version:
+                self.datos.clear(); self.bytes = 0; self.version = version
+                return None
+            e = self.datos.get(clave)
+            if e is not None: self.datos.move_to_end(clave)
+            return e
+
+    def guardar(self, clave, version, cuerpo, mimetype):
+        if len(cuerpo) > self.limite // 4: return
+        with self.lock:
+            if version != self.version: return
+            viejo = self.datos.pop(clave, None)
+            if viejo: self.bytes -= len(viejo[0])
+            self.datos[clave] = (cuerpo, mimetype)
+            self.bytes += len(cuerpo)
+            while self.bytes > self.limite:
+                _, (c, _m) = self.datos.popitem(last=False)
+                self.bytes -= len(c)
+
+    def limpiar(self):
+        with self.lock:
+            self.datos.clear(); self.bytes = 0; self.version = None
+
+def version_datos():
+    conn = get_db_lectura()
+    try:
+        return conn.execute("SELECT n FROM version_datos WHERE id=1").fetchone()[0]
+    finally:
+        conn.close()
+
+def marcar_cambio(conn):
+    """Bump the data version inside the caller's transaction, before its commit"""
+    conn.execute("UPDATE version_datos SET n = n + 1 WHERE id = 1")
+
+def cacheado(por_usuario=True, almacenar=None):
+    """Cache a read-only GET view keyed on its URL and the data version, with ETag/304.
+
+    por_usuario: the page embeds the navbar/session, so entries are per user.
+    almacenar: optional predicate; when it returns False (e.g. a long streamed
+    range) the response is not kept in memory but still gets the ETag.
+    With SNAPSHOT_SEGUNDOS the views read a lagging copy, so nothing is cached.
+    """
+    def deco(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            # Con snapshot el cuerpo puede ser anterior a la versión: quedaría guardado (y con
+            # ETag) como si fuera actual hasta la próxima escritura
+            if session.get('_flashes') or SNAPSHOT_SEGUNDOS > 0:
+                return f(*args, **kwargs)
+            sede = sede_actual()
+            version = version_datos()
+            # La fecha entra en la clave: sin parámetros las vistas muestran "hoy" / el mes actual
+            uid = f"{session.get('user_id')}.{session.get('user_rol')}" if por_usuario else '0'
+            etag = f'{_ARRANQUE}-{sede.clave}-{version}-{datetime.now():%Y%m%d}-{uid}'
+            if request.if_none_match.contains(etag):
+                if METRICAS: M_CACHE.observar((request.endpoint, '304'))
+                resp = make_response('', 304)
+                resp.set_etag(etag)
+                return resp
+            clave = (request.endpoint, request.full_path, etag)
+            guardar = CACHE_MB > 0 and (almacenar is None or almacenar())
+            e = sede.cache.obtener(clave, version) if guardar else None
+            if e is not None:
+                if METRICAS: M_CACHE.observar((request.endpoint, 'hit'))
+                resp = make_response(e[0])
+                resp.mimetype = e[1]
+            else:
+                if METRICAS: M_CACHE.observar((request.endpoint, 'miss'))
+                resp = make_response(f(*args, **kwargs))
+                if guardar and resp.status_code == 200:
+                    sede.cache.guardar(clave, version, resp.get_data(), resp.mimetype)
+            resp.set_etag(etag)
+            resp.headers['Cache-Control'] = 'private, no-cache'
+            return resp
+        return wrapper
+    return deco
+
+# ==============================================================================
+# SEDES - varios centros en un despliegue, cada uno con su BD, pool y caché
+# ==============================================================================
+# La sede de una solicitud sale del subdominio (norte.citas.example) o de la que
+# se eligió al iniciar sesión; la CLI y los hilos de fondo usan con_sede() o la
+# variable SEDE. Con una sola sede todo se comporta como siempre.
+class Sede:
+    def __init__(self, clave, nombre, db_path, prefijo):
+        self.clave = clave
+        self.nombre = nombre
+        self.db_path = db_path
+        self.prefijo = prefijo  # para respaldos y archivos anuales en carpetas compartidas
+        self.pool = _PoolLectura(LECTURA_POOL, db_path)
+        self.cache = _CacheLRU(int(CACHE_MB * 1024 * 1024))
+        self.lista = False
+        self.abierta = False  # con tráfico web desde el último cierre por inactividad
+        self.uso = 0.0
+        self.lock = threading.Lock()
+
+    def preparar(self):
+        """Create/upgrade this site's schema the first time the process touches it"""
+        with self.lock:
+            if self.lista: return
+            self.lista = True
+            try:
+                with con_sede(self): init_db()
+            except Exception:
+                self.lista = False
+                raise
+
+    def cerrar(self):
+        """Drop pooled connections and cached pages; both reopen on next use"""
+        self.abierta = False
+        self.pool.vaciar()
+        self.cache.limpiar()
+
+def _registro_sedes(texto):
+    sedes = OrderedDict()
+    for i, item in enumerate(p.strip() for p in texto.split(',') if p.strip()):
+        clave, _, nombre = item.partition('=')
+        clave = clave.strip().lower()
+        if not re.fullmatch(r'[a-z0-9-]+', clave) or clave in sedes:
+            raise RuntimeError(f'SEDES: clave inválida o repetida "{clave}" (use letras, números o guiones)')
+        ruta = DB_PATH if i == 0 else os.path.join(os.path.dirname(DB_PATH), f'{clave}.db')
+        sedes[clave] = Sede(clave, nombre.strip() or clave, ruta, '' if i == 0 else f'{clave}_')
+    return sedes or OrderedDict(principal=Sede('principal', 'Centro de Salud Mental Comunitario', DB_PATH, ''))
+
+SEDES_REGISTRO = _registro_sedes(SEDES)
+SEDE_PRINCIPAL = next(iter(SEDES_REGISTRO.values()))
+MULTISEDE = len(SEDES_REGISTRO) > 1
+_sede_hilo = threading.local()
+
+@contextmanager
+def con_sede(sede):
+    """Route get_db()/get_db_lectura() in this thread to another site"""
+    previa = getattr(_sede_hilo, 'sede', None)
+    _sede_hilo.sede = sede
+    try:
+        yield sede
+    finally:
+        _sede_hilo.sede = previa
+
+def sede_subdominio():
+    if not (MULTISEDE and has_request_context()): return None
+    return SEDES_REGISTRO.get(request.host.split(':')[0].split('.')[0].lower())
+
+def sede_actual():
+    sede = getattr(_sede_hilo, 'sede', None)
+    if sede is not None: return sede
+    if not MULTISEDE: return SEDE_PRINCIPAL
+    if not has_request_context():
+        return SEDES_REGISTRO.get(os.environ.get('SEDE', ''), SEDE_PRINCIPAL)
+    return sede_subdominio() or SEDES_REGISTRO.get(session.get('sede'), SEDE_PRINCIPAL)
+
+def _sede_en_uso():
+    sede = sede_actual()
+    if not sede.lista: sede.preparar()
+    # Solo las solicitudes web mantienen abierta una sede; mantenimiento, auditoría y CLI no cuentan
+    if has_request_context():
+        sede.uso = time.time()
+        sede.abierta = True
+    return sede
+
+def _sede_inactiva(sede, ahora):
+    return MULTISEDE and sede.abierta and ahora - sede.uso > SEDE_INACTIVA_MIN * 60
+
+_sedes_revisadas = [0.0]
+
+@app.before_request
+def _cerrar_sedes_inactivas():
+    ahora = time.time()
+    if not MULTISEDE or ahora - _sedes_revisadas[0] < 60: return
+    _sedes_revisadas[0] = ahora
+    for sede in SEDES_REGISTRO.values():
+        if _sede_inactiva(sede, ahora): sede.cerrar()
+
 # ==============================================================================
 # MOTOR DE GENERACIÓN - HORARIOS CORREGIDOS
 # ==============================================================================
-def parse_roster_text(text):
-    result = {}
+_DIAS_SEMANA = {'LUN': 0, 'MAR': 1, 'MIE': 2, 'MIÉ': 2, 'JUE': 3, 'VIE': 4, 'SAB': 5, 'SÁB': 5, 'DOM': 6}
+_DIA_SEMANA_RE = r'(LUN|MAR|MI[EÉ]|JUE|VIE|S[AÁ]B|DOM)\w*'
+_RE_SEMANA = re.compile(rf'(?<!\w){_DIA_SEMANA_RE}(?:\s*-\s*{_DIA_SEMANA_RE})?\s+([A-Z]+)\b', re.IGNORECASE)
+_RE_DIA = re.compile(r'd[ií]a\s+(\d+)\s+([A-Za-z]+)', re.IGNORECASE)
+
+def parse_roster_text(text, year=None, month=None, errores=None):
+    """Parse 'NOMBRE: Día N TURNO, ...' lines into {nombre: {dia: turno}}.
+
+    With year/month, weekly patterns ('LUN M', 'LUN-VIE MT') are expanded
+    to that month's days first; explicit 'Día N' entries override them.
+    A repeated name keeps its first line and is reported in errores.
+    """
+    result = {}; vistos = set()
     for line in text.strip().split('\n'):
         if ':' not in line: continue
         parts = line.split(':', 1)
         name = parts[0].strip().upper()
+        if name in vistos:
+            if errores is not None: errores.append(f'{name}: aparece más de una vez en el rol')
+            continue
+        vistos.add(name)
         sched_text = parts[1].strip()
-        matches = re.findall(r'[Dd]ía\s+(\d+)\s+([A-Za-z]+)', sched_text)
         schedule = {}
+        if year:
+            num_days = calendar.monthrange(year, month)[1]
+            for d1, d2, code in _RE_SEMANA.findall(sched_text):
+                a = _DIAS_SEMANA[d1.upper()[:3]]
+                b = _DIAS_SEMANA[d2.upper()[:3]] if d2 else a
+                semana = {(a + k) % 7 for k in range((b - a) % 7 + 1)}
+                for day in range(1, num_days + 1):
+                    if calendar.weekday(year, month, day) in semana: schedule[day] = code.upper()
+        matches = _RE_DIA.findall(sched_text)
         for day, code in matches: schedule[int(day)] = code.upper()
         if schedule: result[name] = schedule
     return result
@@ -386,79 +1369,63 @@ def _make_slots(start_str, n, duration, turno):
         curr = end
     return slots
 
+def _buscar_profesional(nombre, profs):
+    """Loose name match used by the generator: one name contained in the other, ignoring spaces"""
+    n1 = nombre.replace(" ", "").upper()
+    for db_name, db_data in profs.items():
+        n2 = db_name.replace(" ", "").upper()
+        if n1 in n2 or n2 in n1: return db_data
+    return None
+
+def meses_consecutivos(year, month, n):
+    for _ in range(n):
+        yield year, month
+        month += 1
+        if month > 12: year += 1; month = 1
+
 def generate_slots(conn, year, month, roster_text=None):
-    profs = {r['nombre']: dict(r) for r in conn.execute("SELECT * FROM profesionales WHERE activo=1").fetchall()}
-    if roster_text:
-        parsed = parse_roster_text(roster_text)
-    else:
-        parsed = {}
-        rows = conn.execute("SELECT r.dia, r.turno, p.nombre FROM roles_mensuales r JOIN profesionales p ON p.id=r.profesional_id WHERE r.anio=? AND r.mes=?", (year, month)).fetchall()
-        for r in rows: parsed.setdefault(r['nombre'], {})[r['dia']] = r['turno']
+    parsed = parse_roster_text(roster_text, year, month) if roster_text else repositorio(conn).rol_guardado(year, month)
     if not parsed: return 0
+    return generar_meses(conn, {(year, month): parsed})[(year, month)]
+
+def generar_meses(conn, roles):
+    """Regenerate several months in one transaction.
+
+    roles maps (anio, mes) to {nombre: {dia: turno}}; months with an empty
+    roster are left untouched. Returns the slot count per month.
+    """
+    profs = {r['nombre']: dict(r) for r in repositorio(conn).profesionales(activos=True)}
+    if not conn.in_transaction: conn.execute("BEGIN IMMEDIATE")
+    try:
+        res = {(y, m): _generar_mes(conn, profs, y, m, parsed) if parsed else 0 for (y, m), parsed in roles.items()}
+        marcar_cambio(conn)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return res
+
+def _generar_mes(conn, profs, year, month, parsed):
     num_days = calendar.monthrange(year, month)[1]
+    desde, hasta = f"{year}-{month:02d}-01", f"{year}-{month:02d}-{num_days:02d}"
     existing = {}
     rows = conn.execute("SELECT c.*, p.nombre as prof_nombre FROM citas c JOIN profesionales p ON p.id=c.profesional_id WHERE c.fecha BETWEEN ? AND ? AND c.estado != 'Disponible'",
-        (f"{year}-{month:02d}-01", f"{year}-{month:02d}-{num_days:02d}")).fetchall()
+        (desde, hasta)).fetchall()
     for r in rows:
         key = (r['prof_nombre'], r['fecha'])
         existing.setdefault(key, []).append(dict(r))
-    conn.execute("DELETE FROM citas WHERE fecha BETWEEN ? AND ?", (f"{year}-{month:02d}-01", f"{year}-{month:02d}-{num_days:02d}"))
+    conn.execute("DELETE FROM citas WHERE fecha BETWEEN ? AND ?", (desde, hasta))
     conn.execute("DELETE FROM roles_mensuales WHERE anio=? AND mes=?", (year, month))
-    count = 0
+    roles = []; filas = []
     for day in range(1, num_days + 1):
-        try: curr_date = datetime(year, month, day)
-        except ValueError: continue
+        date_str = f"{year}-{month:02d}-{day:02d}"
         for prof_name, schedule in parsed.items():
             if day not in schedule: continue
-            prof_data = None
-            for db_name, db_data in profs.items():
-                n1 = prof_name.replace(" ", "").upper()
-                n2 = db_name.replace(" ", "").upper()
-                if n1 in n2 or n2 in n1: prof_data = db_data; break
+            prof_data = _buscar_profesional(prof_name, profs)
             if not prof_data: continue
             shift = schedule[day]
-            is_med = prof_data['especialidad'] in ('MEDICINA', 'PSIQUIATRÍA', 'SIHCE')
-            is_to = prof_data['especialidad'] == 'TERAPIA OCUPACIONAL'
-            date_str = curr_date.strftime('%Y-%m-%d')
-            conn.execute("INSERT OR REPLACE INTO roles_mensuales (profesional_id, anio, mes, dia, turno) VALUES (?,?,?,?,?)",
-                (prof_data['id'], year, month, day, shift))
-            slots_to_create = []
-            if is_to:
-                # TERAPIA OCUPACIONAL: 45 min, M sin hora admin pero con 1 paciente en tarde
-                if shift in ('M',):
-                    slots_to_create.extend(_make_slots("07:30", 7, 45, 'MAÑANA'))
-                    slots_to_create.append({'inicio': '13:50', 'fin': '14:35', 'turno': 'TARDE'})
-                elif shift in ('T',):
-                    slots_to_create.extend(_make_slots("13:30", 6, 45, 'TARDE'))
-                elif shift in ('MT', 'GD'):
-                    slots_to_create.extend(_make_slots("07:30", 7, 45, 'MAÑANA'))
-                    slots_to_create.extend(_make_slots("13:45", 6, 45, 'TARDE'))
-            elif is_med:
-                # MÉDICO/PSIQUIATRA: 40 min por cita
-                if shift in ('M',):
-                    # Solo mañana: 7 citas + 1 hora administrativa
-                    slots_to_create.extend(_make_slots("07:30", 7, 40, 'MAÑANA'))
-                    slots_to_create.append({'inicio': '12:10', 'fin': '13:00', 'turno': 'ADMINISTRATIVA'})
-                elif shift in ('T',):
-                    # Solo tarde: inicia 13:30, 6 citas
-                    slots_to_create.extend(_make_slots("13:30", 6, 40, 'TARDE'))
-                elif shift in ('MT', 'GD'):
-                    # MT y GD mismo horario: mañana 8 + tarde 7
-                    slots_to_create.extend(_make_slots("07:30", 8, 40, 'MAÑANA'))
-                    slots_to_create.extend(_make_slots("14:00", 7, 40, 'TARDE'))
-            else:
-                # PSICÓLOGO y otros: 45 min por cita
-                if shift in ('M',):
-                    # Solo mañana: 6 citas + 1 hora administrativa
-                    slots_to_create.extend(_make_slots("07:30", 6, 45, 'MAÑANA'))
-                    slots_to_create.append({'inicio': '12:00', 'fin': '13:00', 'turno': 'ADMINISTRATIVA'})
-                elif shift in ('T',):
-                    # Solo tarde: inicia 13:30 para acabar ~18:00, 6 citas
-                    slots_to_create.extend(_make_slots("13:30", 6, 45, 'TARDE'))
-                elif shift in ('MT', 'GD'):
-                    # MT y GD mismo horario: mañana 7 + tarde 6
-                    slots_to_create.extend(_make_slots("07:30", 7, 45, 'MAÑANA'))
-                    slots_to_create.extend(_make_slots("13:45", 6, 45, 'TARDE'))
+            roles.append((prof_data['id'], year, month, day, shift))
+            slots_to_create = _slots_turno(prof_data['especialidad'], shift) if shift in TURNOS_CAMBIO else []
             prev_appointments = existing.get((prof_data['nombre'], date_str), [])
             prev_by_order = sorted(prev_appointments, key=lambda x: x['hora_inicio'])
             for i, slot in enumerate(slots_to_create):
@@ -467,11 +1434,10 @@ def generate_slots(conn, year, month, roster_text=None):
                     prev = prev_by_order[i]; pac=prev['paciente']; dni=prev['dni']; cel=prev['celular']
                     obs=prev['observaciones']; estado=prev['estado']; tipo=prev['tipo_paciente']; asist=prev['asistencia']
                     sihce = prev.get('sihce', 0); sihce_pid = prev.get('sihce_prof_id', 0); edad = prev.get('edad', ''); app_act = prev.get('actividad_app', '')
-                conn.execute("INSERT INTO citas (profesional_id,fecha,hora_inicio,hora_fin,turno,area,paciente,dni,edad,celular,observaciones,estado,tipo_paciente,actividad_app,asistencia,sihce,sihce_prof_id) VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)",
-                    (prof_data['id'], date_str, slot['inicio'], slot['fin'], slot['turno'], prof_data['especialidad'], pac, dni, edad, cel, obs, estado, tipo, app_act, asist, sihce, sihce_pid))
-                count += 1
-    conn.commit()
-    return count
+                filas.append((prof_data['id'], date_str, slot['inicio'], slot['fin'], slot['turno'], prof_data['especialidad'], pac, dni, edad, cel, obs, estado, tipo, app_act, asist, sihce, sihce_pid))
+    conn.executemany("INSERT OR REPLACE INTO roles_mensuales (profesional_id, anio, mes, dia, turno) VALUES (?,?,?,?,?)", roles)
+    conn.executemany("INSERT INTO citas (profesional_id,fecha,hora_inicio,hora_fin,turno,area,paciente,dni,edad,celular,observaciones,estado,tipo_paciente,actividad_app,asistencia,sihce,sihce_prof_id) VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)", filas)
+    return len(filas)
 
 def get_default_roster():
     return ""
@@ -482,13 +1448,18 @@ def get_default_roster():
 # ==============================================================================
 @app.route('/login', methods=['GET', 'POST'])
 def login():
+    fija = sede_subdominio()
     if request.method == 'POST':
         username = request.form.get('username', '').strip()
         password = request.form.get('password', '')
-        conn = get_db()
-        user = conn.execute("SELECT * FROM usuarios WHERE username=? AND activo=1", (username,)).fetchone()
-        conn.close()
+        sede = fija or SEDES_REGISTRO.get(request.form.get('sede'), SEDE_PRINCIPAL)
+        with con_sede(sede):
+            conn = get_db()
+            user = repositorio(conn).usuario_activo(username)
+            conn.close()
         if user and check_password_hash(user['password_hash'], password):
+            session.clear()
+            session['sede'] = sede.clave
             session['user_id'] = user['id']
             session['user_nombre'] = user['nombre']
             session['user_rol'] = user['rol']
@@ -496,14 +1467,20 @@ def login():
         error_html = '<div class="flash flash-danger" style="margin-bottom:1rem">Usuario o contraseña incorrectos</div>'
     else:
         error_html = ''
+    sede_html = ''
+    if MULTISEDE and not fija:
+        opciones = ''.join(f'<option value="{s.clave}" {"selected" if s.clave == session.get("sede") else ""}>{esc(s.nombre)}</option>'
+                           for s in SEDES_REGISTRO.values())
+        sede_html = f'<div class="form-group"><label for="sede">Sede</label><select id="sede" name="sede" class="form-select">{opciones}</select></div>'
     return f'''<!DOCTYPE html><html lang="es"><head><meta charset="UTF-8"><meta name="viewport" content="width=device-width,initial-scale=1.0">
 <title>Login - Sistema de Citas</title><style>{CSS}</style></head><body>
 <div class="login-wrapper"><div class="login-card">
-<div class="login-header"><span class="login-icon">🏥</span><h1>Sistema de Citas</h1><p>Centro de Salud Mental Comunitario</p></div>
+<div class="login-header"><span class="login-icon">🏥</span><h1>Sistema de Citas</h1><p>{esc(fija.nombre) if fija else 'Centro de Salud Mental Comunitario'}</p></div>
 {error_html}
 <form method="POST" class="login-form">
 <div class="form-group"><label for="username">Usuario</label><input type="text" id="username" name="username" required autofocus placeholder="Ingrese su usuario" class="form-input"></div>
 <div class="form-group"><label for="password">Contraseña</label><input type="password" id="password" name="password" required placeholder="Ingrese su contraseña" class="form-input"></div>
+{sede_html}
 <button type="submit" class="btn btn-primary btn-full">Ingresar</button>
 </form>
 <div class="login-footer"><small>Usuario inicial: <b>admin</b> / Contraseña: <b>admin123</b></small></div>
@@ -571,18 +1548,122 @@ function selectDate(f){
     if(p&&f)window.location.href="/?prof_id="+p+"&fecha="+f;
 }
 
+var holdTimer=null;
+var idemPendientes={};
+
+function idemKey(){
+    return Date.now().toString(36)+Math.random().toString(36).slice(2,12);
+}
+
+function retenerCupo(id){
+    return fetch("/cita/retener/"+id,{method:"POST"}).then(function(r){return r.json()});
+}
+
 function openModal(id,h){
-    document.getElementById("modal-cita-id").value=id;
-    document.getElementById("modal-hora").textContent=h;
-    document.getElementById("modal-agendar").style.display="flex";
+    retenerCupo(id).then(function(d){
+        if(!d.ok){alert(d.error||"Cupo no disponible");location.reload();return}
+        document.getElementById("modal-cita-id").value=id;
+        document.getElementById("modal-idem").value=idemKey();
+        document.getElementById("modal-hora").textContent=h;
+        document.getElementById("modal-agendar").style.display="flex";
+        clearInterval(holdTimer);
+        holdTimer=setInterval(function(){retenerCupo(id)},Math.max(d.segundos/3,10)*1000);
+    }).catch(function(e){console.error("Error:",e)});
 }
 
 function closeModal(){
+    var el=document.getElementById("modal-cita-id");
     document.getElementById("modal-agendar").style.display="none";
+    clearInterval(holdTimer);
+    if(el.value){fetch("/cita/liberar/"+el.value,{method:"POST"});el.value=""}
+}
+
+// Asistencia: cada marca lleva la versión de la fila que se vio (X-Cita-Version);
+// si la cita cambió en el servidor mientras tanto, responde 409 y no se aplica.
+var COLA_ASIST="citas_asistencia_cola";
+
+function enviarAsistencia(m){
+    return fetch("/cita/asistencia/"+m.id+"/"+encodeURIComponent(m.estado),
+            {method:"POST",headers:{"Idempotency-Key":m.clave,"X-Cita-Version":m.version}})
+        .then(function(r){
+            // Sin JSON: redirigió al login o respondió la página sin conexión; se reintenta después
+            if((r.headers.get("Content-Type")||"").indexOf("json")<0)return {estado:"red"};
+            return r.json().then(function(d){
+                if(r.ok)return {estado:"ok"};
+                if(d.conflicto)return {estado:"conflicto",actual:d.actual};
+                return {estado:r.status>=500||r.status===409?"red":"error",error:d.error};
+            });
+        },function(){return {estado:"red"}});
+}
+
+function colaAsistencia(){
+    try{return JSON.parse(localStorage.getItem(COLA_ASIST))||[]}catch(e){return []}
+}
+
+function guardarCola(c){localStorage.setItem(COLA_ASIST,JSON.stringify(c))}
+
+function marcarAsistencia(id,e,version,btn){
+    var m={id:id,estado:e,version:version||"",clave:idemKey(),uid:document.body.dataset.uid};
+    if(document.body.classList.contains("solo-lectura")){encolarAsistencia(m,btn);return}
+    var k=id+"|"+e;
+    if(!idemPendientes[k])idemPendientes[k]=m.clave;
+    m.clave=idemPendientes[k];
+    enviarAsistencia(m).then(function(res){
+        if(res.estado==="red"){encolarAsistencia(m,btn);return}
+        delete idemPendientes[k];
+        if(res.estado==="conflicto")alert("La cita cambió en el servidor"+(res.actual?" (asistencia: "+res.actual+")":"")+". Se recarga la agenda.");
+        else if(res.estado==="error")alert(res.error||"No se pudo marcar la asistencia");
+        location.reload();
+    });
+}
+
+function encolarAsistencia(m,btn){
+    // Una marca pendiente por cita: gana la última, con la versión vista antes de la primera
+    var cola=colaAsistencia();
+    cola.forEach(function(x){if(x.id===m.id)m.version=x.version});
+    cola=cola.filter(function(x){return x.id!==m.id});
+    cola.push(m);guardarCola(cola);
+    if(btn){
+        var bs=btn.parentNode.querySelectorAll(".btn-asist");
+        bs[0].className="btn-asist"+(m.estado==="Asistió"?" btn-asist-active":"");
+        bs[1].className="btn-asist"+(m.estado==="No asistió"?" btn-asist-no-active":"");
+    }
+    avisoOffline();
+}
+
+var reenviando=false;
+function reenviarCola(){
+    var uid=document.body.dataset.uid;
+    var cola=colaAsistencia().filter(function(m){return m.uid===uid});
+    if(reenviando||!cola.length)return;
+    reenviando=true;
+    var conflictos=[],listas=0;
+    function terminar(){
+        reenviando=false;avisoOffline();
+        if(conflictos.length)alert("Marcas de asistencia no aplicadas porque la cita cambió:\\n"+conflictos.join("\\n"));
+        if(listas||conflictos.length)location.reload();
+    }
+    (function siguiente(i){
+        if(i>=cola.length)return terminar();
+        enviarAsistencia(cola[i]).then(function(res){
+            if(res.estado==="red")return terminar();
+            guardarCola(colaAsistencia().filter(function(x){return x.clave!==cola[i].clave}));
+            if(res.estado==="ok")listas++;
+            else conflictos.push("Cita "+cola[i].id+": "+cola[i].estado+(res.actual?" (servidor: "+res.actual+")":""));
+            siguiente(i+1);
+        });
+    })(0);
 }
 
-function marcarAsistencia(id,e){
-    fetch("/cita/asistencia/"+id+"/"+encodeURIComponent(e),{method:"POST"}).then(function(){location.reload()});
+function avisoOffline(){
+    var main=document.querySelector("main.container");if(!main)return;
+    var el=document.getElementById("aviso-offline");
+    var n=colaAsistencia().filter(function(m){return m.uid===document.body.dataset.uid}).length;
+    var guardado=document.body.dataset.cache;
+    if(!guardado&&!n){if(el)el.remove();return}
+    if(!el){el=document.createElement("div");el.id="aviso-offline";el.className="aviso-offline";main.insertBefore(el,main.firstChild)}
+    var t=guardado?"📴 Sin conexión: agenda guardada"+(isNaN(new Date(guardado))?"":" el "+new Date(guardado).toLocaleString())+", solo lectura. ":"";
+    el.textContent=t+(n?"⏳ "+n+" marca(s) de asistencia por enviar.":"");
 }
 
 function toggleSihce(id,v){
@@ -607,143 +1688,249 @@ function toggleSihceProf(v){
 
 var modalEl=document.getElementById("modal-agendar");
 if(modalEl)modalEl.addEventListener("click",function(e){if(e.target===this)closeModal()});
+
+if("serviceWorker" in navigator)navigator.serviceWorker.register("/static/sw.js",{scope:"/"});
+if(document.body.dataset.cache)document.body.classList.add("solo-lectura");
+avisoOffline();
+reenviarCola();
+window.addEventListener("online",reenviarCola);
+setInterval(reenviarCola,30000);
 """
     resp = make_response(js)
     resp.headers['Content-Type'] = 'application/javascript; charset=utf-8'
     resp.headers['Cache-Control'] = 'no-cache'
     return resp
 
+@app.route('/static/sw.js')
+def serve_sw_js():
+    """Service worker: network first, last copy of the shell and recent agenda days offline"""
+    js = """
+var CACHE="citas-__VERSION__";
+var DIAS_MAX=30;
+
+self.addEventListener("install",function(e){
+    e.waitUntil(caches.open(CACHE).then(function(c){return c.addAll(["/static/app.js"])}).then(function(){return self.skipWaiting()}));
+});
+
+self.addEventListener("activate",function(e){
+    e.waitUntil(caches.keys().then(function(ks){
+        return Promise.all(ks.filter(function(k){return k!==CACHE}).map(function(k){return caches.delete(k)}));
+    }).then(function(){return self.clients.claim()}));
+});
+
+self.addEventListener("fetch",function(e){
+    var req=e.request,url=new URL(req.url);
+    if(req.method!=="GET"||url.origin!==location.origin)return;
+    // Los días guardados tienen datos de pacientes: al salir se borran
+    if(url.pathname==="/logout"){e.respondWith(caches.delete(CACHE).then(function(){return fetch(req)}));return}
+    if(url.pathname==="/static/app.js"||url.pathname.indexOf("/api/fechas/")===0){e.respondWith(redPrimero(req,false));return}
+    if(url.pathname==="/"&&req.mode==="navigate")e.respondWith(redPrimero(req,true));
+});
+
+function redPrimero(req,pagina){
+    return fetch(req).then(function(r){
+        if(r.ok&&!r.redirected){
+            var copia=r.clone();
+            caches.open(CACHE).then(function(c){return c.put(req,copia).then(function(){if(pagina)return recortar(c)})});
+        }
+        return r;
+    }).catch(function(){
+        return caches.match(req).then(function(r){
+            if(!r)return pagina?sinConexion():Response.error();
+            if(!pagina)return r;
+            // La página guardada se marca para que app.js la muestre en solo lectura
+            return r.text().then(function(t){
+                return new Response(t.replace("<body",'<body data-cache="'+(r.headers.get("Date")||"1")+'"'),
+                                    {headers:{"Content-Type":"text/html; charset=utf-8"}});
+            });
+        });
+    });
+}
+
+function recortar(c){
+    return c.keys().then(function(ks){
+        var dias=ks.filter(function(k){return new URL(k.url).pathname==="/"});
+        return Promise.all(dias.slice(0,Math.max(0,dias.length-DIAS_MAX)).map(function(k){return c.delete(k)}));
+    });
+}
+
+function sinConexion(){
+    return new Response('<!DOCTYPE html><html lang="es"><head><meta charset="UTF-8"><meta name="viewport" content="width=device-width,initial-scale=1.0">'+
+        '<title>Sin conexión</title></head><body style="font-family:sans-serif;padding:2rem;text-align:center">'+
+        '<h2>📴 Sin conexión</h2><p>Este día no se abrió antes en este equipo, así que no hay copia guardada.</p>'+
+        '<p><a href="javascript:history.back()">Volver</a></p></body></html>',
+        {status:503,headers:{"Content-Type":"text/html; charset=utf-8"}});
+}
+""".replace('__VERSION__', _ARRANQUE)
+    resp = make_response(js)
+    resp.headers['Content-Type'] = 'application/javascript; charset=utf-8'
+    resp.headers['Cache-Control'] = 'no-cache'
+    # Servido bajo /static/ pero controla toda la app
+    resp.headers['Service-Worker-Allowed'] = '/'
+    return resp
+
 @app.route('/api/sihce_profs')
 @login_required
+@cacheado(por_usuario=False)
 def api_sihce_profs():
     """Return medical professionals for SIHCE pairing"""
     conn = get_db()
-    profs = conn.execute("SELECT id, nombre, especialidad FROM profesionales WHERE activo=1 AND especialidad IN ('MEDICINA','PSIQUIATRÍA') ORDER BY orden").fetchall()
+    profs = repositorio(conn).profesionales(activos=True, especialidades=['MEDICINA', 'PSIQUIATRÍA'])
     conn.close()
     return jsonify([{'id': p['id'], 'nombre': p['nombre'], 'especialidad': p['especialidad']} for p in profs])
 
 @app.route('/api/fechas/<int:prof_id>')
 @login_required
+@cacheado(por_usuario=False)
 def api_fechas(prof_id):
     conn = get_db()
-    rows = conn.execute("SELECT DISTINCT fecha FROM citas WHERE profesional_id=? ORDER BY fecha", (prof_id,)).fetchall()
+    db = repositorio(conn)
+    rows = db.fechas_con_cupos(prof_id)
     # Get turno info per date from roles_mensuales
-    turno_map = {}
-    turno_rows = conn.execute("SELECT r.dia, r.turno, r.mes, r.anio FROM roles_mensuales r WHERE r.profesional_id=?", (prof_id,)).fetchall()
-    for tr in turno_rows:
-        key = f"{tr['anio']}-{tr['mes']:02d}-{tr['dia']:02d}"
-        turno_map[key] = tr['turno']
+    turno_map = db.turnos_rol(prof_id)
     # Fallback: deduce turno from citas if not in roles_mensuales
-    for r in rows:
-        if r['fecha'] not in turno_map:
-            turnos = conn.execute("SELECT DISTINCT turno FROM citas WHERE profesional_id=? AND fecha=? AND turno!='ADMINISTRATIVA'", (prof_id, r['fecha'])).fetchall()
-            t_list = [t['turno'] for t in turnos]
+    for fecha in rows:
+        if fecha not in turno_map:
+            t_list = db.turnos_del_dia(prof_id, fecha)
             if 'MAÑANA' in t_list and 'TARDE' in t_list:
-                turno_map[r['fecha']] = 'MT'
+                turno_map[fecha] = 'MT'
             elif 'MAÑANA' in t_list:
-                turno_map[r['fecha']] = 'M'
+                turno_map[fecha] = 'M'
             elif 'TARDE' in t_list:
-                turno_map[r['fecha']] = 'T'
+                turno_map[fecha] = 'T'
     fechas = []
-    for r in rows:
-        turno = turno_map.get(r['fecha'], 'M')
+    for fecha in rows:
+        turno = turno_map.get(fecha, 'M')
         try:
-            dt = datetime.strptime(r['fecha'], '%Y-%m-%d')
+            dt = datetime.strptime(fecha, '%Y-%m-%d')
             dia_sem = DIAS_CORTO[dt.weekday()]
-            fechas.append({'value': r['fecha'], 'label': f"{dt.day} {dia_sem} ({dt.strftime('%d/%m')})", 'turno': turno, 'day': dt.day, 'month': dt.month, 'year': dt.year, 'weekday': dt.weekday()})
+            fechas.append({'value': fecha, 'label': f"{dt.day} {dia_sem} ({dt.strftime('%d/%m')})", 'turno': turno, 'day': dt.day, 'month': dt.month, 'year': dt.year, 'weekday': dt.weekday()})
         except:
-            fechas.append({'value': r['fecha'], 'label': r['fecha'], 'turno': turno})
+            fechas.append({'value': fecha, 'label': fecha, 'turno': turno})
     conn.close()
     return jsonify(fechas)
 
 # ==============================================================================
 # AGENDA PRINCIPAL
 # ==============================================================================
+_AG_BANNER = plantilla('<div class="date-banner"><span class="prof-chip" style="background:{bg};color:{fg}">{prof}</span><strong>{fecha}</strong><span class="badge badge-info">{total} cupos</span><span class="badge badge-success">{libres} disponibles</span><span class="badge badge-danger">{ocupados} ocupados</span>'
+    '<a href="/imprimir/dia?fecha={fecha_iso}&amp;prof_id={prof_id}" target="_blank" class="btn btn-sm btn-secondary" style="margin-left:auto">🖨️ Comprobantes del día</a></div>'
+    '<div class="table-wrapper"><table class="citas-table"><thead><tr><th>Turno</th><th>Hora</th><th>Paciente</th><th>DNI</th><th>Tipo</th><th>SIHCE</th><th>Estado</th><th>Asistencia</th><th>Acciones</th></tr></thead><tbody>')
+_AG_DIVISOR = plantilla('<tr class="turno-divider"><td colspan="9"><span class="turno-label">{icono} {turno}</span></td></tr>')
+_AG_ADMIN = plantilla('<tr class="cita-row" style="background:#fff3e0;border-left:4px solid #ff9800"><td>ADM</td><td class="td-hora"><strong>{inicio} - {fin}</strong></td><td colspan="7"><em style="color:#e65100">📋 Hora Administrativa</em></td></tr>')
+_AG_FILA = plantilla('<tr class="cita-row {clase}" style="{estilo}"><td>{turno}</td><td class="td-hora"><strong>{inicio} - {fin}</strong></td><td>{paciente_html}</td><td>{dni}</td><td>{tipo_html}</td><td>{sihce_html}</td><td>{estado_html}</td><td>{asistencia_html}</td><td>{acciones_html}</td></tr>')
+_AG_PACIENTE = plantilla('<span class="paciente-nombre">{paciente}</span>')
+_AG_EDAD = plantilla(' <small>({edad} años)</small>')
+_AG_CELULAR = plantilla('<br><small class="text-muted">📱 {celular}</small>')
+_AG_APP = plantilla('<br><small style="color:#e65100;font-weight:600">🏷️ APP: {app}</small>')
+_AG_OBS = plantilla('<br><small class="text-muted">📝 {obs}</small>')
+_AG_DISPONIBLE = '<span class="text-available">Disponible</span>'
+_AG_EN_USO = plantilla('<span class="badge badge-warning">⏳ En uso — {nombre}</span>')
+_AG_BTN_EN_USO = '<button class="btn btn-sm btn-secondary" disabled>⏳ En uso</button>'
+_AG_SIHCE = '<span class="sihce-tag">SIHCE</span>'
+_AG_SIHCE_PAR = plantilla('<br><small style="color:#e65100">🔗 {nombre}</small>')
+_AG_SIHCE_BTN = plantilla(' <button class="btn-asist" onclick="toggleSihce({id},{val})" title="SIHCE">🔗</button>')
+_AG_ASIST = plantilla('<div class="asistencia-btns"><button class="btn-asist {si}" onclick="marcarAsistencia({id},\'Asistió\',\'{version}\',this)" title="Asistió">✅</button><button class="btn-asist {no}" onclick="marcarAsistencia({id},\'No asistió\',\'{version}\',this)" title="No asistió">❌</button></div>')
+_AG_AGENDAR = plantilla('<button class="btn btn-sm btn-success" onclick="openModal({id},\'{hora}\')">➕ Agendar</button>')
+_AG_OCUPADO = plantilla('<a href="/cita/imprimir/{id}" target="_blank" class="btn btn-sm btn-secondary" title="Imprimir">🖨️</a> <form method="POST" action="/cita/eliminar/{id}" style="display:inline" onsubmit="return confirm({confirmar})">{idem_html}<button type="submit" class="btn btn-sm btn-danger">🗑️</button></form>')
+_ESTADO_HTML = {
+    'Confirmado': '<span class="status-dot status-confirmado"></span>Confirmado',
+    'Disponible': '<span class="status-dot status-disponible"></span>Disponible',
+}
+_TURNO_ICONO = {'MAÑANA': '☀️', 'TARDE': '🌙'}
+
+def _nombres_sihce(conn, citas):
+    """One lookup for every SIHCE partner referenced by the rows"""
+    return repositorio(conn).nombres_profesionales(sorted({c['sihce_prof_id'] for c in citas if c['sihce'] and c['sihce_prof_id']}))
+
+def _fecha_larga(fecha):
+    try:
+        dt = datetime.strptime(fecha, '%Y-%m-%d')
+        return f"{DIAS_ES[dt.weekday()]} {dt.day} de {MESES_ES[dt.month]} {dt.year}"
+    except (ValueError, TypeError):
+        return fecha
+
+def _fecha_param(nombre, defecto=None):
+    valor = request.args.get(nombre, '')
+    try:
+        return datetime.strptime(valor, '%Y-%m-%d').date()
+    except ValueError:
+        return defecto
+
+def _agenda_tabla(citas, fecha, retenidas, nombres_sihce):
+    uid = session['user_id']
+    total = sum(1 for c in citas if c['turno'] != 'ADMINISTRATIVA')
+    ocupados = sum(1 for c in citas if c['estado'] == 'Confirmado')
+    pi = citas[0]
+    out = [_AG_BANNER(bg=pi['color_bg'], fg=pi['color_font'], prof=pi['prof_nombre'], fecha=_fecha_larga(fecha),
+                      fecha_iso=fecha, prof_id=pi['profesional_id'],
+                      total=total, libres=total - ocupados, ocupados=ocupados)]
+    ct = ''
+    for c in citas:
+        if c['turno'] != ct:
+            ct = c['turno']
+            out.append(_AG_DIVISOR(icono=_TURNO_ICONO.get(ct, '📋'), turno=ct))
+        if ct == 'ADMINISTRATIVA':
+            out.append(_AG_ADMIN(inicio=c['hora_inicio'], fin=c['hora_fin']))
+            continue
+        confirmado = c['estado'] == 'Confirmado'
+        sh = asist = ''
+        if confirmado:
+            pc = _AG_PACIENTE(paciente=c['paciente'])
+            if c['edad']: pc += _AG_EDAD(edad=c['edad'])
+            if c['celular']: pc += _AG_CELULAR(celular=c['celular'])
+            if c['actividad_app']: pc += _AG_APP(app=c['actividad_app'])
+            if c['observaciones']: pc += _AG_OBS(obs=c['observaciones'])
+            sv = 1 if c['sihce'] else 0
+            if sv:
+                sh = _AG_SIHCE
+                if c['sihce_prof_id'] in nombres_sihce: sh += _AG_SIHCE_PAR(nombre=nombres_sihce[c['sihce_prof_id']])
+            sh += _AG_SIHCE_BTN(id=c['id'], val=1 - sv)
+            asist = _AG_ASIST(id=c['id'], si='btn-asist-active' if c['asistencia'] == 'Asistió' else '',
+                              no='btn-asist-no-active' if c['asistencia'] == 'No asistió' else '', version=c['modificado_en'] or '')
+            act = _AG_OCUPADO(id=c['id'], confirmar=json.dumps(f"¿Eliminar cita de {c['paciente']}?"), idem_html=idem_input())
+        else:
+            retenida = retenidas.get(c['id'])
+            if c['estado'] == 'Disponible' and retenida and retenida['usuario_id'] != uid:
+                pc = _AG_EN_USO(nombre=retenida['usuario_nombre']); act = _AG_BTN_EN_USO
+            elif c['estado'] == 'Disponible':
+                pc = _AG_DISPONIBLE; act = _AG_AGENDAR(id=c['id'], hora=f"{c['hora_inicio']} - {c['hora_fin']}")
+            else:
+                pc = _AG_DISPONIBLE; act = ''
+        out.append(_AG_FILA(clase='row-ocupado' if confirmado else 'row-disponible',
+                            estilo=f"border-left:4px solid {c['color_bg']};" if confirmado else '',
+                            turno=ct[:3], inicio=c['hora_inicio'], fin=c['hora_fin'], paciente_html=pc,
+                            dni=c['dni'] if confirmado else '', tipo_html=badge_tipo(c['tipo_paciente']), sihce_html=sh,
+                            estado_html=_ESTADO_HTML.get(c['estado']) or esc(c['estado']), asistencia_html=asist, acciones_html=act))
+    out.append('</tbody></table></div>')
+    return out
+
 @app.route('/')
 @login_required
 def agenda():
     conn = get_db()
     prof_id = request.args.get('prof_id', '')
     fecha = request.args.get('fecha', '')
-    profesionales = conn.execute("SELECT * FROM profesionales WHERE activo=1 ORDER BY orden").fetchall()
+    profesionales = repositorio(conn).profesionales(activos=True)
     prof_options = '<option value="">— Seleccionar profesional —</option>'
-    for p in profesionales:
-        sel = 'selected' if str(p['id']) == str(prof_id) else ''
-        prof_options += f'<option value="{p["id"]}" {sel}>{p["nombre"]} ({p["especialidad"]})</option>'
+    prof_options += ''.join(_OPCION_PROF(id=p['id'], sel_html='selected' if str(p['id']) == str(prof_id) else '', nombre=p['nombre'], esp=p['especialidad'])
+                            for p in profesionales)
     citas_html = ''
     if prof_id and fecha:
-        citas = conn.execute("""SELECT c.*, p.nombre as prof_nombre, p.color_bg, p.color_font
-            FROM citas c JOIN profesionales p ON p.id=c.profesional_id
-            WHERE c.profesional_id=? AND c.fecha=? ORDER BY
-            CASE c.turno WHEN 'MAÑANA' THEN 1 WHEN 'TARDE' THEN 2 WHEN 'ADMINISTRATIVA' THEN 3 END,
-            c.hora_inicio""", (prof_id, fecha)).fetchall()
+        citas = repositorio(conn).citas_del_dia(prof_id, fecha)
         if citas:
-            try:
-                dt = datetime.strptime(fecha, '%Y-%m-%d')
-                fecha_info = f"{DIAS_ES[dt.weekday()]} {dt.day} de {MESES_ES[dt.month]} {dt.year}"
-            except: fecha_info = fecha
-            total = len([c for c in citas if c['turno'] != 'ADMINISTRATIVA'])
-            ocupados = sum(1 for c in citas if c['estado'] == 'Confirmado')
-            pi = citas[0]
-            citas_html += f'<div class="date-banner"><span class="prof-chip" style="background:{pi["color_bg"]};color:{pi["color_font"]}">{pi["prof_nombre"]}</span><strong>{fecha_info}</strong><span class="badge badge-info">{total} cupos</span><span class="badge badge-success">{total-ocupados} disponibles</span><span class="badge badge-danger">{ocupados} ocupados</span></div>'
-            citas_html += '<div class="table-wrapper"><table class="citas-table"><thead><tr><th>Turno</th><th>Hora</th><th>Paciente</th><th>DNI</th><th>Tipo</th><th>SIHCE</th><th>Estado</th><th>Asistencia</th><th>Acciones</th></tr></thead><tbody>'
-            ct = ''
-            for c in citas:
-                if c['turno'] != ct:
-                    ct = c['turno']
-                    icon = '☀️' if ct == 'MAÑANA' else ('🌙' if ct == 'TARDE' else '📋')
-                    citas_html += f'<tr class="turno-divider"><td colspan="9"><span class="turno-label">{icon} {ct}</span></td></tr>'
-                if c['turno'] == 'ADMINISTRATIVA':
-                    citas_html += f'<tr class="cita-row" style="background:#fff3e0;border-left:4px solid #ff9800"><td>ADM</td><td class="td-hora"><strong>{c["hora_inicio"]} - {c["hora_fin"]}</strong></td><td colspan="7"><em style="color:#e65100">📋 Hora Administrativa</em></td></tr>'
-                    continue
-                rc = 'row-ocupado' if c['estado'] == 'Confirmado' else 'row-disponible'
-                st = f'border-left:4px solid {c["color_bg"]};' if c['estado'] == 'Confirmado' else ''
-                if c['estado'] == 'Confirmado':
-                    pc = f'<span class="paciente-nombre">{c["paciente"]}</span>'
-                    if c['edad']: pc += f' <small>({c["edad"]} años)</small>'
-                    if c['celular']: pc += f'<br><small class="text-muted">📱 {c["celular"]}</small>'
-                    if c['actividad_app']: pc += f'<br><small style="color:#e65100;font-weight:600">🏷️ APP: {c["actividad_app"]}</small>'
-                    if c['observaciones']: pc += f'<br><small class="text-muted">📝 {c["observaciones"]}</small>'
-                else: pc = '<span class="text-available">Disponible</span>'
-                th = ''
-                if c['tipo_paciente']:
-                    bc = 'badge-new' if c['tipo_paciente'] == 'NUEVO' else 'badge-cont'
-                    th = f'<span class="badge {bc}">{c["tipo_paciente"]}</span>'
-                sh = ''
-                if c['estado'] == 'Confirmado':
-                    sv = c['sihce'] if c['sihce'] else 0
-                    if sv:
-                        sh = '<span class="sihce-tag">SIHCE</span>'
-                        sp_id = c.get('sihce_prof_id', 0) or 0
-                        if sp_id:
-                            sp = conn.execute("SELECT nombre FROM profesionales WHERE id=?", (sp_id,)).fetchone()
-                            if sp: sh += f'<br><small style="color:#e65100">🔗 {sp["nombre"]}</small>'
-                    sh += f' <button class="btn-asist" onclick="toggleSihce({c["id"]},{1 if not sv else 0})" title="SIHCE">🔗</button>'
-                sc = 'status-confirmado' if c['estado'] == 'Confirmado' else 'status-disponible'
-                sthtml = f'<span class="status-dot {sc}"></span>{c["estado"]}'
-                ah = ''
-                if c['estado'] == 'Confirmado':
-                    aa = 'btn-asist-active' if c['asistencia'] == 'Asistió' else ''
-                    na = 'btn-asist-no-active' if c['asistencia'] == 'No asistió' else ''
-                    ah = f'<div class="asistencia-btns"><button class="btn-asist {aa}" onclick="marcarAsistencia({c["id"]},\'Asistió\')" title="Asistió">✅</button><button class="btn-asist {na}" onclick="marcarAsistencia({c["id"]},\'No asistió\')" title="No asistió">❌</button></div>'
-                if c['estado'] == 'Disponible':
-                    he = c["hora_inicio"] + " - " + c["hora_fin"]
-                    act = f'<button class="btn btn-sm btn-success" onclick="openModal({c["id"]},\'{he}\')">➕ Agendar</button>'
-                else:
-                    pe = c["paciente"].replace("'","\\'")
-                    act = f'<a href="/cita/imprimir/{c["id"]}" target="_blank" class="btn btn-sm btn-secondary" title="Imprimir">🖨️</a> <form method="POST" action="/cita/eliminar/{c["id"]}" style="display:inline" onsubmit="return confirm(\'¿Eliminar cita de {pe}?\')"><button type="submit" class="btn btn-sm btn-danger">🗑️</button></form>'
-                citas_html += f'<tr class="cita-row {rc}" style="{st}"><td>{c["turno"][:3]}</td><td class="td-hora"><strong>{c["hora_inicio"]} - {c["hora_fin"]}</strong></td><td>{pc}</td><td>{c["dni"] if c["estado"]=="Confirmado" else ""}</td><td>{th}</td><td>{sh}</td><td>{sthtml}</td><td>{ah}</td><td>{act}</td></tr>'
-            citas_html += '</tbody></table></div>'
+            retenidas = _retenciones_activas(conn, [c['id'] for c in citas])
+            citas_html = ''.join(_agenda_tabla(citas, fecha, retenidas, _nombres_sihce(conn, citas)))
         else: citas_html = '<div class="empty-state"><p>No hay cupos para esta combinación.</p></div>'
     elif not prof_id:
         citas_html = '<div class="empty-state"><div class="empty-icon">📋</div><h3>Seleccione un profesional para ver su agenda</h3><p>Use los filtros de arriba para comenzar</p></div>'
     is_lector = session.get('user_rol') == 'lector'
     conn.close()
     CALENDAR_JS = '<script src="/static/app.js"></script>'
-    init_js = f'<script>onProfChange("{prof_id}");</script>' if prof_id else ''
+    init_js = f'<script>onProfChange("{prof_id}");</script>' if prof_id.isdigit() else ''
     modal_html = '''<div id="modal-agendar" class="modal" style="display:none"><div class="modal-content">
         <div class="modal-header"><h3>➕ Agendar Cita</h3><button class="modal-close" onclick="closeModal()">×</button></div>
-        <form method="POST" action="/cita/agendar"><input type="hidden" name="cita_id" id="modal-cita-id">
+        <form method="POST" action="/cita/agendar"><input type="hidden" name="cita_id" id="modal-cita-id"><input type="hidden" name="_idem" id="modal-idem">
         <div class="modal-body"><p id="modal-hora" class="modal-hora-display"></p>
         <div class="form-group"><label>Paciente *</label><input type="text" name="paciente" required class="form-input" placeholder="Nombre completo"></div>
         <div class="form-row"><div class="form-group"><label>DNI</label><input type="text" name="dni" class="form-input" maxlength="8" placeholder="12345678"></div>
@@ -766,7 +1953,7 @@ def agenda():
     content = f'''<div class="page-header"><h2>📅 Agenda de Citas</h2></div>
     <div class="card" style="padding:1rem"><div class="filter-row">
         <div class="filter-group"><label>Profesional</label><select id="sel-prof" class="form-select" onchange="onProfChange(this.value)">{prof_options}</select></div>
-        <div class="filter-group"><label>Fecha</label><div id="cal-container"></div><input type="hidden" id="sel-fecha" value="{fecha}"></div>
+        <div class="filter-group"><label>Fecha</label><div id="cal-container"></div><input type="hidden" id="sel-fecha" value="{esc(fecha)}"></div>
     </div></div>{citas_html}{modal_html}''' + CALENDAR_JS + init_js
     flash_msgs = session.pop('_flashes', [])
     return page('Agenda - Sistema de Citas', content, flash_msgs)
@@ -780,6 +1967,7 @@ def agenda():
 # ==============================================================================
 @app.route('/cita/agendar', methods=['POST'])
 @login_required
+@idempotente
 def agendar_cita():
     if session.get('user_rol')=='lector':
         flash('No tiene permisos (solo lectura)','danger')
@@ -798,32 +1986,45 @@ def agendar_cita():
         flash('El nombre del paciente es obligatorio', 'danger')
         return redirect(request.referrer or '/')
     conn = get_db()
-    cita = conn.execute("SELECT * FROM citas WHERE id=?", (cita_id,)).fetchone()
+    db = repositorio(conn)
+    cita = db.cita(cita_id)
     if not cita or cita['estado'] != 'Disponible':
         flash('Cupo no disponible', 'warning')
         conn.close()
         return redirect(request.referrer or '/')
-    conn.execute("UPDATE citas SET paciente=?, dni=?, edad=?, celular=?, observaciones=?, estado='Confirmado', tipo_paciente=?, sihce=?, sihce_prof_id=?, actividad_app=?, creado_por=?, modificado_por=?, modificado_en=CURRENT_TIMESTAMP WHERE id=?",
-        (paciente, dni, edad, celular, obs, tipo, sihce, sihce_prof_id, actividad_app, session['user_id'], session['user_id'], cita_id))
-    conn.execute("INSERT INTO historial (cita_id, usuario_id, accion, detalle) VALUES (?,?,?,?)",
-        (cita_id, session['user_id'], 'AGENDAR', f'Paciente: {paciente} | DNI: {dni}'))
+    _barrer_retenciones(conn)
+    retenida = _retenciones_activas(conn, [cita['id']]).get(cita['id'])
+    if retenida and retenida['usuario_id'] != session['user_id']:
+        flash(f'Cupo en uso por {retenida["usuario_nombre"]}', 'warning')
+        conn.close()
+        return redirect(request.referrer or '/')
+    datos = {'paciente': paciente, 'dni': dni, 'edad': edad, 'celular': celular, 'observaciones': obs, 'tipo_paciente': tipo,
+             'sihce': sihce, 'sihce_prof_id': sihce_prof_id, 'actividad_app': actividad_app}
+    if not db.agendar(cita_id, datos, session['user_id']):
+        flash('Cupo no disponible', 'warning')
+        conn.close()
+        return redirect(request.referrer or '/')
+    conn.execute("DELETE FROM retenciones WHERE cita_id=?", (cita_id,))
+    marcar_cambio(conn)
     conn.commit(); conn.close()
+    auditar([(cita_id, session['user_id'], 'AGENDAR', f'Paciente: {paciente} | DNI: {dni}')])
     flash(f'Cita agendada: {paciente}', 'success')
     return redirect(request.referrer or '/')
 
 @app.route('/cita/eliminar/<int:cita_id>', methods=['POST'])
 @login_required
+@idempotente
 def eliminar_cita(cita_id):
     if session.get('user_rol')=='lector':
         flash('No tiene permisos (solo lectura)','danger')
         return redirect(request.referrer or '/')
     conn = get_db()
-    cita = conn.execute("SELECT * FROM citas WHERE id=?", (cita_id,)).fetchone()
+    db = repositorio(conn)
+    cita = db.cita(cita_id)
     if cita and cita['estado'] != 'Disponible':
-        conn.execute("UPDATE citas SET paciente='',dni='',edad='',celular='',observaciones='',estado='Disponible',tipo_paciente='',actividad_app='',asistencia='Pendiente',sihce=0,sihce_prof_id=0,modificado_por=?,modificado_en=CURRENT_TIMESTAMP WHERE id=?",
-            (session['user_id'], cita_id))
-        conn.execute("INSERT INTO historial (cita_id,usuario_id,accion,detalle) VALUES (?,?,?,?)",
-            (cita_id, session['user_id'], 'ELIMINAR', f'Eliminado: {cita["paciente"]}'))
+        db.vaciar_cita(cita_id, session['user_id'])
+        registrar_historial(conn, [(cita_id, session['user_id'], 'ELIMINAR', f'Eliminado: {cita["paciente"]}')])
+        marcar_cambio(conn)
         conn.commit()
         flash('Cita eliminada', 'info')
     conn.close()
@@ -831,14 +2032,23 @@ def eliminar_cita(cita_id):
 
 @app.route('/cita/asistencia/<int:cita_id>/<estado>', methods=['POST'])
 @login_required
+@idempotente
 def marcar_asistencia(cita_id, estado):
     if session.get('user_rol')=='lector': return jsonify({'error':'Sin permisos'}),403
     if estado not in ('Asistió', 'No asistió', 'Pendiente'): abort(400)
+    # Versión de la fila que vio la terminal (marcas hechas sin conexión): si cambió, es un conflicto
+    version = request.headers.get('X-Cita-Version')
     conn = get_db()
-    conn.execute("UPDATE citas SET asistencia=?, modificado_por=?, modificado_en=CURRENT_TIMESTAMP WHERE id=?", (estado, session['user_id'], cita_id))
-    conn.execute("INSERT INTO historial (cita_id,usuario_id,accion,detalle) VALUES (?,?,?,?)",
-        (cita_id, session['user_id'], 'ASISTENCIA', f'Marcado como: {estado}'))
+    db = repositorio(conn)
+    if not db.marcar_asistencia(cita_id, estado, session['user_id'], version):
+        actual = db.cita(cita_id)
+        conn.close()
+        vigente = actual['asistencia'] if actual and actual['estado'] == 'Confirmado' else None
+        if vigente == estado: return jsonify({'ok': True})
+        return jsonify({'error': 'La cita cambió en el servidor', 'conflicto': True, 'actual': vigente}), 409
+    marcar_cambio(conn)
     conn.commit(); conn.close()
+    auditar([(cita_id, session['user_id'], 'ASISTENCIA', f'Marcado como: {estado}')])
     return jsonify({'ok': True})
 
 @app.route('/cita/sihce/<int:cita_id>/<int:val>', methods=['POST'])
@@ -846,7 +2056,53 @@ def marcar_asistencia(cita_id, estado):
 def toggle_sihce(cita_id, val):
     if session.get('user_rol')=='lector': return jsonify({'error':'Sin permisos'}),403
     conn = get_db()
-    conn.execute("UPDATE citas SET sihce=?, modificado_por=?, modificado_en=CURRENT_TIMESTAMP WHERE id=?", (val, session['user_id'], cita_id))
+    repositorio(conn).marcar_sihce(cita_id, val, session['user_id'])
+    marcar_cambio(conn)
+    conn.commit(); conn.close()
+    return jsonify({'ok': True})
+
+# ==============================================================================
+# RETENCIÓN TEMPORAL DE CUPOS (mientras se llena el formulario de agendar)
+# ==============================================================================
+def _barrer_retenciones(conn):
+    conn.execute("DELETE FROM retenciones WHERE expira_en <= datetime('now')")
+
+def _retenciones_activas(conn, cita_ids):
+    """Return {cita_id: row} for the non-expired holds among cita_ids"""
+    if not cita_ids: return {}
+    marks = ','.join('?' * len(cita_ids))
+    rows = conn.execute(f"SELECT * FROM retenciones WHERE cita_id IN ({marks}) AND expira_en > datetime('now')", list(cita_ids)).fetchall()
+    return {r['cita_id']: r for r in rows}
+
+@app.route('/cita/retener/<int:cita_id>', methods=['POST'])
+@login_required
+def retener_cita(cita_id):
+    if session.get('user_rol')=='lector': return jsonify({'ok': False, 'error': 'Sin permisos'}), 403
+    conn = get_db()
+    cita = repositorio(conn).cita(cita_id)
+    if not cita or cita['estado'] != 'Disponible':
+        conn.close()
+        return jsonify({'ok': False, 'error': 'Cupo no disponible'}), 409
+    _barrer_retenciones(conn)
+    # Toma o renueva la retención solo si está libre, vencida o ya es del mismo usuario
+    conn.execute("""INSERT INTO retenciones (cita_id, usuario_id, usuario_nombre, expira_en)
+        VALUES (?,?,?,datetime('now', ?))
+        ON CONFLICT(cita_id) DO UPDATE SET usuario_id=excluded.usuario_id,
+            usuario_nombre=excluded.usuario_nombre, expira_en=excluded.expira_en
+        WHERE retenciones.usuario_id=excluded.usuario_id OR retenciones.expira_en <= datetime('now')""",
+        (cita_id, session['user_id'], session.get('user_nombre', ''), f'+{RETENCION_SEGUNDOS} seconds'))
+    conn.commit()
+    ret = conn.execute("SELECT * FROM retenciones WHERE cita_id=?", (cita_id,)).fetchone()
+    conn.close()
+    if ret['usuario_id'] != session['user_id']:
+        return jsonify({'ok': False, 'error': f'Cupo en uso por {ret["usuario_nombre"]}'}), 409
+    return jsonify({'ok': True, 'expira_en': ret['expira_en'], 'segundos': RETENCION_SEGUNDOS})
+
+@app.route('/cita/liberar/<int:cita_id>', methods=['POST'])
+@login_required
+def liberar_cita(cita_id):
+    conn = get_db()
+    conn.execute("DELETE FROM retenciones WHERE cita_id=? AND usuario_id=?", (cita_id, session['user_id']))
     conn.commit(); conn.close()
     return jsonify({'ok': True})
 
@@ -855,9 +2111,10 @@ def toggle_sihce(cita_id, val):
 # ==============================================================================
 @app.route('/cambiar_turno', methods=['GET', 'POST'])
 @admin_required
+@idempotente
 def cambiar_turno():
     conn = get_db()
-    profesionales = conn.execute("SELECT id, nombre, especialidad FROM profesionales WHERE activo=1 ORDER BY orden").fetchall()
+    profesionales = repositorio(conn).profesionales(activos=True)
 
     resultado = ''
     if request.method == 'POST':
@@ -871,7 +2128,7 @@ def cambiar_turno():
         if accion == 'eliminar':
             if prof_id and fecha:
                 confirmar = request.form.get('confirmar', '')
-                prof = conn.execute("SELECT * FROM profesionales WHERE id=?", (prof_id,)).fetchone()
+                prof = repositorio(conn).profesional(prof_id)
                 citas_dia = conn.execute("SELECT * FROM citas WHERE profesional_id=? AND fecha=?", (prof_id, fecha)).fetchall()
                 pac_conf = [c for c in citas_dia if c['estado'] == 'Confirmado']
 
@@ -898,6 +2155,7 @@ def cambiar_turno():
                             <input type="hidden" name="prof_id" value="{prof_id}">
                             <input type="hidden" name="fecha" value="{fecha}">
                             <input type="hidden" name="confirmar" value="1">
+                            {idem_input()}
                             <button type="submit" class="btn btn-danger btn-lg" onclick="return confirm('¿ELIMINAR todos los cupos de {prof['nombre']} el {fecha}?')">🗑️ Confirmar Eliminación</button>
                             <a href="/cambiar_turno" class="btn btn-secondary btn-lg">❌ Cancelar</a>
                         </form></div>'''
@@ -908,190 +2166,221 @@ def cambiar_turno():
                         conn.execute("DELETE FROM roles_mensuales WHERE profesional_id=? AND anio=? AND mes=? AND dia=?",
                             (prof_id, dt.year, dt.month, dt.day))
                     except: pass
+                    marcar_cambio(conn)
                     conn.commit()
                     flash(f'Cupos eliminados: {prof["nombre"]} el {fecha} ({len(citas_dia)} cupos, {len(pac_conf)} pacientes)', 'success')
                     conn.close()
                     return redirect('/cambiar_turno')
 
             conn.close()
-            prof_options = ''.join(f'<option value="{p["id"]}">{p["nombre"]} ({p["especialidad"]})</option>' for p in profesionales)
+            prof_options = ''.join(_OPCION_PROF(id=p['id'], sel_html='', nombre=p['nombre'], esp=p['especialidad']) for p in profesionales)
             flash_msgs = session.pop('_flashes', [])
             return page('Cambiar Turno', _cambiar_turno_form(prof_options, resultado), flash_msgs)
 
-        # ACCION: CAMBIAR turno
-        if not prof_id or not fecha or not nuevo_turno:
+        # ACCION: CAMBIAR turno (uno o varios movimientos; la vista previa es un simulacro)
+        movimientos = []
+        for fila in zip(request.form.getlist('prof_id'), request.form.getlist('fecha'),
+                        request.form.getlist('fecha_destino'), request.form.getlist('nuevo_turno')):
+            pid, f_origen, f_destino, turno = (v.strip() for v in fila)
+            if not (pid or f_origen or f_destino or turno): continue
+            if not (pid.isdigit() and f_origen and turno):
+                movimientos = None; break
+            movimientos.append((int(pid), f_origen, f_destino or f_origen, turno))
+        if not movimientos:
             flash('Complete todos los campos', 'danger')
             conn.close()
             return redirect('/cambiar_turno')
 
-        prof = conn.execute("SELECT * FROM profesionales WHERE id=?", (prof_id,)).fetchone()
-        if not prof:
-            flash('Profesional no encontrado', 'danger')
-            conn.close()
-            return redirect('/cambiar_turno')
-
-        # Get existing appointments from SOURCE date
-        citas_existentes = conn.execute(
-            "SELECT * FROM citas WHERE profesional_id=? AND fecha=? ORDER BY hora_inicio",
-            (prof_id, fecha)).fetchall()
-        pacientes = [dict(c) for c in citas_existentes if c['estado'] == 'Confirmado']
-        total_prev = len(citas_existentes)
-
-        # Check if DESTINATION date already has slots
-        if fecha_destino != fecha:
-            citas_destino = conn.execute("SELECT * FROM citas WHERE profesional_id=? AND fecha=?", (prof_id, fecha_destino)).fetchall()
-            pac_destino = [c for c in citas_destino if c['estado'] == 'Confirmado']
-            if pac_destino:
-                flash(f'La fecha destino {fecha_destino} ya tiene {len(pac_destino)} pacientes agendados. Elimine esos cupos primero o elija otra fecha.', 'danger')
+        confirmar = request.form.get('confirmar', '')
+        if confirmar:
+            conn.execute("BEGIN IMMEDIATE")
+        planes, errores = _planificar_cambios(conn, movimientos)
+        if confirmar:
+            if errores:
+                conn.rollback()
+                for e in errores: flash(e, 'danger')
                 conn.close()
                 return redirect('/cambiar_turno')
-
-        # Generate new slots
-        is_med = prof['especialidad'] in ('MEDICINA', 'PSIQUIATRÍA', 'SIHCE')
-        is_to = prof['especialidad'] == 'TERAPIA OCUPACIONAL'
-        new_slots = []
-        if is_to:
-            if nuevo_turno == 'M':
-                new_slots = _make_slots("07:30", 7, 45, 'MAÑANA')
-                new_slots.append({'inicio': '13:50', 'fin': '14:35', 'turno': 'TARDE'})
-            elif nuevo_turno == 'T':
-                new_slots = _make_slots("13:30", 6, 45, 'TARDE')
-            elif nuevo_turno in ('MT', 'GD'):
-                new_slots = _make_slots("07:30", 7, 45, 'MAÑANA')
-                new_slots.extend(_make_slots("13:45", 6, 45, 'TARDE'))
-        elif is_med:
-            if nuevo_turno == 'M':
-                new_slots = _make_slots("07:30", 7, 40, 'MAÑANA')
-                new_slots.append({'inicio': '12:10', 'fin': '13:00', 'turno': 'ADMINISTRATIVA'})
-            elif nuevo_turno == 'T':
-                new_slots = _make_slots("13:30", 6, 40, 'TARDE')
-            elif nuevo_turno in ('MT', 'GD'):
-                new_slots = _make_slots("07:30", 8, 40, 'MAÑANA')
-                new_slots.extend(_make_slots("14:00", 7, 40, 'TARDE'))
-        else:
-            if nuevo_turno == 'M':
-                new_slots = _make_slots("07:30", 6, 45, 'MAÑANA')
-                new_slots.append({'inicio': '12:00', 'fin': '13:00', 'turno': 'ADMINISTRATIVA'})
-            elif nuevo_turno == 'T':
-                new_slots = _make_slots("13:30", 6, 45, 'TARDE')
-            elif nuevo_turno in ('MT', 'GD'):
-                new_slots = _make_slots("07:30", 7, 45, 'MAÑANA')
-                new_slots.extend(_make_slots("13:45", 6, 45, 'TARDE'))
-
-        patient_slots = [s for s in new_slots if s['turno'] != 'ADMINISTRATIVA']
-        slots_disponibles = len(patient_slots)
-        pacientes_sin_cupo = []
-        if len(pacientes) > slots_disponibles:
-            pacientes_sin_cupo = pacientes[slots_disponibles:]
-            pacientes = pacientes[:slots_disponibles]
-
-        confirmar = request.form.get('confirmar', '')
-        if not confirmar:
-            try:
-                dt = datetime.strptime(fecha, '%Y-%m-%d')
-                fecha_display = f"{DIAS_ES[dt.weekday()]} {dt.day} de {MESES_ES[dt.month]} {dt.year}"
-                dt2 = datetime.strptime(fecha_destino, '%Y-%m-%d')
-                fecha_dest_display = f"{DIAS_ES[dt2.weekday()]} {dt2.day} de {MESES_ES[dt2.month]} {dt2.year}"
-            except:
-                fecha_display = fecha; fecha_dest_display = fecha_destino
-
-            turnos_prev = set(c['turno'] for c in citas_existentes if c['turno'] != 'ADMINISTRATIVA')
-            turno_prev = ', '.join(turnos_prev) if turnos_prev else 'Sin turno'
-
-            cambio_dia = fecha != fecha_destino
-            pac_rows = ''
-            for i, p in enumerate(pacientes):
-                dest = patient_slots[i]
-                pac_rows += f'<tr><td>{p["paciente"]}</td><td>{p["hora_inicio"]}-{p["hora_fin"]}</td><td style="color:green;font-weight:700">{dest["inicio"]}-{dest["fin"]} ({dest["turno"]})</td></tr>'
-
-            warning = ''
-            if pacientes_sin_cupo:
-                warning = f'<div class="flash flash-danger" style="margin:1rem 0">⚠️ <strong>{len(pacientes_sin_cupo)} paciente(s) NO CABEN</strong> en el nuevo turno:<br>'
-                for p in pacientes_sin_cupo:
-                    warning += f'• {p["paciente"]} ({p["hora_inicio"]}-{p["hora_fin"]})<br>'
-                warning += 'Estos pacientes se perderán si continúa.</div>'
-
-            dia_info = f'<p style="color:#1565c0;font-weight:700">📅 Los pacientes se MOVERÁN al {fecha_dest_display}</p>' if cambio_dia else ''
-
-            resultado = f'''<div class="card" style="border:2px solid #ff8f00">
-                <h3>📋 Vista previa del cambio</h3>
-                <p><strong>Profesional:</strong> {prof["nombre"]}</p>
-                <p><strong>Fecha origen:</strong> {fecha_display} — Turno: {turno_prev} ({total_prev} cupos)</p>
-                <p><strong>{"Fecha destino" if cambio_dia else "Misma fecha"}:</strong> {fecha_dest_display if cambio_dia else fecha_display} — Nuevo turno: {nuevo_turno} ({len(new_slots)} cupos, {slots_disponibles} para pacientes)</p>
-                <p><strong>Pacientes agendados:</strong> {len(pacientes) + len(pacientes_sin_cupo)}</p>
-                {dia_info}{warning}
-                {"<div class='table-wrapper'><table class='citas-table'><thead><tr><th>Paciente</th><th>Horario actual</th><th>Nuevo horario</th></tr></thead><tbody>" + pac_rows + "</tbody></table></div>" if pac_rows else "<p>No hay pacientes agendados.</p>"}
-                <form method="POST" style="margin-top:1rem">
-                    <input type="hidden" name="accion" value="cambiar">
-                    <input type="hidden" name="prof_id" value="{prof_id}">
-                    <input type="hidden" name="fecha" value="{fecha}">
-                    <input type="hidden" name="fecha_destino" value="{fecha_destino}">
-                    <input type="hidden" name="nuevo_turno" value="{nuevo_turno}">
-                    <input type="hidden" name="confirmar" value="1">
-                    <button type="submit" class="btn btn-warning btn-lg" onclick="return confirm('¿Confirmar cambio de turno?')">✅ Confirmar Cambio</button>
-                    <a href="/cambiar_turno" class="btn btn-secondary btn-lg">❌ Cancelar</a>
-                </form></div>'''
-        else:
-            # Execute: delete source
-            conn.execute("DELETE FROM citas WHERE profesional_id=? AND fecha=?", (prof_id, fecha))
-            try:
-                dt = datetime.strptime(fecha, '%Y-%m-%d')
-                conn.execute("DELETE FROM roles_mensuales WHERE profesional_id=? AND anio=? AND mes=? AND dia=?",
-                    (prof_id, dt.year, dt.month, dt.day))
-            except: pass
-
-            # If different destination, also clear destination
-            if fecha_destino != fecha:
-                conn.execute("DELETE FROM citas WHERE profesional_id=? AND fecha=?", (prof_id, fecha_destino))
-                try:
-                    dt2 = datetime.strptime(fecha_destino, '%Y-%m-%d')
-                    conn.execute("DELETE FROM roles_mensuales WHERE profesional_id=? AND anio=? AND mes=? AND dia=?",
-                        (prof_id, dt2.year, dt2.month, dt2.day))
-                except: pass
-
-            # Update roles_mensuales for destination
-            try:
-                dt_dest = datetime.strptime(fecha_destino, '%Y-%m-%d')
-                conn.execute("INSERT OR REPLACE INTO roles_mensuales (profesional_id, anio, mes, dia, turno) VALUES (?,?,?,?,?)",
-                    (prof_id, dt_dest.year, dt_dest.month, dt_dest.day, nuevo_turno))
-            except: pass
-
-            # Insert new slots at destination date
-            pac_idx = 0
-            for slot in new_slots:
-                pac=''; dni=''; edad=''; cel=''; obs=''; estado='Disponible'
-                tipo=''; app_act=''; asist='Pendiente'; sihce=0; sihce_pid=0; creado=None; modif=None
-                if slot['turno'] != 'ADMINISTRATIVA' and pac_idx < len(pacientes):
-                    p = pacientes[pac_idx]
-                    pac=p['paciente']; dni=p['dni']; edad=p.get('edad','')
-                    cel=p['celular']; obs=p['observaciones']; estado='Confirmado'
-                    tipo=p['tipo_paciente']; app_act=p.get('actividad_app','')
-                    asist=p.get('asistencia','Pendiente')
-                    sihce=p.get('sihce',0); sihce_pid=p.get('sihce_prof_id',0)
-                    creado=p.get('creado_por'); modif=p.get('modificado_por')
-                    pac_idx += 1
-                conn.execute("""INSERT INTO citas (profesional_id,fecha,hora_inicio,hora_fin,turno,area,
-                    paciente,dni,edad,celular,observaciones,estado,tipo_paciente,actividad_app,
-                    asistencia,sihce,sihce_prof_id,creado_por,modificado_por,modificado_en)
-                    VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,CURRENT_TIMESTAMP)""",
-                    (prof_id, fecha_destino, slot['inicio'], slot['fin'], slot['turno'], prof['especialidad'],
-                     pac, dni, edad, cel, obs, estado, tipo, app_act, asist, sihce, sihce_pid, creado, modif))
-
-            detalle = f'{prof["nombre"]} | {fecha}→{fecha_destino} | Turno: {nuevo_turno} | {len(pacientes)} pac trasladados'
-            conn.execute("INSERT INTO historial (cita_id, usuario_id, accion, detalle) VALUES (?,?,?,?)",
-                (0, session['user_id'], 'CAMBIO_TURNO', detalle))
-            conn.commit()
-
-            perdidos = f' | {len(pacientes_sin_cupo)} no cupieron' if pacientes_sin_cupo else ''
-            flash(f'Turno cambiado: {prof["nombre"]} → {nuevo_turno} en {fecha_destino}. {len(pacientes)} pacientes trasladados.{perdidos}', 'success')
+            _aplicar_cambios(conn, planes, session['user_id'])
+            trasladados = sum(len(p['colocados']) for p in planes)
+            perdidos = sum(len(p['sin_cupo']) for p in planes)
+            if len(planes) == 1:
+                p = planes[0]
+                extra = f' | {perdidos} no cupieron' if perdidos else ''
+                flash(f'Turno cambiado: {p["prof"]["nombre"]} → {p["turno"]} en {p["destino"]}. {trasladados} pacientes trasladados.{extra}', 'success')
+            else:
+                extra = f' | {perdidos} no cupieron' if perdidos else ''
+                flash(f'{len(planes)} cambios de turno aplicados. {trasladados} pacientes trasladados.{extra}', 'success')
             conn.close()
             return redirect('/cambiar_turno')
+        resultado = _vista_previa_cambios(planes, errores)
 
     conn.close()
-    prof_options = ''.join(f'<option value="{p["id"]}">{p["nombre"]} ({p["especialidad"]})</option>' for p in profesionales)
+    prof_options = ''.join(_OPCION_PROF(id=p['id'], sel_html='', nombre=p['nombre'], esp=p['especialidad']) for p in profesionales)
     flash_msgs = session.pop('_flashes', [])
     return page('Cambiar Turno - Sistema de Citas', _cambiar_turno_form(prof_options, resultado), flash_msgs)
 
+TURNOS_CAMBIO = ('M', 'T', 'MT', 'GD')
+
+def _slots_turno(especialidad, turno):
+    """Slot layout for one professional-day, same rules as the monthly generator"""
+    if especialidad == 'TERAPIA OCUPACIONAL':
+        if turno == 'M':
+            return _make_slots("07:30", 7, 45, 'MAÑANA') + [{'inicio': '13:50', 'fin': '14:35', 'turno': 'TARDE'}]
+        if turno == 'T':
+            return _make_slots("13:30", 6, 45, 'TARDE')
+        return _make_slots("07:30", 7, 45, 'MAÑANA') + _make_slots("13:45", 6, 45, 'TARDE')
+    if especialidad in ('MEDICINA', 'PSIQUIATRÍA', 'SIHCE'):
+        if turno == 'M':
+            return _make_slots("07:30", 7, 40, 'MAÑANA') + [{'inicio': '12:10', 'fin': '13:00', 'turno': 'ADMINISTRATIVA'}]
+        if turno == 'T':
+            return _make_slots("13:30", 6, 40, 'TARDE')
+        return _make_slots("07:30", 8, 40, 'MAÑANA') + _make_slots("14:00", 7, 40, 'TARDE')
+    if turno == 'M':
+        return _make_slots("07:30", 6, 45, 'MAÑANA') + [{'inicio': '12:00', 'fin': '13:00', 'turno': 'ADMINISTRATIVA'}]
+    if turno == 'T':
+        return _make_slots("13:30", 6, 45, 'TARDE')
+    return _make_slots("07:30", 7, 45, 'MAÑANA') + _make_slots("13:45", 6, 45, 'TARDE')
+
+def _turno_actual(conn, prof_id, fecha, citas):
+    dt = datetime.strptime(fecha, '%Y-%m-%d')
+    r = conn.execute("SELECT turno FROM roles_mensuales WHERE profesional_id=? AND anio=? AND mes=? AND dia=?",
+                     (prof_id, dt.year, dt.month, dt.day)).fetchone()
+    if r: return r['turno']
+    turnos = {c['turno'] for c in citas}
+    if {'MAÑANA', 'TARDE'} <= turnos: return 'MT'
+    return 'M' if 'MAÑANA' in turnos else ('T' if 'TARDE' in turnos else '')
+
+def _planificar_cambios(conn, movimientos):
+    """Dry run of a list of (prof_id, fecha, fecha_destino, turno) moves; writes nothing.
+
+    Everything is computed from the current state, so a destination that is also
+    the source of another move in the batch (shifting a week by one day) is fine.
+    Returns (planes, errores).
+    """
+    ids = sorted({m[0] for m in movimientos})
+    profs = {r['id']: r for r in repositorio(conn).profesionales(ids=ids)}
+    fuentes = {(pid, f) for pid, f, _, _ in movimientos}
+    planes, errores, vistos_origen, vistos_destino = [], [], set(), set()
+    for pid, fecha, destino, turno in movimientos:
+        prof = profs.get(pid)
+        if not prof:
+            errores.append('Profesional no encontrado'); continue
+        try:
+            datetime.strptime(fecha, '%Y-%m-%d'); datetime.strptime(destino, '%Y-%m-%d')
+        except ValueError:
+            errores.append(f'{prof["nombre"]}: fecha inválida ({fecha} → {destino})'); continue
+        if (pid, fecha) in vistos_origen:
+            errores.append(f'{prof["nombre"]}: el {fecha} aparece dos veces como origen'); continue
+        if (pid, destino) in vistos_destino:
+            errores.append(f'{prof["nombre"]}: el {destino} aparece dos veces como destino'); continue
+        vistos_origen.add((pid, fecha)); vistos_destino.add((pid, destino))
+        citas = [dict(c) for c in conn.execute(
+            "SELECT * FROM citas WHERE profesional_id=? AND fecha=? ORDER BY hora_inicio", (pid, fecha))]
+        turnos_prev = sorted({c['turno'] for c in citas if c['turno'] != 'ADMINISTRATIVA'})
+        if turno == '=':
+            turno = _turno_actual(conn, pid, fecha, citas)
+        if turno not in TURNOS_CAMBIO:
+            errores.append(f'{prof["nombre"]}: no se pudo determinar el turno del {fecha}'); continue
+        if destino != fecha and (pid, destino) not in fuentes:
+            ocupados = conn.execute("SELECT COUNT(*) FROM citas WHERE profesional_id=? AND fecha=? AND estado='Confirmado'",
+                                    (pid, destino)).fetchone()[0]
+            if ocupados:
+                errores.append(f'La fecha destino {destino} de {prof["nombre"]} ya tiene {ocupados} pacientes agendados. '
+                               'Elimine esos cupos primero o elija otra fecha.')
+                continue
+        slots = _slots_turno(prof['especialidad'], turno)
+        para_pacientes = [sl for sl in slots if sl['turno'] != 'ADMINISTRATIVA']
+        pacientes = [c for c in citas if c['estado'] == 'Confirmado']
+        planes.append({'prof': prof, 'fecha': fecha, 'destino': destino, 'turno': turno,
+                       'turno_prev': ', '.join(turnos_prev) or 'Sin turno', 'total_prev': len(citas),
+                       'slots': slots, 'colocados': list(zip(pacientes, para_pacientes)),
+                       'sin_cupo': pacientes[len(para_pacientes):]})
+    return planes, errores
+
+def _aplicar_cambios(conn, planes, usuario_id):
+    """Apply planned moves in the caller's transaction: bulk deletes and inserts, one historial row per move"""
+    dias = {(p['prof']['id'], f) for p in planes for f in (p['fecha'], p['destino'])}
+    conn.executemany("DELETE FROM citas WHERE profesional_id=? AND fecha=?", dias)
+    conn.executemany("DELETE FROM roles_mensuales WHERE profesional_id=? AND anio=? AND mes=? AND dia=?",
+                     [(pid, int(f[:4]), int(f[5:7]), int(f[8:10])) for pid, f in dias])
+    conn.executemany("INSERT OR REPLACE INTO roles_mensuales (profesional_id, anio, mes, dia, turno) VALUES (?,?,?,?,?)",
+                     [(p['prof']['id'], int(p['destino'][:4]), int(p['destino'][5:7]), int(p['destino'][8:10]), p['turno'])
+                      for p in planes])
+    filas, historial = [], []
+    for p in planes:
+        prof = p['prof']
+        asignados = {id(sl): pac for pac, sl in p['colocados']}
+        for sl in p['slots']:
+            pac = asignados.get(id(sl))
+            if pac:
+                filas.append((prof['id'], p['destino'], sl['inicio'], sl['fin'], sl['turno'], prof['especialidad'],
+                              pac['paciente'], pac['dni'], pac.get('edad', ''), pac['celular'], pac['observaciones'],
+                              'Confirmado', pac['tipo_paciente'], pac.get('actividad_app', ''),
+                              pac.get('asistencia', 'Pendiente'), pac.get('sihce', 0), pac.get('sihce_prof_id', 0),
+                              pac.get('creado_por'), pac.get('modificado_por')))
+            else:
+                filas.append((prof['id'], p['destino'], sl['inicio'], sl['fin'], sl['turno'], prof['especialidad'],
+                              '', '', '', '', '', 'Disponible', '', '', 'Pendiente', 0, 0, None, None))
+        historial.append((0, usuario_id, 'CAMBIO_TURNO',
+                          f'{prof["nombre"]} | {p["fecha"]}→{p["destino"]} | Turno: {p["turno"]} | {len(p["colocados"])} pac trasladados'))
+    conn.executemany("""INSERT INTO citas (profesional_id,fecha,hora_inicio,hora_fin,turno,area,
+        paciente,dni,edad,celular,observaciones,estado,tipo_paciente,actividad_app,
+        asistencia,sihce,sihce_prof_id,creado_por,modificado_por,modificado_en)
+        VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,CURRENT_TIMESTAMP)""", filas)
+    registrar_historial(conn, historial)
+    marcar_cambio(conn)
+    conn.commit()
+
+_CT_MOVIDO = plantilla('<tr><td>{paciente}</td><td>{antes}</td><td style="color:green;font-weight:700">{despues}</td></tr>')
+_CT_SIN_CUPO = plantilla('• {paciente} ({inicio}-{fin})<br>')
+_CT_OCULTOS = plantilla('<input type="hidden" name="prof_id" value="{pid}"><input type="hidden" name="fecha" value="{fecha}">'
+                        '<input type="hidden" name="fecha_destino" value="{destino}"><input type="hidden" name="nuevo_turno" value="{turno}">')
+
+def _vista_previa_cambios(planes, errores):
+    partes = ['<div class="card" style="border:2px solid #ff8f00"><h3>📋 Vista previa del cambio</h3>']
+    if len(planes) > 1:
+        partes.append(f'<p><strong>{len(planes)} movimientos</strong> — {sum(len(p["colocados"]) for p in planes)} pacientes se trasladan, '
+                      f'{sum(len(p["sin_cupo"]) for p in planes)} no caben.</p>')
+    for e in errores:
+        partes.append(f'<div class="flash flash-danger" style="margin:.5rem 0">⚠️ {esc(e)}</div>')
+    for p in planes:
+        cambio_dia = p['fecha'] != p['destino']
+        fecha_display = _fecha_larga(p['fecha'])
+        n_pac = sum(1 for sl in p['slots'] if sl['turno'] != 'ADMINISTRATIVA')
+        partes.append(f'''<div style="border-top:1px solid #ddd;margin-top:1rem;padding-top:.5rem">
+            <p><strong>Profesional:</strong> {esc(p["prof"]["nombre"])}</p>
+            <p><strong>Fecha origen:</strong> {esc(fecha_display)} — Turno: {esc(p["turno_prev"])} ({p["total_prev"]} cupos)</p>
+            <p><strong>{"Fecha destino" if cambio_dia else "Misma fecha"}:</strong> {esc(_fecha_larga(p["destino"]) if cambio_dia else fecha_display)} — Nuevo turno: {p["turno"]} ({len(p["slots"])} cupos, {n_pac} para pacientes)</p>
+            <p><strong>Pacientes agendados:</strong> {len(p["colocados"]) + len(p["sin_cupo"])}</p>''')
+        if cambio_dia:
+            partes.append(f'<p style="color:#1565c0;font-weight:700">📅 Los pacientes se MOVERÁN al {esc(_fecha_larga(p["destino"]))}</p>')
+        if p['sin_cupo']:
+            partes.append(f'<div class="flash flash-danger" style="margin:1rem 0">⚠️ <strong>{len(p["sin_cupo"])} paciente(s) NO CABEN</strong> en el nuevo turno:<br>'
+                          + ''.join(_CT_SIN_CUPO(paciente=c['paciente'], inicio=c['hora_inicio'], fin=c['hora_fin']) for c in p['sin_cupo'])
+                          + 'Estos pacientes se perderán si continúa.</div>')
+        if p['colocados']:
+            partes.append("<div class='table-wrapper'><table class='citas-table'><thead><tr><th>Paciente</th><th>Horario actual</th><th>Nuevo horario</th></tr></thead><tbody>")
+            partes.extend(_CT_MOVIDO(paciente=c['paciente'], antes=f"{c['hora_inicio']}-{c['hora_fin']}",
+                                     despues=f"{sl['inicio']}-{sl['fin']} ({sl['turno']})") for c, sl in p['colocados'])
+            partes.append('</tbody></table></div>')
+        else:
+            partes.append('<p>No hay pacientes agendados.</p>')
+        partes.append('</div>')
+    if planes and not errores:
+        ocultos = ''.join(_CT_OCULTOS(pid=p['prof']['id'], fecha=p['fecha'], destino=p['destino'], turno=p['turno']) for p in planes)
+        partes.append(f'''<form method="POST" style="margin-top:1rem">
+            <input type="hidden" name="accion" value="cambiar">{ocultos}
+            <input type="hidden" name="confirmar" value="1">
+            {idem_input()}
+            <button type="submit" class="btn btn-warning btn-lg" onclick="return confirm('¿Confirmar cambio de turno?')">✅ Confirmar Cambio</button>
+            <a href="/cambiar_turno" class="btn btn-secondary btn-lg">❌ Cancelar</a>
+        </form>''')
+    else:
+        partes.append('<p><a href="/cambiar_turno" class="btn btn-secondary btn-lg">↩️ Corregir</a></p>')
+    partes.append('</div>')
+    return ''.join(partes)
+
 def _cambiar_turno_form(prof_options, resultado=''):
     today = datetime.now().strftime('%Y-%m-%d')
     return f'''<div class="page-header"><h2>🔄 Cambiar Turno de Profesional</h2></div>
@@ -1120,6 +2409,51 @@ def _cambiar_turno_form(prof_options, resultado=''):
         </div>
         <button type="submit" class="btn btn-warning btn-lg">🔍 Ver Vista Previa</button>
     </form></div>
+    <div class="card"><h3>📦 Cambio masivo (feriados, vacaciones)</h3>
+    <p class="text-muted" style="font-size:.85rem">Varios profesionales y fechas en una sola vista previa; se aplica todo junto o nada.
+        "Mismo turno" conserva el turno que tenía el día de origen.</p>
+    <div class="form-row" style="align-items:flex-end">
+        <div class="form-group"><label>Rellenar: profesional</label><select id="lote-prof" class="form-select"><option value="">—</option>{prof_options}</select></div>
+        <div class="form-group"><label>Desde</label><input type="date" id="lote-desde" class="form-input"></div>
+        <div class="form-group"><label>Hasta</label><input type="date" id="lote-hasta" class="form-input"></div>
+        <div class="form-group"><label>Mover días</label><input type="number" id="lote-dias" value="7" class="form-input" style="width:5rem"></div>
+        <button type="button" class="btn btn-secondary" onclick="loteRellenar()">⤵️ Agregar filas</button>
+    </div>
+    <form method="POST">
+        <input type="hidden" name="accion" value="cambiar">
+        <div class="table-wrapper"><table class="citas-table"><thead><tr><th>Profesional</th><th>Origen</th><th>Destino</th><th>Turno</th><th></th></tr></thead>
+        <tbody id="lote-filas"></tbody></table></div>
+        <button type="button" class="btn btn-secondary" onclick="loteFila()">➕ Fila</button>
+        <button type="submit" class="btn btn-warning btn-lg">🔍 Vista previa del lote</button>
+    </form>
+    <template id="lote-tpl"><tr>
+        <td><select name="prof_id" class="form-select"><option value="">—</option>{prof_options}</select></td>
+        <td><input type="date" name="fecha" class="form-input"></td>
+        <td><input type="date" name="fecha_destino" class="form-input"></td>
+        <td><select name="nuevo_turno" class="form-select"><option value="=">Mismo turno</option><option value="M">M</option><option value="T">T</option><option value="MT">MT</option><option value="GD">GD</option></select></td>
+        <td><button type="button" class="btn btn-sm btn-danger" onclick="this.closest('tr').remove()">✖</button></td>
+    </tr></template>
+    <script>
+    function loteFila(prof, origen, destino) {{
+        const tr = document.getElementById('lote-tpl').content.firstElementChild.cloneNode(true);
+        if (prof) tr.querySelector('[name=prof_id]').value = prof;
+        if (origen) tr.querySelector('[name=fecha]').value = origen;
+        if (destino) tr.querySelector('[name=fecha_destino]').value = destino;
+        document.getElementById('lote-filas').appendChild(tr);
+    }}
+    function loteRellenar() {{
+        const prof = document.getElementById('lote-prof').value, d = document.getElementById('lote-desde').value,
+              h = document.getElementById('lote-hasta').value, n = parseInt(document.getElementById('lote-dias').value || '0');
+        if (!prof || !d || !h) return;
+        const iso = x => x.toISOString().slice(0, 10);
+        for (let f = new Date(d + 'T00:00:00Z'); iso(f) <= h; f.setUTCDate(f.getUTCDate() + 1)) {{
+            if (f.getUTCDay() === 0 || f.getUTCDay() === 6) continue;
+            const dest = new Date(f); dest.setUTCDate(dest.getUTCDate() + n);
+            loteFila(prof, iso(f), iso(dest));
+        }}
+    }}
+    loteFila();
+    </script></div>
     <div class="card" style="border:1px solid #c62828"><h3>🗑️ Eliminar cupos de una fecha (corregir errores)</h3>
     <form method="POST">
         <input type="hidden" name="accion" value="eliminar">
@@ -1135,37 +2469,14 @@ def _cambiar_turno_form(prof_options, resultado=''):
     </form></div>
     {resultado}'''
 
-@app.route('/cita/imprimir/<int:cita_id>')
-@login_required
-def imprimir_cita(cita_id):
-    conn = get_db()
-    cita = conn.execute("""SELECT c.*, p.nombre as prof_nombre, p.especialidad
-        FROM citas c JOIN profesionales p ON p.id=c.profesional_id
-        WHERE c.id=?""", (cita_id,)).fetchone()
-    if not cita:
-        conn.close()
-        return "Cita no encontrada", 404
-
-    cita = dict(cita)
-
-    sihce_info = ''
-    if cita['sihce'] and cita.get('sihce_prof_id'):
-        sp = conn.execute("SELECT nombre FROM profesionales WHERE id=?", (cita['sihce_prof_id'],)).fetchone()
-        if sp: sihce_info = f'<tr><td><strong>SIHCE con:</strong></td><td>{sp["nombre"]}</td></tr>'
-    conn.close()
-
-    try:
-        dt = datetime.strptime(cita['fecha'], '%Y-%m-%d')
-        fecha_display = f"{DIAS_ES[dt.weekday()]} {dt.day} de {MESES_ES[dt.month]} {dt.year}"
-    except:
-        fecha_display = cita['fecha']
-
-    html = f'''<!DOCTYPE html>
-<html><head><meta charset="UTF-8"><title>Cita - {cita['paciente']}</title>
+_TICKET_DOC = '''<!DOCTYPE html>
+<html><head><meta charset="UTF-8"><title>{titulo}</title>
 <style>
     @page {{ size: A5; margin: 10mm; }}
     * {{ margin:0; padding:0; box-sizing:border-box; }}
-    body {{ font-family: Arial, sans-serif; font-size: 12px; padding: 10mm; max-width: 148mm; }}
+    body {{ font-family: Arial, sans-serif; font-size: 12px; }}
+    .ticket {{ padding: 10mm; max-width: 148mm; }}
+    .ticket + .ticket {{ break-before: page; page-break-before: always; }}
     .header {{ text-align: center; border-bottom: 2px solid #1a365d; padding-bottom: 8px; margin-bottom: 12px; }}
     .header h1 {{ font-size: 14px; color: #1a365d; }}
     .titulo {{ background: #1a365d; color: white; text-align: center; padding: 6px; font-size: 13px; font-weight: bold; margin-bottom: 12px; }}
@@ -1177,126 +2488,435 @@ def imprimir_cita(cita_id):
     .footer {{ margin-top: 12px; text-align: center; font-size: 8px; color: #999; }}
     @media print {{ .no-print {{ display: none !important; }} }}
 </style></head><body>
-    <div class="no-print" style="text-align:center;margin-bottom:10px">
-        <button onclick="window.print()" style="padding:8px 20px;font-size:13px;background:#1a365d;color:white;border:none;border-radius:4px;cursor:pointer">🖨️ Imprimir</button>
+    <div class="no-print" style="text-align:center;margin:10px 0">
+        {aviso}<button onclick="window.print()" style="padding:8px 20px;font-size:13px;background:#1a365d;color:white;border:none;border-radius:4px;cursor:pointer">🖨️ Imprimir</button>
         <button onclick="window.close()" style="padding:8px 20px;font-size:13px;background:#e2e8f0;border:none;border-radius:4px;cursor:pointer;margin-left:5px">Cerrar</button>
     </div>
+{tickets}
+</body></html>'''
+
+_TICKET = plantilla('''<div class="ticket">
     <div class="header"><h1>🏥 CENTRO DE SALUD MENTAL COMUNITARIO</h1></div>
     <div class="titulo">COMPROBANTE DE CITA</div>
     <table>
-        <tr><td>Paciente:</td><td>{cita['paciente']}</td></tr>
-        <tr><td>DNI:</td><td>{cita['dni']}</td></tr>
-        <tr><td>Fecha:</td><td class="grande">{fecha_display}</td></tr>
-        <tr><td>Hora:</td><td style="font-size:14px;font-weight:bold">{cita['hora_inicio']}</td></tr>
-        <tr><td>Turno:</td><td>{cita['turno']}</td></tr>
-        <tr><td>Área:</td><td class="grande">{cita['area']}</td></tr>
-        <tr><td>Profesional:</td><td>{cita['prof_nombre']}</td></tr>
+        <tr><td>Paciente:</td><td>{paciente}</td></tr>
+        <tr><td>DNI:</td><td>{dni}</td></tr>
+        <tr><td>Fecha:</td><td class="grande">{fecha}</td></tr>
+        <tr><td>Hora:</td><td style="font-size:14px;font-weight:bold">{hora}</td></tr>
+        <tr><td>Turno:</td><td>{turno}</td></tr>
+        <tr><td>Área:</td><td class="grande">{area}</td></tr>
+        <tr><td>Profesional:</td><td>{prof}</td></tr>{sihce_html}
     </table>
     <div class="nota">⚠️ ASISTIR A SU CITA 15 MINUTOS ANTES</div>
-    <div class="footer">Sistema de Citas CSMC — {datetime.now().strftime('%d/%m/%Y %H:%M')}</div>
-</body></html>'''
-    return html
+    <div class="footer">Sistema de Citas CSMC — {impreso}</div>
+</div>
+''')
+_TICKET_SIHCE = plantilla('\n        <tr><td>SIHCE con:</td><td>{nombre}</td></tr>')
 
+def _tickets(citas, nombres_sihce):
+    impreso = datetime.now().strftime('%d/%m/%Y %H:%M')
+    fechas = {}
+    for c in citas:
+        sp = nombres_sihce.get(c['sihce_prof_id']) if c['sihce'] else None
+        if c['fecha'] not in fechas: fechas[c['fecha']] = _fecha_larga(c['fecha'])
+        yield _TICKET(paciente=c['paciente'], dni=c['dni'], fecha=fechas[c['fecha']], hora=c['hora_inicio'],
+                      turno=c['turno'], area=c['area'], prof=c['prof_nombre'], impreso=impreso,
+                      sihce_html=_TICKET_SIHCE(nombre=sp) if sp else '')
 
-@app.route('/reporte_diario')
+@app.route('/cita/imprimir/<int:cita_id>')
 @login_required
-def reporte_diario():
-    fecha = request.args.get('fecha', datetime.now().strftime('%Y-%m-%d'))
+def imprimir_cita(cita_id):
     conn = get_db()
-    citas = conn.execute("""SELECT c.*, p.nombre as prof_nombre, p.especialidad, p.color_bg, p.color_font
+    cita = repositorio(conn).cita_con_profesional(cita_id)
+    if not cita:
+        conn.close()
+        return "Cita no encontrada", 404
+    nombres = _nombres_sihce(conn, [cita])
+    conn.close()
+    return _TICKET_DOC.format(titulo=f"Cita - {esc(cita['paciente'])}", aviso='',
+                              tickets=''.join(_tickets([cita], nombres)))
+
+@app.route('/imprimir/dia')
+@login_required
+def imprimir_dia():
+    """Every confirmed ticket of a day (optionally one professional) in one printable document"""
+    fecha = _fecha_param('fecha', datetime.now().date()).isoformat()
+    prof_id = request.args.get('prof_id', '')
+    filtro, params = ("AND c.profesional_id=?", (fecha, int(prof_id))) if prof_id.isdigit() else ('', (fecha,))
+    conn = get_db_lectura()
+    citas = conn.execute(f"""SELECT c.fecha, c.paciente, c.dni, c.hora_inicio, c.turno, c.area, c.sihce, c.sihce_prof_id,
+            p.nombre as prof_nombre
         FROM citas c JOIN profesionales p ON p.id=c.profesional_id
-        WHERE c.fecha=? AND c.estado='Confirmado'
-        ORDER BY p.orden, c.turno, c.hora_inicio""", (fecha,)).fetchall()
+        WHERE c.fecha=? AND c.estado='Confirmado' {filtro}
+        ORDER BY p.orden, c.hora_inicio""", params).fetchall()
+    nombres = _nombres_sihce(conn, citas)
+    conn.close()
+    if not citas:
+        return _TICKET_DOC.format(titulo='Sin citas', aviso='',
+                                  tickets=f'<p style="text-align:center;padding:2rem">No hay pacientes programados para el {esc(_fecha_larga(fecha))}.</p>')
+    aviso = f'<p style="margin-bottom:8px"><strong>{len(citas)} comprobantes</strong> — {esc(_fecha_larga(fecha))}</p>'
+    return _TICKET_DOC.format(titulo=f'Comprobantes {fecha}', aviso=aviso, tickets=''.join(_tickets(citas, nombres)))
 
-    try:
-        dt = datetime.strptime(fecha, '%Y-%m-%d')
-        fecha_display = f"{DIAS_ES[dt.weekday()]} {dt.day} de {MESES_ES[dt.month]} {dt.year}"
-    except: fecha_display = fecha
 
-    rows = ''
-    current_prof = ''
-    num = 0
-    for c in citas:
-        if c['prof_nombre'] != current_prof:
-            current_prof = c['prof_nombre']
-            num = 0
-            rows += f'''<tr style="background:{c['color_bg']};color:{c['color_font']}">
-                <td colspan="7" style="padding:.6rem;font-weight:700">{c['prof_nombre']} — {c['especialidad']}</td></tr>'''
-        num += 1
-        sihce_tag = ''
-        if c['sihce']:
-            sihce_tag = ' <span class="sihce-tag">SIHCE</span>'
-            sp_id = c.get('sihce_prof_id', 0) or 0
-            if sp_id:
-                sp = conn.execute("SELECT nombre FROM profesionales WHERE id=?", (sp_id,)).fetchone()
-                if sp: sihce_tag += f' <small style="color:#e65100">🔗 {sp["nombre"]}</small>'
-        app_tag = f'<br><small style="color:#e65100">APP: {c["actividad_app"]}</small>' if c['actividad_app'] else ''
-        rows += f'''<tr><td>{num}</td><td>{c['turno']}</td>
-            <td class="td-hora">{c['hora_inicio']} - {c['hora_fin']}</td>
-            <td><strong>{c['paciente']}</strong>{sihce_tag}{app_tag}</td><td>{c['dni']}</td><td>{c['edad']}</td>
-            <td><span class="badge {'badge-new' if c['tipo_paciente']=='NUEVO' else 'badge-cont'}">{c['tipo_paciente']}</span></td>
-            <td>{c['observaciones']}</td></tr>'''
+REPORTE_LOTE = 200  # filas leídas del cursor por cada bloque enviado
 
-    conn.close()
-    if not citas:
-        rows = '<tr><td colspan="8" class="text-center">No hay pacientes programados para esta fecha</td></tr>'
+_RD_DIA = plantilla('<tr class="turno-divider"><td colspan="8"><span class="turno-label">📅 {fecha}</span></td></tr>')
+_RD_PROF = plantilla('<tr style="background:{bg};color:{fg}"><td colspan="8" style="padding:.6rem;font-weight:700">{prof} — {esp}</td></tr>')
+_RD_FILA = plantilla('<tr><td>{num}</td><td>{turno}</td><td class="td-hora">{inicio} - {fin}</td><td><strong>{paciente}</strong>{sihce_html}{app_html}</td><td>{dni}</td><td>{edad}</td><td>{tipo_html}</td><td>{obs}</td></tr>')
+_RD_SIHCE = ' <span class="sihce-tag">SIHCE</span>'
+_RD_SIHCE_PAR = plantilla(' <small style="color:#e65100">🔗 {nombre}</small>')
+_RD_APP = plantilla('<br><small style="color:#e65100">APP: {app}</small>')
+_RD_TIPO = {t: f'<span class="badge {"badge-new" if t == "NUEVO" else "badge-cont"}">{t}</span>' for t in ('NUEVO', 'CONTINUADOR')}
+_RD_VACIO = '<tr><td colspan="8" class="text-center">No hay pacientes programados para esta fecha</td></tr>'
+
+def _filas_reporte_diario(cur, nombres, varios_dias):
+    """Render the cursor in REPORTE_LOTE-row chunks; memory stays flat for any range"""
+    dia = prof = None; num = 0
+    while True:
+        lote = cur.fetchmany(REPORTE_LOTE)
+        if not lote: break
+        out = []
+        for c in lote:
+            if varios_dias and c['fecha'] != dia:
+                dia = c['fecha']; prof = None
+                out.append(_RD_DIA(fecha=_fecha_larga(dia)))
+            if c['profesional_id'] != prof:
+                prof = c['profesional_id']; num = 0
+                out.append(_RD_PROF(bg=c['color_bg'], fg=c['color_font'], prof=c['prof_nombre'], esp=c['especialidad']))
+            num += 1
+            sh = ''
+            if c['sihce']:
+                sh = _RD_SIHCE
+                if c['sihce_prof_id'] in nombres: sh += _RD_SIHCE_PAR(nombre=nombres[c['sihce_prof_id']])
+            tipo = c['tipo_paciente']
+            out.append(_RD_FILA(num=num, turno=c['turno'], inicio=c['hora_inicio'], fin=c['hora_fin'], paciente=c['paciente'],
+                                sihce_html=sh, app_html=_RD_APP(app=c['actividad_app']) if c['actividad_app'] else '',
+                                dni=c['dni'], edad=c['edad'],
+                                tipo_html=_RD_TIPO.get(tipo) or f'<span class="badge badge-cont">{esc(tipo)}</span>',
+                                obs=c['observaciones']))
+        yield ''.join(out)
 
-    content = f'''<div class="page-header"><h2>📋 Reporte Diario - Pacientes Programados</h2>
+@app.route('/reporte_diario')
+@login_required
+@cacheado(almacenar=lambda: request.args.get('hasta', '') in ('', request.args.get('fecha')))
+def reporte_diario():
+    """Programmed patients for one day, or for a desde/hasta range, streamed from the cursor"""
+    desde = _fecha_param('fecha', datetime.now().date())
+    hasta = _fecha_param('hasta', desde)
+    if hasta < desde: hasta = desde
+    fecha, fecha_hasta = desde.isoformat(), hasta.isoformat()
+    varios_dias = hasta != desde
+    titulo = f'{_fecha_larga(fecha)} al {_fecha_larga(fecha_hasta)}' if varios_dias else _fecha_larga(fecha)
+    semana = (desde + timedelta(days=6)).isoformat()
+    fin_mes = desde.replace(day=calendar.monthrange(desde.year, desde.month)[1]).isoformat()
+
+    conn = get_db_lectura()
+    total = conn.execute("SELECT COUNT(*) FROM citas WHERE fecha BETWEEN ? AND ? AND estado='Confirmado'",
+                         (fecha, fecha_hasta)).fetchone()[0]
+    nombres = repositorio(conn).nombres_profesionales()
+    cur = conn.execute("""SELECT c.fecha, c.profesional_id, c.turno, c.hora_inicio, c.hora_fin, c.paciente, c.dni, c.edad,
+            c.tipo_paciente, c.observaciones, c.sihce, c.sihce_prof_id, c.actividad_app,
+            p.nombre as prof_nombre, p.especialidad, p.color_bg, p.color_font
+        FROM citas c JOIN profesionales p ON p.id=c.profesional_id
+        WHERE c.fecha BETWEEN ? AND ? AND c.estado='Confirmado'
+        ORDER BY c.fecha, p.orden, c.turno, c.hora_inicio""", (fecha, fecha_hasta))
+
+    cabecera = f'''<div class="page-header"><h2>📋 Reporte Diario - Pacientes Programados</h2>
         <p class="text-muted" style="font-size:.9rem">Para sacar historias clínicas</p></div>
     <div class="card no-print" style="padding:1rem">
         <form method="GET" class="filter-row">
             <div class="filter-group"><label>Fecha</label><input type="date" name="fecha" value="{fecha}" class="form-input"></div>
+            <div class="filter-group"><label>Hasta (opcional)</label><input type="date" name="hasta" value="{fecha_hasta if varios_dias else ''}" class="form-input"></div>
             <div class="filter-group" style="align-self:flex-end"><button type="submit" class="btn btn-primary">🔍 Consultar</button>
+            <a href="/reporte_diario?fecha={fecha}&hasta={semana}" class="btn btn-secondary">Semana</a>
+            <a href="/reporte_diario?fecha={fecha}&hasta={fin_mes}" class="btn btn-secondary">Hasta fin de mes</a>
+            <a href="/imprimir/dia?fecha={fecha}" target="_blank" class="btn btn-secondary">🖨️ Comprobantes del día</a>
             <button type="button" class="btn btn-secondary" onclick="window.print()">🖨️ Imprimir</button></div>
         </form>
     </div>
     <div class="card">
-        <h3>📅 {fecha_display} — {len(citas)} pacientes programados</h3>
+        <h3>📅 {esc(titulo)} — {total} pacientes programados</h3>
         <div class="table-wrapper"><table class="citas-table"><thead><tr>
             <th>#</th><th>Turno</th><th>Hora</th><th>Paciente</th><th>DNI</th><th>Edad</th><th>Tipo</th><th>Observaciones</th>
-        </tr></thead><tbody>{rows}</tbody></table></div>
-    </div>'''
+        </tr></thead><tbody>'''
+
+    def partes():
+        try:
+            yield cabecera
+            yield from _filas_reporte_diario(cur, nombres, varios_dias)
+            if not total: yield _RD_VACIO
+            yield '</tbody></table></div></div>'
+        finally:
+            conn.close()
+
     flash_msgs = session.pop('_flashes', [])
-    return page('Reporte Diario - Sistema de Citas', content, flash_msgs)
+    return page_stream('Reporte Diario - Sistema de Citas', partes(), flash_msgs)
 
 # ==============================================================================
 # GENERAR CALENDARIO
 # ==============================================================================
+# Códigos de la grilla que no generan cupos (libre, vacaciones, descanso)
+TURNOS_SIN_CUPOS = ('L', 'V', 'D')
+_GEN_FILA = plantilla('<tr><td><strong>{nombre}</strong><br><small>{esp}</small></td><td>{dias}</td><td>{cupos}</td><td>{pacientes}</td><td>{migradas}</td><td>{perdidas}</td></tr>')
+_GEN_PERDIDA = plantilla('<tr><td>{prof}</td><td>{fecha}</td><td>{hora}</td><td>{paciente}</td></tr>')
+
+def _dia_encabezado(v):
+    if v.isdigit() and 1 <= int(v) <= 31: return int(v)
+    if re.match(r'\d{4}-\d{2}-\d{2}$', v): return int(v[8:10])
+    return None
+
+def _leer_rol_grilla(filas):
+    """Parse a professionals × days grid into ({nombre: {dia: codigo}}, errores).
+
+    The header is the first row with at least five day numbers (or dates);
+    the name is the longest text left of the first day column, so N° or
+    CARGO columns are ignored. Blank cells are days off.
+    """
+    filas = iter(filas)
+    dias = None
+    for n, fila in enumerate(filas, 1):
+        cols = {i: d for i, d in ((i, _dia_encabezado(v)) for i, v in enumerate(fila)) if d}
+        if len(cols) >= 5:
+            dias = cols; break
+        if n >= 10: break
+    if dias is None:
+        return {}, [(0, 'No se encontró la fila con los números de día (1, 2, 3, …) en las primeras 10 filas')]
+    primera = min(dias)
+    rol = {}; errores = []
+    for n, fila in enumerate(filas, n + 1):
+        nombre = max(fila[:primera], key=len, default='').upper()
+        if not nombre or nombre.isdigit(): continue
+        if nombre in rol:
+            errores.append((n, f'Fila {n}: {nombre} aparece más de una vez en la grilla')); continue
+        turnos = rol[nombre] = {}
+        for i, dia in dias.items():
+            codigo = fila[i].strip().upper() if i < len(fila) else ''
+            if codigo: turnos[dia] = codigo
+    return rol, errores
+
+def _validar_rol(conn, rol, anio, mes):
+    """Check names, days and shift codes, and simulate generate_slots' patient migration.
+
+    Returns (resumen, perdidas, errores, limpio): one summary row per
+    professional, the confirmed patients that would be dropped, the
+    problems found and the roster restricted to working days.
+    """
+    profs = {r['nombre']: dict(r) for r in repositorio(conn).profesionales(activos=True)}
+    num_dias = calendar.monthrange(anio, mes)[1]
+    errores = []; limpio = {}; por_prof = {}
+    for nombre, turnos in rol.items():
+        prof = _buscar_profesional(nombre, profs)
+        if not prof:
+            errores.append(f'{nombre}: no coincide con ningún profesional activo'); continue
+        if prof['id'] in por_prof:
+            errores.append(f'{nombre}: es el mismo profesional que {por_prof[prof["id"]]["rol"]}'); continue
+        dias = {}
+        for dia, codigo in sorted(turnos.items()):
+            if dia > num_dias:
+                errores.append(f'{nombre}: {MESES_ES[mes]} no tiene día {dia}')
+            elif codigo in TURNOS_CAMBIO:
+                dias[dia] = codigo
+            elif codigo not in TURNOS_SIN_CUPOS:
+                errores.append(f'{nombre}, día {dia}: turno «{codigo}» desconocido (use {", ".join(TURNOS_CAMBIO + TURNOS_SIN_CUPOS)})')
+        por_prof[prof['id']] = {'prof': prof, 'rol': nombre, 'dias': dias}
+        if dias: limpio[prof['nombre']] = dias
+
+    existentes = {}
+    for c in conn.execute("""SELECT c.profesional_id, c.fecha, c.hora_inicio, c.paciente, p.nombre, p.especialidad
+            FROM citas c JOIN profesionales p ON p.id=c.profesional_id
+            WHERE c.fecha BETWEEN ? AND ? AND c.estado != 'Disponible' ORDER BY c.hora_inicio""",
+            (f'{anio}-{mes:02d}-01', f'{anio}-{mes:02d}-{num_dias:02d}')):
+        existentes.setdefault(c['profesional_id'], {}).setdefault(int(c['fecha'][8:10]), []).append(c)
+        if c['profesional_id'] not in por_prof:
+            por_prof[c['profesional_id']] = {'prof': {'nombre': c['nombre'], 'especialidad': c['especialidad']}, 'dias': {}}
+
+    resumen = []; perdidas = []
+    for pid, d in por_prof.items():
+        esp = d['prof']['especialidad']
+        cupos = pacientes = migradas = 0
+        antes = len(perdidas)
+        for dia, codigo in d['dias'].items():
+            slots = _slots_turno(esp, codigo)
+            cupos += len(slots); pacientes += sum(1 for sl in slots if sl['turno'] != 'ADMINISTRATIVA')
+        for dia, citas in existentes.get(pid, {}).items():
+            n = len(_slots_turno(esp, d['dias'][dia])) if dia in d['dias'] else 0
+            migradas += min(n, len(citas))
+            perdidas.extend(citas[n:])
+        conteo = {}
+        for codigo in d['dias'].values(): conteo[codigo] = conteo.get(codigo, 0) + 1
+        resumen.append({'nombre': d['prof']['nombre'], 'esp': esp, 'cupos': cupos, 'pacientes': pacientes,
+                        'dias': conteo, 'migradas': migradas,
+                        'perdidas': len(perdidas) - antes})
+    perdidas.sort(key=lambda c: (c['fecha'], c['hora_inicio']))
+    return resumen, perdidas, errores, limpio
+
+def _rol_a_texto(rol):
+    return '\n'.join(f'{nombre}: ' + ', '.join(f'Día {d} {c}' for d, c in sorted(dias.items())) for nombre, dias in rol.items())
+
+def _planificar_meses(conn, meses, rol_de_mes):
+    """Run _validar_rol for every month of the range and add the results up per professional"""
+    por_mes = []; total = {}; perdidas = []; errores = []; roles = {}
+    for a, m in meses:
+        resumen, perd, errs, limpio = _validar_rol(conn, rol_de_mes(a, m), a, m)
+        por_mes.append({'anio': a, 'mes': m, 'cupos': sum(r['cupos'] for r in resumen),
+                        'migradas': sum(r['migradas'] for r in resumen), 'perdidas': len(perd)})
+        for r in resumen:
+            t = total.setdefault(r['nombre'], {'nombre': r['nombre'], 'esp': r['esp'], 'dias': {},
+                                               'cupos': 0, 'pacientes': 0, 'migradas': 0, 'perdidas': 0})
+            for k in ('cupos', 'pacientes', 'migradas', 'perdidas'): t[k] += r[k]
+            for codigo, n in r['dias'].items(): t['dias'][codigo] = t['dias'].get(codigo, 0) + n
+        perdidas += perd; errores += errs; roles[(a, m)] = limpio
+    if not any(roles.values()): errores.append('El rol no tiene ningún día con turno')
+    return {'meses': por_mes, 'resumen': list(total.values()), 'perdidas': perdidas,
+            'errores': list(dict.fromkeys(errores)), 'roles': roles}
+
+def _rango_meses(meses):
+    (a1, m1), (a2, m2) = meses[0], meses[-1]
+    return f'{MESES_ES[m1]} {a1}' + (f' – {MESES_ES[m2]} {a2}' if len(meses) > 1 else '')
+
+def _dias_fijos(texto):
+    """Errors for 'Día N' entries, which only make sense within a single month"""
+    return [f'{l.split(":", 1)[0].strip().upper()}: «Día N» vale para un solo mes; para varios meses use patrones semanales (LUN-VIE M)'
+            for l in texto.splitlines() if ':' in l and _RE_DIA.search(l.split(':', 1)[1])]
+
+def _revisar_texto_rol(texto, meses):
+    """Text-roster errors over the month range: repeated names, lines with no entry, 'Día N' across months"""
+    errores = []
+    for a, m in meses:
+        rol = parse_roster_text(texto, a, m, errores)
+        errores += [f'{l.split(":", 1)[0].strip().upper()}: no se reconoció ningún «Día N TURNO» ni patrón semanal'
+                    for l in texto.splitlines() if ':' in l and l.split(':', 1)[0].strip().upper() not in rol]
+    if len(meses) > 1: errores += _dias_fijos(texto)
+    return list(dict.fromkeys(errores))
+
+def _rol_de_solicitud(year, month, n_meses=1):
+    """Roster posted to /generar as (texto, rol_de_mes, errores); raises ValueError when unusable"""
+    archivo = request.files.get('grilla')
+    if archivo and archivo.filename:
+        rol, errores = _leer_rol_grilla(_leer_planilla(archivo))
+        errores = [e for _, e in errores]
+        if n_meses > 1: errores.append('La grilla es de un solo mes: genere un mes a la vez o use patrones semanales')
+        return _rol_a_texto(rol), lambda a, m: rol, errores
+    texto = request.form.get('roster_text', '')
+    if not texto.strip(): raise ValueError('El texto del rol no puede estar vacío')
+    errores = _revisar_texto_rol(texto, list(meses_consecutivos(year, month, n_meses)))
+    return texto, lambda a, m: parse_roster_text(texto, a, m), errores
+
+def _vista_previa_rol(meses, plan, errores, texto):
+    resumen, perdidas = plan['resumen'], plan['perdidas']
+    partes = [f'''<div class="card" style="border:2px solid #ff8f00"><h3>📋 Vista previa — {_rango_meses(meses)}</h3>
+        <p><strong>{sum(r["cupos"] for r in resumen)}</strong> cupos para {sum(1 for r in resumen if r["cupos"])} profesional(es);
+        {sum(r["migradas"] for r in resumen)} cita(s) agendadas se migran, <strong>{len(perdidas)}</strong> se pierden.</p>''']
+    for e in errores:
+        partes.append(f'<div class="flash flash-danger" style="margin:.5rem 0">⚠️ {esc(e)}</div>')
+    if len(meses) > 1:
+        partes.append("<div class='table-wrapper'><table class='citas-table'><thead><tr><th>Mes</th><th>Cupos</th><th>Citas migradas</th><th>Se pierden</th></tr></thead><tbody>")
+        partes.extend(f"<tr><td>{MESES_ES[x['mes']]} {x['anio']}</td><td>{x['cupos']}</td><td>{x['migradas']}</td><td>{x['perdidas']}</td></tr>" for x in plan['meses'])
+        partes.append('</tbody></table></div>')
+    partes.append("<div class='table-wrapper'><table class='citas-table'><thead><tr><th>Profesional</th><th>Días</th><th>Cupos</th><th>Para pacientes</th><th>Citas migradas</th><th>Se pierden</th></tr></thead><tbody>")
+    partes.extend(_GEN_FILA(nombre=r['nombre'], esp=r['esp'], dias=' · '.join(f'{v} {k}' for k, v in r['dias'].items()) or '—',
+                            cupos=r['cupos'], pacientes=r['pacientes'], migradas=r['migradas'], perdidas=r['perdidas']) for r in resumen)
+    partes.append('</tbody></table></div>')
+    if perdidas:
+        partes.append(f'<div class="flash flash-danger" style="margin:1rem 0">⚠️ <strong>{len(perdidas)} paciente(s) agendado(s) se perderán</strong> (sin cupo en el nuevo rol):</div>')
+        partes.append("<div class='table-wrapper'><table class='citas-table'><thead><tr><th>Profesional</th><th>Fecha</th><th>Hora</th><th>Paciente</th></tr></thead><tbody>")
+        partes.extend(_GEN_PERDIDA(prof=c['nombre'], fecha=c['fecha'], hora=c['hora_inicio'], paciente=c['paciente']) for c in perdidas)
+        partes.append('</tbody></table></div>')
+    if errores:
+        partes.append('<p>Corrija el rol y vuelva a revisar; no se genera nada mientras haya errores.</p>')
+    else:
+        (anio, mes) = meses[0]
+        partes.append(f'''<form method="POST" style="margin-top:1rem">
+            <input type="hidden" name="year" value="{anio}"><input type="hidden" name="month" value="{mes}">
+            <input type="hidden" name="meses" value="{len(meses)}">
+            <textarea name="roster_text" hidden>{esc(texto)}</textarea>
+            <input type="hidden" name="confirmar" value="1">{idem_input()}
+            <button type="submit" class="btn btn-danger btn-lg" onclick="return confirm('¿Generar cupos? Las citas existentes se migrarán al nuevo horario.')">🔄 CONFIRMAR Y GENERAR</button>
+            <a href="/generar" class="btn btn-secondary btn-lg">❌ Cancelar</a>
+        </form>''')
+    partes.append('</div>')
+    return ''.join(partes)
+
+def _meses_solicitud():
+    year = int(request.form.get('year', datetime.now().year))
+    month = int(request.form.get('month', datetime.now().month))
+    n = max(1, min(12, int(request.form.get('meses') or 1)))
+    return year, month, list(meses_consecutivos(year, month, n))
+
 @app.route('/generar', methods=['GET', 'POST'])
 @admin_required
+@idempotente
 def generar():
+    year, month, meses = _meses_solicitud()
+    roster_text = request.form.get('roster_text', '')
+    vista = ''
     if request.method == 'POST':
-        year = int(request.form.get('year', datetime.now().year))
-        month = int(request.form.get('month', datetime.now().month))
-        roster_text = request.form.get('roster_text', '')
-        if not roster_text.strip():
-            flash('El texto del rol no puede estar vacío', 'danger')
+        try:
+            texto, rol_de_mes, errores = _rol_de_solicitud(year, month, len(meses))
+        except ValueError as e:
+            flash(str(e), 'danger')
             return redirect('/generar')
-        conn = get_db()
-        count = generate_slots(conn, year, month, roster_text)
+        confirmar = request.form.get('confirmar')
+        conn = get_db() if confirmar else get_db_lectura()
+        plan = _planificar_meses(conn, meses, rol_de_mes)
+        errores += plan['errores']
+        if confirmar and not errores:
+            count = sum(generar_meses(conn, plan['roles']).values())
+            conn.close()
+            flash(f'✅ Generados {count} cupos para {_rango_meses(meses)}', 'success')
+            return redirect('/')
         conn.close()
-        flash(f'✅ Generados {count} cupos para {MESES_ES[month]} {year}', 'success')
-        return redirect('/')
+        vista = _vista_previa_rol(meses, plan, errores, texto)
+        if not roster_text.strip(): roster_text = texto
 
-    month_opts = ''.join([f'<option value="{i}" {"selected" if i==datetime.now().month else ""}>{MESES_ES[i]}</option>' for i in range(1, 13)])
+    month_opts = ''.join([f'<option value="{i}" {"selected" if i==month else ""}>{MESES_ES[i]}</option>' for i in range(1, 13)])
 
     content = f'''<div class="page-header"><h2>⚙️ Generar Calendario Mensual</h2></div>
-    <div class="card"><form method="POST">
+    {vista}
+    <div class="card"><form method="POST" enctype="multipart/form-data">
         <div class="form-row">
-            <div class="form-group"><label>Año</label><input type="number" name="year" value="{datetime.now().year}" class="form-input" min="2024" max="2030"></div>
+            <div class="form-group"><label>Año</label><input type="number" name="year" value="{year}" class="form-input" min="2024" max="2030"></div>
             <div class="form-group"><label>Mes</label><select name="month" class="form-select">{month_opts}</select></div>
+            <div class="form-group"><label>Meses seguidos</label><input type="number" name="meses" value="{len(meses)}" class="form-input" min="1" max="12"></div>
         </div>
         <div class="form-group"><label>Texto del Rol Mensual</label>
-            <textarea name="roster_text" class="form-textarea" rows="16">{get_default_roster()}</textarea>
+            <textarea name="roster_text" class="form-textarea" rows="16">{esc(roster_text) or get_default_roster()}</textarea>
             <small class="form-help">Formato: NOMBRE: Día X TURNO. Turnos: M=Mañana, T=Tarde, MT=Mañana+Tarde, GD=Guardia Diurna.<br>
+            Patrones semanales: NOMBRE: LUN M, MIÉ MT o LUN-VIE T (se repiten en cada mes; «Día X L» anula un día puntual y solo se admite al generar un mes).<br>
             ⚠️ M: mañana + hora administrativa | T: inicia 1:30pm | MT y GD: mismo horario completo<br>
             ⚠️ Si ya existen citas agendadas, se migrarán automáticamente.</small>
         </div>
-        <div class="form-actions"><button type="submit" class="btn btn-danger btn-lg" onclick="return confirm('¿Generar cupos? Las citas existentes se migrarán al nuevo horario.')">🔄 REGENERAR CALENDARIO</button></div>
+        <div class="form-group"><label>… o la grilla del rol (.csv / .xlsx)</label>
+            <input type="file" name="grilla" accept=".csv,.txt,.xlsx" class="form-input">
+            <small class="form-help">Una fila por profesional y una columna por día (1 … 31) con M, T, MT o GD; L, V, D o vacío = sin cupos. Si se sube, reemplaza al texto.</small>
+        </div>
+        <div class="form-actions"><button type="submit" class="btn btn-primary btn-lg">🔍 Revisar antes de generar</button></div>
     </form></div>'''
     flash_msgs = session.pop('_flashes', [])
     return page('Generar - Sistema de Citas', content, flash_msgs)
 
+@app.route('/api/generar/estimar', methods=['POST'])
+@admin_required
+def api_generar_estimar():
+    """Slot estimate for a roster and month range, same checks as the /generar preview; writes nothing"""
+    year, month, meses = _meses_solicitud()
+    try:
+        _, rol_de_mes, errores = _rol_de_solicitud(year, month, len(meses))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    conn = get_db_lectura()
+    try:
+        plan = _planificar_meses(conn, meses, rol_de_mes)
+    finally:
+        conn.close()
+    return jsonify({
+        'meses': plan['meses'],
+        'profesionales': [{k: r[k] for k in ('nombre', 'cupos', 'pacientes', 'migradas', 'perdidas', 'dias')} for r in plan['resumen']],
+        'cupos': sum(x['cupos'] for x in plan['meses']),
+        'perdidas': len(plan['perdidas']),
+        'errores': errores + plan['errores'],
+    })
+
 # ==============================================================================
 # PROFESIONALES
 # ==============================================================================
@@ -1304,10 +2924,10 @@ def generar():
 @admin_required
 def profesionales():
     conn = get_db()
-    profs = conn.execute("SELECT * FROM profesionales ORDER BY orden").fetchall()
+    profs = repositorio(conn).profesionales()
     conn.close()
 
-    rows = ''
+    rows = []
     for p in profs:
         inactive = 'row-inactive' if not p['activo'] else ''
         status_badge = '<span class="badge badge-success">Activo</span>' if p['activo'] else '<span class="badge badge-danger">Inactivo</span>'
@@ -1319,9 +2939,9 @@ def profesionales():
             esp_opts += f'<option value="{esp}" {sel}>{esp}</option>'
         font_b = 'selected' if p['color_font'] == 'black' else ''
         font_w = 'selected' if p['color_font'] == 'white' else ''
-        rows += f'''<tr class="{inactive}">
-            <td><span class="color-swatch" style="background:{p['color_bg']};color:{p['color_font']}">Aa</span></td>
-            <td><strong>{p['nombre']}</strong></td><td>{p['especialidad']}</td><td>{status_badge}</td>
+        rows.append(f'''<tr class="{inactive}">
+            <td><span class="color-swatch" style="background:{esc(p['color_bg'])};color:{esc(p['color_font'])}">Aa</span></td>
+            <td><strong>{esc(p['nombre'])}</strong></td><td>{esc(p['especialidad'])}</td><td>{status_badge}</td>
             <td style="white-space:nowrap">
                 <button class="btn btn-sm btn-primary" onclick="document.getElementById('edit-{p['id']}').style.display=document.getElementById('edit-{p['id']}').style.display==='none'?'table-row':'none'">✏️</button>
                 <form method="POST" action="/profesional/toggle/{p['id']}" style="display:inline"><button type="submit" class="btn btn-sm {btn_class}">{btn_text}</button></form>
@@ -1329,13 +2949,14 @@ def profesionales():
             <tr id="edit-{p['id']}" style="display:none;background:#f0f9ff">
             <td colspan="5">
                 <form method="POST" action="/profesional/editar/{p['id']}" style="display:flex;gap:.5rem;align-items:flex-end;flex-wrap:wrap;padding:.5rem">
-                    <div class="form-group" style="flex:2;margin:0"><label>Nombre</label><input type="text" name="nombre" value="{p['nombre']}" class="form-input" required></div>
+                    <div class="form-group" style="flex:2;margin:0"><label>Nombre</label><input type="text" name="nombre" value="{esc(p['nombre'])}" class="form-input" required></div>
                     <div class="form-group" style="flex:1;margin:0"><label>Especialidad</label><select name="especialidad" class="form-select">{esp_opts}</select></div>
-                    <div class="form-group" style="margin:0"><label>Color</label><input type="color" name="color_bg" value="{p['color_bg']}" class="form-color"></div>
+                    <div class="form-group" style="margin:0"><label>Color</label><input type="color" name="color_bg" value="{esc(p['color_bg'])}" class="form-color"></div>
                     <div class="form-group" style="margin:0"><label>Texto</label><select name="color_font" class="form-select"><option value="black" {font_b}>Negro</option><option value="white" {font_w}>Blanco</option></select></div>
                     <button type="submit" class="btn btn-sm btn-success">💾 Guardar</button>
                 </form>
-            </td></tr>'''
+            </td></tr>''')
+    rows = ''.join(rows)
 
     content = f'''<div class="page-header"><h2>👥 Gestión de Profesionales</h2></div>
     <div class="card"><h3>Agregar Profesional</h3>
@@ -1365,13 +2986,11 @@ def nuevo_profesional():
         flash('El nombre es obligatorio', 'danger')
         return redirect('/profesionales')
     conn = get_db()
-    try:
-        max_orden = conn.execute("SELECT MAX(orden) FROM profesionales").fetchone()[0] or 0
-        conn.execute("INSERT INTO profesionales (nombre, especialidad, color_bg, color_font, orden) VALUES (?,?,?,?,?)",
-            (nombre, esp, color_bg, color_font, max_orden + 1))
+    if repositorio(conn).crear_profesional(nombre, esp, color_bg, color_font):
+        marcar_cambio(conn)
         conn.commit()
         flash(f'Profesional {nombre} agregado', 'success')
-    except sqlite3.IntegrityError:
+    else:
         flash('Ya existe un profesional con ese nombre', 'warning')
     conn.close()
     return redirect('/profesionales')
@@ -1387,8 +3006,8 @@ def editar_profesional(prof_id):
         flash('El nombre es obligatorio', 'danger')
         return redirect('/profesionales')
     conn = get_db()
-    conn.execute("UPDATE profesionales SET nombre=?, especialidad=?, color_bg=?, color_font=? WHERE id=?",
-        (nombre, esp, color_bg, color_font, prof_id))
+    repositorio(conn).editar_profesional(prof_id, nombre, esp, color_bg, color_font)
+    marcar_cambio(conn)
     conn.commit(); conn.close()
     flash(f'Profesional actualizado: {nombre}', 'success')
     return redirect('/profesionales')
@@ -1397,9 +3016,8 @@ def editar_profesional(prof_id):
 @admin_required
 def toggle_profesional(prof_id):
     conn = get_db()
-    prof = conn.execute("SELECT * FROM profesionales WHERE id=?", (prof_id,)).fetchone()
-    if prof:
-        conn.execute("UPDATE profesionales SET activo=? WHERE id=?", (0 if prof['activo'] else 1, prof_id))
+    if repositorio(conn).alternar_profesional(prof_id):
+        marcar_cambio(conn)
         conn.commit()
     conn.close()
     return redirect('/profesionales')
@@ -1411,9 +3029,9 @@ def toggle_profesional(prof_id):
 @admin_required
 def usuarios():
     conn = get_db()
-    users = conn.execute("SELECT * FROM usuarios ORDER BY id").fetchall()
+    users = repositorio(conn).usuarios()
     conn.close()
-    rows = ''
+    rows = []
     for u in users:
         inactive = 'row-inactive' if not u['activo'] else ''
         role_badge = '<span class="badge badge-admin">ADMIN</span>' if u['rol'] == 'admin' else ('<span class="badge badge-warning">LECTOR</span>' if u['rol'] == 'lector' else '<span class="badge badge-info">OPERADOR</span>')
@@ -1424,7 +3042,8 @@ def usuarios():
             action = f'<form method="POST" action="/usuario/toggle/{u["id"]}" style="display:inline"><button type="submit" class="btn btn-sm {btn_class}">{btn}</button></form>'
         else:
             action = '<small class="text-muted">(Usted)</small>'
-        rows += f'<tr class="{inactive}"><td>{u["id"]}</td><td><strong>{u["username"]}</strong></td><td>{u["nombre"]}</td><td>{role_badge}</td><td>{status_badge}</td><td>{action}</td></tr>'
+        rows.append(f'<tr class="{inactive}"><td>{u["id"]}</td><td><strong>{esc(u["username"])}</strong></td><td>{esc(u["nombre"])}</td><td>{role_badge}</td><td>{status_badge}</td><td>{action}</td></tr>')
+    rows = ''.join(rows)
 
     content = f'''<div class="page-header"><h2>🔑 Gestión de Usuarios</h2></div>
     <div class="card"><h3>Crear Usuario</h3>
@@ -1454,12 +3073,10 @@ def nuevo_usuario():
         flash('Usuario y contraseña son obligatorios', 'danger')
         return redirect('/usuarios')
     conn = get_db()
-    try:
-        conn.execute("INSERT INTO usuarios (username, password_hash, nombre, rol) VALUES (?,?,?,?)",
-            (username, generate_password_hash(password), nombre, rol))
+    if repositorio(conn).crear_usuario(username, generate_password_hash(password), nombre, rol):
         conn.commit()
         flash(f'Usuario {username} creado', 'success')
-    except sqlite3.IntegrityError:
+    else:
         flash('Ya existe ese nombre de usuario', 'warning')
     conn.close()
     return redirect('/usuarios')
@@ -1471,9 +3088,7 @@ def toggle_usuario(user_id):
         flash('No puede desactivar su propia cuenta', 'danger')
         return redirect('/usuarios')
     conn = get_db()
-    user = conn.execute("SELECT * FROM usuarios WHERE id=?", (user_id,)).fetchone()
-    if user:
-        conn.execute("UPDATE usuarios SET activo=? WHERE id=?", (0 if user['activo'] else 1, user_id))
+    if repositorio(conn).alternar_usuario(user_id):
         conn.commit()
     conn.close()
     return redirect('/usuarios')
@@ -1483,12 +3098,49 @@ def toggle_usuario(user_id):
 # ==============================================================================
 @app.route('/reportes')
 @login_required
+@cacheado()
 def reportes():
-    conn = get_db()
     year = int(request.args.get('year', datetime.now().year))
     month = int(request.args.get('month', datetime.now().month))
+    with conexion_periodo(year) as (conn, citas_t):
+        stats, by_prof = _datos_reportes(conn, citas_t, year, month)
+    flash_msgs = session.pop('_flashes', [])
+    return page('Reportes - Sistema de Citas', _reportes_html(year, month, stats, by_prof), flash_msgs)
+
+@app.route('/reportes/sedes')
+@admin_required
+def reportes_sedes():
+    """Month summary for every site, one read connection per site DB"""
+    year = int(request.args.get('year', datetime.now().year))
+    month = int(request.args.get('month', datetime.now().month))
+    filas = []
+    for sede in SEDES_REGISTRO.values():
+        with con_sede(sede), conexion_periodo(year) as (conn, citas_t):
+            stats, _ = _datos_reportes(conn, citas_t, year, month)
+        filas.append((sede.nombre, {k: stats[k] or 0 for k in stats.keys()}))
+    totales = {k: sum(f[k] for _, f in filas) for k in filas[0][1]}
+    month_opts = ''.join([f'<option value="{i}" {"selected" if i==month else ""}>{MESES_ES[i]}</option>' for i in range(1, 13)])
+
+    def fila(nombre, f, etiqueta='td'):
+        pct = round(f['confirmados'] / f['total'] * 100, 1) if f['total'] else 0
+        celdas = [esc(nombre), f['total'], f['confirmados'], f['disponibles'], f['asistieron'], f['no_asistieron'],
+                  f['nuevos'], f['continuadores'], f'{pct}%']
+        return '<tr>' + ''.join(f'<{etiqueta}>{c}</{etiqueta}>' for c in celdas) + '</tr>'
 
-    stats = conn.execute("""SELECT COUNT(*) as total,
+    content = f'''<div class="page-header"><h2>🏥 Resumen por Sede - {MESES_ES[month]} {year}</h2></div>
+    <div class="card" style="padding:1rem"><form method="GET" class="filter-row">
+        <div class="filter-group"><label>Año</label><input type="number" name="year" value="{year}" class="form-input" min="2024" max="2030"></div>
+        <div class="filter-group"><label>Mes</label><select name="month" class="form-select">{month_opts}</select></div>
+        <div class="filter-group" style="align-self:flex-end"><button type="submit" class="btn btn-primary">🔍 Consultar</button></div>
+    </form></div>
+    <div class="card"><div class="table-wrapper"><table class="citas-table"><thead><tr>
+        <th>Sede</th><th>Cupos</th><th>Confirmados</th><th>Disponibles</th><th>Asistieron</th><th>No asistieron</th><th>Nuevos</th><th>Continuadores</th><th>% Ocupación</th>
+    </tr></thead><tbody>{''.join(fila(n, f) for n, f in filas)}{fila('TOTAL', totales, 'th')}</tbody></table></div></div>'''
+    flash_msgs = session.pop('_flashes', [])
+    return page('Sedes - Sistema de Citas', content, flash_msgs)
+
+def _datos_reportes(conn, citas_t, year, month):
+    stats = conn.execute(f"""SELECT COUNT(*) as total,
         SUM(CASE WHEN estado='Confirmado' THEN 1 ELSE 0 END) as confirmados,
         SUM(CASE WHEN estado='Disponible' THEN 1 ELSE 0 END) as disponibles,
         SUM(CASE WHEN asistencia='Asistió' THEN 1 ELSE 0 END) as asistieron,
@@ -1496,10 +3148,10 @@ def reportes():
         SUM(CASE WHEN tipo_paciente='NUEVO' THEN 1 ELSE 0 END) as nuevos,
         SUM(CASE WHEN tipo_paciente='CONTINUADOR' THEN 1 ELSE 0 END) as continuadores,
         SUM(CASE WHEN sihce=1 THEN 1 ELSE 0 END) as sihce_total
-        FROM citas WHERE strftime('%Y',fecha)=? AND strftime('%m',fecha)=? AND turno!='ADMINISTRATIVA'""",
+        FROM {citas_t} WHERE strftime('%Y',fecha)=? AND strftime('%m',fecha)=? AND turno!='ADMINISTRATIVA'""",
         (str(year), f"{month:02d}")).fetchone()
 
-    by_prof = conn.execute("""SELECT p.nombre, p.color_bg, p.color_font, p.especialidad,
+    by_prof = conn.execute(f"""SELECT p.nombre, p.color_bg, p.color_font, p.especialidad,
         COUNT(*) as total,
         SUM(CASE WHEN c.estado='Confirmado' THEN 1 ELSE 0 END) as confirmados,
         SUM(CASE WHEN c.asistencia='Asistió' THEN 1 ELSE 0 END) as asistieron,
@@ -1507,11 +3159,17 @@ def reportes():
         SUM(CASE WHEN c.tipo_paciente='NUEVO' THEN 1 ELSE 0 END) as nuevos,
         SUM(CASE WHEN c.tipo_paciente='CONTINUADOR' THEN 1 ELSE 0 END) as continuadores,
         SUM(CASE WHEN c.sihce=1 THEN 1 ELSE 0 END) as sihce_count
-        FROM citas c JOIN profesionales p ON p.id=c.profesional_id
+        FROM {citas_t} c JOIN profesionales p ON p.id=c.profesional_id
         WHERE strftime('%Y',c.fecha)=? AND strftime('%m',c.fecha)=? AND c.turno!='ADMINISTRATIVA'
         GROUP BY p.id ORDER BY p.orden""", (str(year), f"{month:02d}")).fetchall()
-    conn.close()
+    return stats, by_prof
 
+_REP_FILA = plantilla('<tr><td><span class="prof-chip" style="background:{bg};color:{fg}">{nombre}</span></td>'
+    '<td>{esp}</td><td><strong>{total}</strong></td><td>{conf}</td><td class="text-success">{asis}</td><td class="text-danger">{no_asis}</td>'
+    '<td>{nuevos}</td><td>{cont}</td><td>{sihce}</td>'
+    '<td><div class="progress-bar"><div class="progress-fill" style="width:{pct}%"></div></div><small>{pct}%</small></td></tr>')
+
+def _reportes_html(year, month, stats, by_prof):
     month_opts = ''.join([f'<option value="{i}" {"selected" if i==month else ""}>{MESES_ES[i]}</option>' for i in range(1, 13)])
 
     total = stats['total'] or 0
@@ -1529,14 +3187,12 @@ def reportes():
         <div class="stat-card stat-rate"><div class="stat-number">{ocupacion}%</div><div class="stat-label">Ocupación</div></div>
     </div>'''
 
-    prof_rows = ''
-    for p in by_prof:
-        pct = round((p['confirmados'] or 0) / p['total'] * 100, 1) if p['total'] else 0
-        prof_rows += f'''<tr><td><span class="prof-chip" style="background:{p['color_bg']};color:{p['color_font']}">{p['nombre']}</span></td>
-            <td>{p['especialidad']}</td><td><strong>{p['total']}</strong></td><td>{p['confirmados'] or 0}</td>
-            <td class="text-success">{p['asistieron'] or 0}</td><td class="text-danger">{p['no_asistieron'] or 0}</td>
-            <td>{p['nuevos'] or 0}</td><td>{p['continuadores'] or 0}</td><td>{p['sihce_count'] or 0}</td>
-            <td><div class="progress-bar"><div class="progress-fill" style="width:{pct}%"></div></div><small>{pct}%</small></td></tr>'''
+    prof_rows = ''.join(_REP_FILA(bg=p['color_bg'], fg=p['color_font'], nombre=p['nombre'], esp=p['especialidad'],
+                                  total=p['total'], conf=p['confirmados'] or 0, asis=p['asistieron'] or 0,
+                                  no_asis=p['no_asistieron'] or 0, nuevos=p['nuevos'] or 0, cont=p['continuadores'] or 0,
+                                  sihce=p['sihce_count'] or 0,
+                                  pct=round((p['confirmados'] or 0) / p['total'] * 100, 1) if p['total'] else 0)
+                        for p in by_prof)
 
     content = f'''<div class="page-header"><h2>📊 Reportes y Estadísticas</h2></div>
     <div class="card" style="padding:1rem"><form method="GET" class="filter-row">
@@ -1548,8 +3204,177 @@ def reportes():
     <div class="card"><h3>📋 Por Profesional</h3><div class="table-wrapper"><table class="citas-table"><thead><tr>
         <th>Profesional</th><th>Especialidad</th><th>Cupos</th><th>Confirmados</th><th>Asistieron</th><th>No asistieron</th><th>Nuevos</th><th>Continuadores</th><th>SIHCE</th><th>% Ocupación</th>
     </tr></thead><tbody>{prof_rows}</tbody></table></div></div>'''
+    return content
+
+# ==============================================================================
+# TENDENCIAS - resumen diario precalculado por profesional y turno
+# ==============================================================================
+# Los triggers de citas anotan en resumen_pendiente cada día que cambia; el
+# mantenimiento (o `flask stats rebuild`) recalcula solo esos días. Las vistas
+# leen el resumen tal como está y muestran cuándo se actualizó.
+_SQL_RESUMEN = """INSERT OR REPLACE INTO resumen_diario
+    (fecha, profesional_id, turno, slots, confirmados, asistieron, no_asistieron, nuevos, continuadores)
+    SELECT fecha, profesional_id, turno, COUNT(*), SUM(estado='Confirmado'), SUM(asistencia='Asistió'),
+        SUM(asistencia='No asistió'), SUM(tipo_paciente='NUEVO'), SUM(tipo_paciente='CONTINUADOR')
+    FROM {citas_t} WHERE turno!='ADMINISTRATIVA' AND {filtro}
+    GROUP BY fecha, profesional_id, turno"""
+
+def refrescar_resumen(conn):
+    """Recompute the rollup for every pending day; commits unless the caller holds a transaction.
+
+    Bumps the data version so cached /tendencias pages pick up the new numbers.
+    """
+    propia = not conn.in_transaction
+    if propia:
+        if not conn.execute("SELECT 1 FROM resumen_pendiente LIMIT 1").fetchone(): return 0
+        conn.execute("BEGIN IMMEDIATE")
+    try:
+        n = conn.execute("SELECT COUNT(*) FROM resumen_pendiente").fetchone()[0]
+        if n:
+            conn.execute("DELETE FROM resumen_diario WHERE fecha IN (SELECT fecha FROM resumen_pendiente)")
+            conn.execute(_SQL_RESUMEN.format(citas_t='main.citas', filtro='fecha IN (SELECT fecha FROM resumen_pendiente)'))
+            conn.execute("DELETE FROM resumen_pendiente")
+            marcar_cambio(conn)
+        if propia: conn.commit()
+    except Exception:
+        if propia: conn.rollback()
+        raise
+    return n
+
+def reconstruir_resumen(conn):
+    """Rebuild the whole rollup, archived years included; returns the row count"""
+    conn.execute("BEGIN IMMEDIATE")
+    conn.execute("DELETE FROM resumen_diario")
+    conn.execute("DELETE FROM resumen_pendiente")
+    conn.execute(_SQL_RESUMEN.format(citas_t='main.citas', filtro='1'))
+    conn.commit()
+    patron = re.compile(re.escape(sede_actual().prefijo) + r'citas_(\d{4})\.db')
+    for nombre in sorted(os.listdir(ARCHIVO_DIR)) if os.path.isdir(ARCHIVO_DIR) else []:
+        m = patron.fullmatch(nombre)
+        if not m: continue
+        conn.execute("ATTACH DATABASE ? AS arch", (f'file:{ruta_archivo(int(m.group(1)))}?mode=ro',))
+        try:
+            conn.execute(_SQL_RESUMEN.format(citas_t='arch.citas', filtro='1'))
+            conn.commit()
+        finally:
+            conn.execute("DETACH DATABASE arch")
+    return conn.execute("SELECT COUNT(*) FROM resumen_diario").fetchone()[0]
+
+TENDENCIAS_POR = OrderedDict([
+    ('profesional', ('Profesional', 'p.nombre')),
+    ('especialidad', ('Especialidad', 'p.especialidad')),
+    ('turno', ('Turno', 'r.turno')),
+    ('dia_semana', ('Día de la semana', "(CAST(strftime('%w', r.fecha) AS INTEGER) + 6) % 7")),
+])
+TENDENCIAS_PERIODO = OrderedDict([
+    ('mes', ('Mes', "strftime('%Y-%m', r.fecha)")),
+    ('semana', ('Semana', "strftime('%Y-S%W', r.fecha)")),
+    ('dia', ('Día', 'r.fecha')),
+])
+TENDENCIAS_COLUMNAS_MAX = 60
+
+def _consulta_tendencias():
+    """Validate the request args; return (desde, hasta, por, agrupar) or an error string"""
+    hoy = datetime.now().date()
+    anio, mes = (hoy.year, hoy.month - 11) if hoy.month > 11 else (hoy.year - 1, hoy.month + 1)
+    desde = _fecha_param('desde', hoy.replace(year=anio, month=mes, day=1))
+    hasta = _fecha_param('hasta', hoy)
+    if hasta < desde: return 'hasta es anterior a desde'
+    por = request.args.get('por', 'profesional')
+    agrupar = request.args.get('agrupar', 'mes')
+    if por not in TENDENCIAS_POR: return f'por debe ser uno de: {", ".join(TENDENCIAS_POR)}'
+    if agrupar not in TENDENCIAS_PERIODO: return f'agrupar debe ser uno de: {", ".join(TENDENCIAS_PERIODO)}'
+    return desde, hasta, por, agrupar
+
+def _datos_tendencias(desde, hasta, por, agrupar):
+    """(series, estado): one dict per (periodo, grupo) with counts and rates, plus the rollup's freshness"""
+    conn = get_db_lectura()
+    try:
+        estado = {'actualizado': (conn.execute("SELECT fin FROM mantenimiento WHERE tarea='resumen' AND ok=1").fetchone() or [None])[0],
+                  'pendientes': conn.execute("SELECT COUNT(*) FROM resumen_pendiente").fetchone()[0]}
+        rows = conn.execute(f"""SELECT {TENDENCIAS_PERIODO[agrupar][1]} AS periodo, {TENDENCIAS_POR[por][1]} AS grupo,
+            SUM(r.slots) AS slots, SUM(r.confirmados) AS confirmados, SUM(r.asistieron) AS asistieron,
+            SUM(r.no_asistieron) AS no_asistieron, SUM(r.nuevos) AS nuevos, SUM(r.continuadores) AS continuadores
+            FROM resumen_diario r JOIN profesionales p ON p.id=r.profesional_id
+            WHERE r.fecha BETWEEN ? AND ? GROUP BY periodo, grupo ORDER BY periodo, {'MIN(p.orden)' if por == 'profesional' else 'grupo'}""",
+            (desde.isoformat(), hasta.isoformat())).fetchall()
+    finally:
+        conn.close()
+    return [_tasas({'periodo': r['periodo'], 'grupo': DIAS_ES[r['grupo']] if por == 'dia_semana' else r['grupo'],
+                    **{k: r[k] for k in ('slots', 'confirmados', 'asistieron', 'no_asistieron', 'nuevos', 'continuadores')}})
+            for r in rows], estado
+
+def _tasas(d):
+    d['ocupacion'] = round(d['confirmados'] / d['slots'] * 100, 1) if d['slots'] else 0
+    atendidas = d['asistieron'] + d['no_asistieron']
+    d['inasistencia'] = round(d['no_asistieron'] / atendidas * 100, 1) if atendidas else 0
+    return d
+
+@app.route('/api/tendencias')
+@login_required
+@cacheado(por_usuario=False)
+def api_tendencias():
+    consulta = _consulta_tendencias()
+    if isinstance(consulta, str): return jsonify({'error': consulta}), 400
+    desde, hasta, por, agrupar = consulta
+    series, estado = _datos_tendencias(desde, hasta, por, agrupar)
+    return jsonify({'desde': desde.isoformat(), 'hasta': hasta.isoformat(), 'por': por, 'agrupar': agrupar,
+                    **estado, 'series': series})
+
+_TEND_CELDA = plantilla('<td style="background:rgba({rgb},{alfa})" title="{detalle}">{pct}%</td>')
+
+def _tabla_tendencias(titulo, filas, periodos, metrica, rgb):
+    grupos = OrderedDict()
+    for f in filas: grupos.setdefault(f['grupo'], {})[f['periodo']] = f
+    cuerpo = ''
+    for grupo, por_periodo in grupos.items():
+        celdas = ''
+        for p in periodos:
+            f = por_periodo.get(p)
+            celdas += _TEND_CELDA(rgb=rgb, alfa=round(f[metrica] / 100, 2), pct=f[metrica],
+                                  detalle=f"{f['confirmados']}/{f['slots']} cupos · {f['asistieron']} asistieron · {f['no_asistieron']} no asistieron") if f else '<td>—</td>'
+        total = _tasas({k: sum(f[k] for f in por_periodo.values()) for k in ('slots', 'confirmados', 'asistieron', 'no_asistieron')})
+        cuerpo += f'<tr><td><strong>{esc(grupo)}</strong></td>{celdas}<th>{total[metrica]}%</th></tr>'
+    encabezado = ''.join(f'<th>{esc(p)}</th>' for p in periodos)
+    return f'''<div class="card"><h3>{titulo}</h3><div class="table-wrapper"><table class="citas-table">
+        <thead><tr><th></th>{encabezado}<th>Total</th></tr></thead><tbody>{cuerpo}</tbody></table></div></div>'''
+
+@app.route('/tendencias')
+@login_required
+@cacheado()
+def tendencias():
+    consulta = _consulta_tendencias()
+    if isinstance(consulta, str):
+        flash(consulta, 'warning')
+        return redirect('/tendencias')
+    desde, hasta, por, agrupar = consulta
+    filas, estado = _datos_tendencias(desde, hasta, por, agrupar)
+    periodos = sorted({f['periodo'] for f in filas})
+    por_opts = ''.join(f'<option value="{k}" {"selected" if k == por else ""}>{t}</option>' for k, (t, _) in TENDENCIAS_POR.items())
+    agr_opts = ''.join(f'<option value="{k}" {"selected" if k == agrupar else ""}>{t}</option>' for k, (t, _) in TENDENCIAS_PERIODO.items())
+    if not filas:
+        tablas = '<div class="empty-state"><p>No hay cupos en ese rango.</p></div>'
+    elif len(periodos) > TENDENCIAS_COLUMNAS_MAX:
+        tablas = f'<div class="empty-state"><p>{len(periodos)} columnas: elija un rango más corto o agrupe por semana o mes.</p></div>'
+    else:
+        tablas = (_tabla_tendencias('📈 Ocupación (confirmados / cupos)', filas, periodos, 'ocupacion', '46,125,50') +
+                  _tabla_tendencias('❌ Inasistencia (no asistieron / asistencias marcadas)', filas, periodos, 'inasistencia', '198,40,40'))
+    api = esc(f'/api/tendencias?desde={desde}&hasta={hasta}&por={por}&agrupar={agrupar}')
+    al_dia = f'Resumen actualizado: {estado["actualizado"] or "—"}'
+    if estado['pendientes']: al_dia += f' · {estado["pendientes"]} día(s) con cambios por recalcular en el próximo mantenimiento'
+    content = f'''<div class="page-header"><h2>📈 Tendencias</h2>
+        <p class="text-muted" style="font-size:.9rem">{al_dia}</p></div>
+    <div class="card" style="padding:1rem"><form method="GET" class="filter-row">
+        <div class="filter-group"><label>Desde</label><input type="date" name="desde" value="{desde}" class="form-input"></div>
+        <div class="filter-group"><label>Hasta</label><input type="date" name="hasta" value="{hasta}" class="form-input"></div>
+        <div class="filter-group"><label>Por</label><select name="por" class="form-select">{por_opts}</select></div>
+        <div class="filter-group"><label>Agrupar</label><select name="agrupar" class="form-select">{agr_opts}</select></div>
+        <div class="filter-group" style="align-self:flex-end"><button type="submit" class="btn btn-primary">🔍 Consultar</button></div>
+        <div class="filter-group" style="align-self:flex-end"><a href="{api}" class="btn btn-secondary">{{ }} JSON</a></div>
+    </form></div>
+    {tablas}'''
     flash_msgs = session.pop('_flashes', [])
-    return page('Reportes - Sistema de Citas', content, flash_msgs)
+    return page('Tendencias - Sistema de Citas', content, flash_msgs)
 
 # ==============================================================================
 # EXPORTAR EXCEL - CON COLORES Y FORMULARIO
@@ -1558,6 +3383,11 @@ def reportes():
 @login_required
 def exportar_form():
     month_opts = ''.join([f'<option value="{i}" {"selected" if i==datetime.now().month else ""}>{MESES_ES[i]}</option>' for i in range(1, 13)])
+    hoy = datetime.now().date()
+    conn = get_db_lectura()
+    prof_opts = ''.join(_OPCION_PROF(id=p['id'], sel_html='', nombre=p['nombre'], esp=p['especialidad'])
+                        for p in repositorio(conn).profesionales(activos=True))
+    conn.close()
     content = f'''<div class="page-header"><h2>📥 Exportar a Excel</h2></div>
     <div class="card">
         <form method="GET" action="/exportar">
@@ -1567,36 +3397,58 @@ def exportar_form():
             </div>
             <div class="form-actions"><button type="submit" class="btn btn-success btn-lg">📥 Descargar Excel</button></div>
         </form>
+    </div>
+    <div class="card">
+        <h3>📊 Datos para análisis (CSV / NDJSON)</h3>
+        <form method="GET" action="/exportar.csv">
+            <div class="form-row">
+                <div class="form-group"><label>Desde</label><input type="date" name="desde" value="{hoy.replace(day=1)}" class="form-input"></div>
+                <div class="form-group"><label>Hasta</label><input type="date" name="hasta" value="{hoy.replace(day=calendar.monthrange(hoy.year, hoy.month)[1])}" class="form-input"></div>
+                <div class="form-group"><label>Profesional</label><select name="prof_id" class="form-select"><option value="">Todos</option>{prof_opts}</select></div>
+                <div class="form-group"><label>Estado</label><select name="estado" class="form-select"><option value="">Todos</option><option>Confirmado</option><option>Disponible</option></select></div>
+            </div>
+            <div class="form-actions">
+                <button type="submit" class="btn btn-primary">⬇️ CSV</button>
+                <button type="submit" formaction="/exportar.ndjson" class="btn btn-secondary">⬇️ NDJSON</button>
+            </div>
+        </form>
     </div>'''
     flash_msgs = session.pop('_flashes', [])
     return page('Exportar Excel - Sistema de Citas', content, flash_msgs)
 
-@app.route('/exportar')
-@login_required
-def exportar_excel():
-    year = int(request.args.get('year', datetime.now().year))
-    month = int(request.args.get('month', datetime.now().month))
-    conn = get_db()
-    rows = conn.execute("""SELECT c.fecha, c.turno, c.area, p.nombre as profesional,
+_SQL_EXPORTAR = """SELECT c.fecha, c.turno, c.area, p.nombre as profesional,
         c.hora_inicio, c.hora_fin, c.paciente, c.dni, c.edad, c.celular, c.observaciones, c.estado,
         c.tipo_paciente, c.actividad_app, c.asistencia, c.sihce, c.sihce_prof_id, p.color_bg, p.color_font,
         u.nombre as registrado_por
-        FROM citas c JOIN profesionales p ON p.id=c.profesional_id
+        FROM {citas_t} c JOIN profesionales p ON p.id=c.profesional_id
         LEFT JOIN usuarios u ON u.id=c.creado_por
-        WHERE strftime('%Y',c.fecha)=? AND strftime('%m',c.fecha)=?
-        ORDER BY c.fecha, CASE c.turno WHEN 'MAÑANA' THEN 1 WHEN 'TARDE' THEN 2 WHEN 'ADMINISTRATIVA' THEN 3 END, p.orden, c.hora_inicio""",
-        (str(year), f"{month:02d}")).fetchall()
-    conn.close()
+        WHERE c.fecha BETWEEN ? AND ?
+        ORDER BY c.fecha, CASE c.turno WHEN 'MAÑANA' THEN 1 WHEN 'TARDE' THEN 2 WHEN 'ADMINISTRATIVA' THEN 3 END, p.orden, c.hora_inicio"""
 
+@app.route('/exportar')
+@login_required
+def exportar_excel():
+    year = int(request.args.get('year', datetime.now().year))
+    month = int(request.args.get('month', datetime.now().month))
+    desde, hasta = f'{year}-{month:02d}-01', f'{year}-{month:02d}-{calendar.monthrange(year, month)[1]:02d}'
     output = io.BytesIO()
     wb = xlsxwriter.Workbook(output, {'in_memory': True})
+    with conexion_periodo(year) as (conn, citas_t):
+        rows = conn.execute(_SQL_EXPORTAR.format(citas_t=citas_t), (desde, hasta)).fetchall()
+    _escribir_agenda(wb, rows, f'AGENDA DE CITAS - {MESES_ES[month].upper()} {year}')
+    wb.close(); output.seek(0)
+    filename = f"Agenda_{MESES_ES[month]}_{year}.xlsx"
+    return send_file(output, download_name=filename, as_attachment=True, mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
+
+def _escribir_agenda(wb, rows, titulo, progreso=None):
+    """Write the AGENDA sheet; rows are written strictly top to bottom so constant_memory works"""
     ws = wb.add_worksheet('AGENDA')
     fmt_h = wb.add_format({'bold': True, 'bg_color': '#1a365d', 'font_color': 'white', 'border': 1, 'align': 'center', 'valign': 'vcenter', 'font_size': 10})
     fmt_title = wb.add_format({'bold': True, 'font_size': 14, 'align': 'center', 'valign': 'vcenter'})
     fmt_sep = wb.add_format({'bold': True, 'bg_color': '#f1f5f9', 'font_size': 11, 'border': 1, 'align': 'left', 'valign': 'vcenter'})
 
     # Title
-    ws.merge_range(0, 0, 0, 16, f'AGENDA DE CITAS - {MESES_ES[month].upper()} {year}', fmt_title)
+    ws.merge_range(0, 0, 0, 16, titulo, fmt_title)
 
     headers = ['FECHA', 'DÍA', 'TURNO', 'ÁREA', 'PROFESIONAL', 'HORA', 'PACIENTE', 'DNI', 'EDAD', 'CELULAR', 'OBSERVACIONES', 'ESTADO', 'TIPO', 'APP', 'ASISTENCIA', 'SIHCE', 'REGISTRADO POR']
     for i, h in enumerate(headers): ws.write(2, i, h, fmt_h)
@@ -1607,6 +3459,7 @@ def exportar_excel():
 
     fmt_cache = {}
     r = 3
+    n = 0
     prev_date = ''; prev_turno = ''
     for row in rows:
         row = dict(row)
@@ -1653,15 +3506,863 @@ def exportar_excel():
         ws.write(r, 15, 'SIHCE' if row['sihce'] else '', fc)
         ws.write(r, 16, row.get('registrado_por', '') or '', fl)
         r += 1
+        n += 1
+        if progreso and n % 5000 == 0: progreso(n)
+    return n
 
-    wb.close(); output.seek(0)
-    filename = f"Agenda_{MESES_ES[month]}_{year}.xlsx"
-    return send_file(output, download_name=filename, as_attachment=True, mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
+# Columnas de /exportar.csv y /exportar.ndjson: nombre público → expresión SQL
+COLUMNAS_DATOS = OrderedDict([
+    ('id', 'c.id'), ('fecha', 'c.fecha'), ('turno', 'c.turno'), ('area', 'c.area'),
+    ('profesional_id', 'c.profesional_id'), ('profesional', 'p.nombre'),
+    ('hora_inicio', 'c.hora_inicio'), ('hora_fin', 'c.hora_fin'),
+    ('paciente', 'c.paciente'), ('dni', 'c.dni'), ('edad', 'c.edad'), ('celular', 'c.celular'),
+    ('observaciones', 'c.observaciones'), ('estado', 'c.estado'), ('tipo_paciente', 'c.tipo_paciente'),
+    ('actividad_app', 'c.actividad_app'), ('asistencia', 'c.asistencia'), ('sihce', 'c.sihce'),
+    ('registrado_por', 'u.nombre'),
+])
+# Filtros: parámetro → columna; cada uno acepta varios valores (?estado=Confirmado&estado=Disponible)
+FILTROS_DATOS = {'prof_id': 'c.profesional_id', 'area': 'c.area', 'estado': 'c.estado', 'asistencia': 'c.asistencia'}
+EXPORTAR_LOTE = 1000  # filas por fetchmany en la exportación de datos
+
+def _consulta_datos(formato):
+    """Validate the request args; return (columns, sql template, params, desde, hasta) or an error string"""
+    hoy = datetime.now().date()
+    desde = _fecha_param('desde', hoy.replace(day=1))
+    hasta = _fecha_param('hasta', hoy.replace(day=calendar.monthrange(hoy.year, hoy.month)[1]))
+    if hasta < desde: return 'hasta es anterior a desde'
+    columnas = [c for v in request.args.getlist('columnas') for c in v.split(',') if c] or list(COLUMNAS_DATOS)
+    desconocidas = [c for c in columnas if c not in COLUMNAS_DATOS]
+    if desconocidas: return f'Columnas desconocidas: {", ".join(desconocidas)}'
+    if formato == 'ndjson':
+        # SQLite arma cada objeto JSON: Python solo concatena texto
+        select = 'json_object(' + ', '.join(f"'{c}', {COLUMNAS_DATOS[c]}" for c in columnas) + ')'
+    else:
+        select = ', '.join(COLUMNAS_DATOS[c] for c in columnas)
+    where = ['c.fecha BETWEEN ? AND ?']; params = []
+    for arg, col in FILTROS_DATOS.items():
+        valores = [v for v in request.args.getlist(arg) if v]
+        if valores:
+            where.append(f"{col} IN ({','.join('?' * len(valores))})"); params += valores
+    sql = (f"""SELECT {select} FROM {{citas_t}} c JOIN profesionales p ON p.id=c.profesional_id
+        LEFT JOIN usuarios u ON u.id=c.creado_por WHERE {' AND '.join(where)}
+        ORDER BY c.fecha, p.orden, c.turno, c.hora_inicio""")
+    return columnas, sql, params, desde, hasta
+
+def _filas_datos(sql, params, desde, hasta, formato, columnas):
+    """Yield text chunks straight from the cursor, one year (main or archive) at a time"""
+    if formato == 'csv':
+        buf = io.StringIO(); w = csv.writer(buf, lineterminator='\n')
+        w.writerow(columnas)
+    for anio in range(desde.year, hasta.year + 1):
+        d = max(desde, desde.replace(year=anio, month=1, day=1)).isoformat()
+        h = min(hasta, hasta.replace(year=anio, month=12, day=31)).isoformat()
+        with conexion_periodo(anio) as (conn, citas_t):
+            cur = conn.cursor()
+            cur.row_factory = None  # tuplas simples, sin sqlite3.Row por fila
+            cur.execute(sql.format(citas_t=citas_t), [d, h] + params)
+            while True:
+                lote = cur.fetchmany(EXPORTAR_LOTE)
+                if not lote: break
+                if formato == 'csv':
+                    w.writerows(lote)
+                    yield buf.getvalue(); buf.seek(0); buf.truncate()
+                else:
+                    yield '\n'.join(fila[0] for fila in lote) + '\n'
+    if formato == 'csv' and buf.tell(): yield buf.getvalue()
+
+@app.route('/exportar.<any(csv, ndjson):formato>')
+@login_required
+def exportar_datos(formato):
+    consulta = _consulta_datos(formato)
+    if isinstance(consulta, str): return jsonify({'error': consulta}), 400
+    columnas, sql, params, desde, hasta = consulta
+    gen = _filas_datos(sql, params, desde, hasta, formato, columnas)
+    mimetype = 'text/csv' if formato == 'csv' else 'application/x-ndjson'
+    resp = Response(stream_with_context(gen), mimetype=mimetype)
+    resp.headers['Content-Disposition'] = f'attachment; filename=citas_{desde}_{hasta}.{formato}'
+    return resp
+
+# ==============================================================================
+# IMPORTACIÓN MASIVA - pacientes desde CSV/XLSX a cupos ya generados
+# ==============================================================================
+IMPORTAR_MAX_FILAS = 5000
+# Encabezado normalizado (minúsculas, sin tildes) → campo. Acepta también el Excel que exporta el sistema.
+_IMP_CAMPOS = {
+    'profesional': 'profesional', 'profesional_id': 'profesional', 'prof_id': 'profesional',
+    'fecha': 'fecha', 'hora': 'hora', 'hora_inicio': 'hora',
+    'paciente': 'paciente', 'dni': 'dni', 'edad': 'edad', 'celular': 'celular',
+    'observaciones': 'observaciones', 'tipo': 'tipo_paciente', 'tipo_paciente': 'tipo_paciente',
+    'app': 'actividad_app', 'actividad_app': 'actividad_app',
+}
+_IMP_OBLIGATORIOS = ('profesional', 'fecha', 'hora', 'paciente')
+_IMP_FILA = plantilla('<tr><td>{n}</td><td>{prof}</td><td>{fecha}</td><td>{hora}</td><td><strong>{paciente}</strong></td><td>{dni}</td><td>{tipo}</td></tr>')
+_IMP_ERROR = plantilla('<tr><td>{n}</td><td>{detalle}</td></tr>')
+
+def _normalizar(texto):
+    texto = unicodedata.normalize('NFKD', str(texto).strip().lower())
+    return ''.join(ch for ch in texto if not unicodedata.combining(ch)).replace(' ', '_')
+
+def _celda_texto(v):
+    if v is None: return ''
+    if isinstance(v, datetime): return v.strftime('%Y-%m-%d')
+    if isinstance(v, dtime): return v.strftime('%H:%M')
+    if isinstance(v, float) and v.is_integer(): return str(int(v))
+    return str(v).strip()
+
+def _leer_planilla(archivo):
+    """Yield each row of an uploaded .csv/.xlsx as a list of strings, without loading the whole sheet"""
+    nombre = (archivo.filename or '').lower()
+    if nombre.endswith('.xlsx'):
+        # Un .xlsx dañado o renombrado falla dentro del zip o del XML de la hoja, al abrir o al leer
+        try:
+            wb = openpyxl.load_workbook(archivo.stream, read_only=True, data_only=True)
+        except (zipfile.BadZipFile, InvalidFileException, KeyError, OSError, SyntaxError):
+            raise ValueError('No se pudo leer el archivo .xlsx') from None
+        try:
+            for fila in wb.active.iter_rows(values_only=True):
+                yield [_celda_texto(v) for v in fila]
+        except (zipfile.BadZipFile, KeyError, OSError, SyntaxError):
+            raise ValueError('No se pudo leer el archivo .xlsx') from None
+        finally:
+            wb.close()
+    elif nombre.endswith(('.csv', '.txt')):
+        # Excel en Windows guarda CSV en cp1252 y con ';' como separador
+        muestra = archivo.stream.read(65536); archivo.stream.seek(0)
+        try: muestra.decode('utf-8'); codificacion = 'utf-8-sig'
+        except UnicodeDecodeError as e: codificacion = 'utf-8-sig' if e.start > len(muestra) - 4 else 'cp1252'
+        texto = io.TextIOWrapper(archivo.stream, encoding=codificacion, errors='replace', newline='')
+        primera = texto.readline()
+        sep = ';' if primera.count(';') > primera.count(',') else ','
+        for fila in csv.reader(itertools.chain([primera], texto), delimiter=sep):
+            yield [v.strip() for v in fila]
+    else:
+        raise ValueError('Formato no soportado: use .csv o .xlsx')
+
+def _imp_fecha(valor):
+    for fmt in ('%Y-%m-%d', '%d/%m/%Y', '%d-%m-%Y'):
+        try: return datetime.strptime(valor, fmt).strftime('%Y-%m-%d')
+        except ValueError: pass
+    return None
+
+def _imp_hora(valor):
+    # "08:00", "8:00", "08:00:00" o el rango "08:00 - 08:20" del Excel exportado
+    m = re.match(r'(\d{1,2}):(\d{2})', valor)
+    return f'{int(m.group(1)):02d}:{m.group(2)}' if m else None
+
+def _validar_importacion(conn, filas):
+    """Dry run: match every row to a free slot by (profesional, fecha, hora_inicio).
+
+    Returns (listas, errores, omitidas). listas holds the parsed rows with
+    their cita_id; errores is [(row number, message)]. Rows without a
+    patient (free slots, separators) and patients already booked in their
+    slot are counted in omitidas.
+    """
+    filas = iter(filas)
+    errores = []; omitidas = 0
+    columnas = None
+    for n, fila in enumerate(filas, 1):
+        normal = [_normalizar(v) for v in fila]
+        if 'fecha' in normal and 'paciente' in normal:
+            columnas = {i: _IMP_CAMPOS[v] for i, v in enumerate(normal) if v in _IMP_CAMPOS}
+            break
+        if n >= 10: break
+    if columnas is None:
+        return [], [(0, 'No se encontró la fila de encabezados (debe tener al menos FECHA y PACIENTE en las primeras 10 filas)')], 0
+    faltan = [c for c in _IMP_OBLIGATORIOS if c not in columnas.values()]
+    if faltan:
+        return [], [(n, f'Faltan columnas: {", ".join(faltan).upper()}')], 0
+
+    profs = {}
+    for p in repositorio(conn).profesionales():
+        profs[p['nombre'].upper()] = p; profs[str(p['id'])] = p
+    candidatas = []
+    for n, fila in enumerate(filas, n + 1):
+        r = {campo: fila[i] if i < len(fila) else '' for i, campo in columnas.items()}
+        if not r['paciente']:
+            omitidas += 1; continue
+        if len(candidatas) + len(errores) >= IMPORTAR_MAX_FILAS:
+            errores.append((n, f'Se superó el máximo de {IMPORTAR_MAX_FILAS} filas por archivo')); break
+        prof = profs.get(r['profesional'].strip().upper())
+        fecha = _imp_fecha(r['fecha']); hora = _imp_hora(r['hora'])
+        tipo = (r.get('tipo_paciente') or 'NUEVO').upper()
+        problemas = []
+        if not prof: problemas.append(f'Profesional desconocido: {r["profesional"] or "(vacío)"}')
+        if not fecha: problemas.append(f'Fecha inválida: {r["fecha"] or "(vacía)"}')
+        if not hora: problemas.append(f'Hora inválida: {r["hora"] or "(vacía)"}')
+        if tipo not in ('NUEVO', 'CONTINUADOR'): problemas.append(f'Tipo de paciente inválido: {tipo}')
+        if problemas:
+            errores.append((n, '; '.join(problemas))); continue
+        candidatas.append({'n': n, 'prof': prof, 'fecha': fecha, 'hora': hora, 'paciente': r['paciente'].upper(),
+                           'dni': r.get('dni', ''), 'edad': r.get('edad', ''), 'celular': r.get('celular', ''),
+                           'observaciones': r.get('observaciones', ''), 'tipo_paciente': tipo,
+                           'actividad_app': r.get('actividad_app', '')})
+    if not candidatas:
+        return [], errores, omitidas
+
+    fechas = [c['fecha'] for c in candidatas]
+    pids = sorted({c['prof']['id'] for c in candidatas})
+    cupos = {(c['profesional_id'], c['fecha'], c['hora_inicio']): c for c in conn.execute(
+        f"""SELECT id, profesional_id, fecha, hora_inicio, turno, estado, paciente, dni FROM citas
+        WHERE fecha BETWEEN ? AND ? AND profesional_id IN ({','.join('?' * len(pids))})""",
+        [min(fechas), max(fechas)] + pids)}
+    listas = []; usados = {}
+    for c in candidatas:
+        cupo = cupos.get((c['prof']['id'], c['fecha'], c['hora']))
+        if not cupo:
+            errores.append((c['n'], f'No existe cupo de {c["prof"]["nombre"]} el {c["fecha"]} a las {c["hora"]} (¿falta generar el mes?)'))
+        elif cupo['turno'] == 'ADMINISTRATIVA':
+            errores.append((c['n'], f'El cupo de las {c["hora"]} es horario administrativo'))
+        elif cupo['estado'] != 'Disponible':
+            if cupo['paciente'] == c['paciente'] or (c['dni'] and cupo['dni'] == c['dni']): omitidas += 1
+            else: errores.append((c['n'], f'Cupo ocupado por {cupo["paciente"]}'))
+        elif cupo['id'] in usados:
+            errores.append((c['n'], f'Mismo cupo que la fila {usados[cupo["id"]]}'))
+        else:
+            usados[cupo['id']] = c['n']; c['cita_id'] = cupo['id']; listas.append(c)
+    errores.sort()
+    return listas, errores, omitidas
+
+def _aplicar_importacion(conn, filas, usuario_id):
+    """Book every row in one transaction; returns False (and rolls back) if any slot was taken meanwhile"""
+    conn.execute("BEGIN IMMEDIATE")
+    cur = conn.executemany("""UPDATE citas SET paciente=?, dni=?, edad=?, celular=?, observaciones=?, estado='Confirmado',
+        tipo_paciente=?, actividad_app=?, creado_por=?, modificado_por=?, modificado_en=CURRENT_TIMESTAMP
+        WHERE id=? AND estado='Disponible'""",
+        [(f['paciente'], f['dni'], f['edad'], f['celular'], f['observaciones'], f['tipo_paciente'], f['actividad_app'],
+          usuario_id, usuario_id, f['cita_id']) for f in filas])
+    if cur.rowcount != len(filas):
+        conn.rollback()
+        return False
+    conn.executemany("DELETE FROM retenciones WHERE cita_id=?", [(f['cita_id'],) for f in filas])
+    marcar_cambio(conn)
+    conn.commit()
+    auditar([(f['cita_id'], usuario_id, 'IMPORTAR', f'Paciente: {f["paciente"]} | DNI: {f["dni"]}') for f in filas])
+    return True
+
+def _firmador_importacion():
+    return URLSafeTimedSerializer(app.secret_key, salt='importar')
+
+_IMP_APLICAR = ('cita_id', 'paciente', 'dni', 'edad', 'celular', 'observaciones', 'tipo_paciente', 'actividad_app')
+
+@app.route('/importar', methods=['GET', 'POST'])
+@admin_required
+@idempotente
+def importar():
+    if request.method == 'POST' and request.form.get('lote'):
+        try:
+            lote = _firmador_importacion().loads(request.form['lote'], max_age=3600)
+        except BadSignature:
+            flash('La validación expiró; vuelva a subir el archivo', 'warning')
+            return redirect('/importar')
+        filas = [dict(zip(_IMP_APLICAR, f)) for f in lote]
+        t0 = time.perf_counter()
+        conn = get_db()
+        try:
+            ok = _aplicar_importacion(conn, filas, session['user_id'])
+        finally:
+            conn.close()
+        if ok:
+            flash(f'{len(filas)} cita(s) importadas en {time.perf_counter() - t0:.2f} s', 'success')
+        else:
+            flash('Algunos cupos se ocuparon después de validar; no se importó nada. Vuelva a subir el archivo.', 'warning')
+        return redirect('/importar')
+
+    partes = ['<div class="page-header"><h2>📤 Importar pacientes desde CSV / Excel</h2></div>']
+    if request.method == 'POST':
+        archivo = request.files.get('archivo')
+        if not archivo or not archivo.filename:
+            flash('Seleccione un archivo', 'warning')
+            return redirect('/importar')
+        t0 = time.perf_counter()
+        conn = get_db_lectura()
+        try:
+            listas, errores, omitidas = _validar_importacion(conn, _leer_planilla(archivo))
+        except ValueError as e:
+            flash(str(e), 'danger')
+            return redirect('/importar')
+        finally:
+            conn.close()
+        partes.append(f'''<div class="card" style="border:2px solid #ff8f00"><h3>📋 Validación de {esc(archivo.filename)}</h3>
+            <p><strong>{len(listas)}</strong> fila(s) listas para agendar, <strong>{len(errores)}</strong> con errores,
+            {omitidas} omitida(s) (sin paciente o ya agendadas) — {time.perf_counter() - t0:.2f} s</p>''')
+        if errores:
+            partes.append("<div class='table-wrapper'><table class='citas-table'><thead><tr><th>Fila</th><th>Error</th></tr></thead><tbody>")
+            partes.extend(_IMP_ERROR(n=n or '—', detalle=d) for n, d in errores)
+            partes.append('</tbody></table></div>')
+            partes.append('<p>Corrija la planilla y vuelva a subirla; no se importa nada mientras haya errores.</p>')
+        if listas:
+            partes.append("<div class='table-wrapper'><table class='citas-table'><thead><tr><th>Fila</th><th>Profesional</th><th>Fecha</th><th>Hora</th><th>Paciente</th><th>DNI</th><th>Tipo</th></tr></thead><tbody>")
+            partes.extend(_IMP_FILA(n=f['n'], prof=f['prof']['nombre'], fecha=f['fecha'], hora=f['hora'], paciente=f['paciente'],
+                                    dni=f['dni'], tipo=f['tipo_paciente']) for f in listas)
+            partes.append('</tbody></table></div>')
+        if listas and not errores:
+            lote = _firmador_importacion().dumps([[f[k] for k in _IMP_APLICAR] for f in listas])
+            partes.append(f'''<form method="POST" style="margin-top:1rem">
+                <input type="hidden" name="lote" value="{esc(lote)}">{idem_input()}
+                <button type="submit" class="btn btn-warning btn-lg" onclick="return confirm('¿Agendar {len(listas)} cita(s)?')">✅ Importar {len(listas)} cita(s)</button>
+                <a href="/importar" class="btn btn-secondary btn-lg">❌ Cancelar</a>
+            </form>''')
+        partes.append('</div>')
+
+    partes.append(f'''<div class="card">
+        <form method="POST" enctype="multipart/form-data">
+            <div class="form-row">
+                <div class="form-group"><label>Archivo (.csv o .xlsx)</label><input type="file" name="archivo" accept=".csv,.txt,.xlsx" class="form-input" required></div>
+            </div>
+            <div class="form-actions"><button type="submit" class="btn btn-primary btn-lg">🔍 Validar</button></div>
+        </form>
+        <p style="margin-top:1rem;font-size:.85rem;color:#555">La primera fila debe tener los encabezados
+        <strong>PROFESIONAL, FECHA, HORA, PACIENTE</strong> y opcionalmente DNI, EDAD, CELULAR, OBSERVACIONES, TIPO, APP.
+        Cada fila se agenda en el cupo existente del profesional en esa fecha y hora; primero se valida todo sin guardar nada.
+        También se puede subir el Excel exportado por el sistema.</p>
+    </div>''')
+    flash_msgs = session.pop('_flashes', [])
+    return page('Importar - Sistema de Citas', ''.join(partes), flash_msgs)
+
+# ==============================================================================
+# ARCHIVO ANUAL - años cerrados en citas_AAAA.db
+# ==============================================================================
+ARCHIVO_TABLAS = {
+    # tabla: (filtro del año, parámetros)
+    'citas':           ("fecha BETWEEN ? AND ?", lambda a: (f'{a}-01-01', f'{a}-12-31')),
+    'roles_mensuales': ("anio = ?", lambda a: (a,)),
+    'historial':       ("fecha_hora >= ? AND fecha_hora < ?", lambda a: (f'{a}-01-01', f'{a + 1}-01-01')),
+}
+
+def ruta_archivo(anio):
+    return os.path.join(ARCHIVO_DIR, f'{sede_actual().prefijo}citas_{anio}.db')
+
+def anio_archivable(anio):
+    """True when the whole year ended more than ARCHIVO_MESES months ago"""
+    hoy = datetime.now()
+    return (hoy.year - anio - 1) * 12 + hoy.month - 1 >= ARCHIVO_MESES
+
+@contextmanager
+def conexion_periodo(anio):
+    """Read-only connection plus the citas table expression for a year.
+
+    Years inside the hot horizon only touch the main DB; archived years
+    ATTACH their citas_AAAA.db and read main+archive as one table.
+    """
+    conn = get_db_lectura()
+    ruta = ruta_archivo(anio)
+    adjunto = os.path.exists(ruta)
+    try:
+        if adjunto:
+            conn.execute("ATTACH DATABASE ? AS arch", (f'file:{ruta}?mode=ro',))
+            yield conn, '(SELECT * FROM main.citas UNION ALL SELECT * FROM arch.citas)'
+        else:
+            yield conn, 'citas'
+    finally:
+        if adjunto:
+            if conn.in_transaction: conn.rollback()
+            conn.execute("DETACH DATABASE arch")
+        conn.close()
+
+def archivar_anio(anio):
+    """Move one year of citas/roles_mensuales/historial to its archive file.
+
+    Rows are copied with INSERT OR REPLACE, so re-running after a crash
+    between the two files' commits finishes the move without duplicates.
+    """
+    auditoria.vaciar()  # que no quede historial del año en la cola
+    conn = get_db()
+    # Las FK del archivo apuntan a profesionales, que solo existe en la BD principal
+    conn.execute("PRAGMA foreign_keys=OFF")
+    esquema = {r['name']: r['sql'] for r in conn.execute("SELECT name, sql FROM sqlite_master WHERE type='table' AND name IN ('citas','roles_mensuales','historial')")}
+    conn.execute("ATTACH DATABASE ? AS arch", (ruta_archivo(anio),))
+    conn.execute("PRAGMA arch.journal_mode=DELETE")
+    for tabla in ARCHIVO_TABLAS:
+        conn.execute(esquema[tabla].replace(f'CREATE TABLE {tabla}', f'CREATE TABLE IF NOT EXISTS arch.{tabla}', 1))
+    conn.execute("CREATE INDEX IF NOT EXISTS arch.idx_citas_fecha ON citas(fecha)")
+    movidas = {}
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        refrescar_resumen(conn)
+        for tabla, (filtro, params) in ARCHIVO_TABLAS.items():
+            conn.execute(f"INSERT OR REPLACE INTO arch.{tabla} SELECT * FROM main.{tabla} WHERE {filtro}", params(anio))
+            movidas[tabla] = conn.execute(f"DELETE FROM main.{tabla} WHERE {filtro}", params(anio)).rowcount
+        # El resumen del año se conserva: borrar las citas no lo deja pendiente
+        conn.execute("DELETE FROM resumen_pendiente WHERE fecha BETWEEN ? AND ?", (f'{anio}-01-01', f'{anio}-12-31'))
+        marcar_cambio(conn)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.execute("DETACH DATABASE arch")
+        conn.close()
+    return movidas
+
+@app.cli.command('archivar')
+@click.option('--anio', type=int, help='Año a archivar (por defecto, todos los cerrados fuera del horizonte)')
+@click.option('--forzar', is_flag=True, help='Archivar aunque el año esté dentro del horizonte')
+def archivar_cmd(anio, forzar):
+    """Mover años cerrados a citas_AAAA.db"""
+    conn = get_db()
+    r = conn.execute("SELECT MIN(fecha) FROM citas").fetchone()[0]
+    conn.close()
+    if anio: anios = [anio]
+    elif r: anios = [a for a in range(int(r[:4]), datetime.now().year) if anio_archivable(a)]
+    else: anios = []
+    if not anios:
+        click.echo('No hay años para archivar.')
+    for a in anios:
+        if not forzar and not anio_archivable(a):
+            raise click.ClickException(f'{a} está dentro del horizonte de {ARCHIVO_MESES} meses (use --forzar)')
+        t0 = time.perf_counter()
+        movidas = archivar_anio(a)
+        detalle = ', '.join(f'{t}: {n}' for t, n in movidas.items())
+        click.echo(f'{a} → {ruta_archivo(a)} | {detalle} | {time.perf_counter() - t0:.2f} s')
+
+# ==============================================================================
+# PERFIL DE SQL - página de administración
+# ==============================================================================
+@app.route('/sql_lento', methods=['GET', 'POST'])
+@admin_required
+def sql_lento():
+    if not PERFIL_SQL:
+        flash('El perfil de SQL está desactivado (PERFIL_SQL=1)', 'warning')
+        return redirect('/')
+    if request.method == 'POST':
+        with _perfil_lock: _perfil.clear()
+        flash('Estadísticas de SQL reiniciadas', 'info')
+        return redirect('/sql_lento')
+    with _perfil_lock:
+        top = sorted(_perfil.values(), key=lambda e: e['total_ms'], reverse=True)[:50]
+        top = [dict(e, formas=sorted(e['formas'])) for e in top]
+    rows = ''
+    for e in top:
+        escaneo = ''.join(f'<span class="badge badge-danger">SCAN {esc(t)}</span> ' for t in e['escaneos'])
+        plan = Markup('<br>').join(e['plan'])
+        rows += f'''<tr><td><code style="font-size:.75rem">{Markup.escape(e['sql'])}</code><br>{escaneo}<small class="text-muted">{plan}</small></td>
+            <td>{e['n']}</td><td><strong>{e['total_ms']:.1f}</strong></td><td>{e['total_ms'] / e['n']:.2f}</td><td>{e['max_ms']:.1f}</td>
+            <td class="{'text-danger' if e['lentas'] else ''}">{e['lentas']}</td><td><small>{Markup.escape(' '.join(e['formas']))}</small></td></tr>'''
+    if not rows: rows = '<tr><td colspan="7" class="text-center">Sin datos todavía</td></tr>'
+    content = f'''<div class="page-header"><h2>🐢 Perfil de SQL</h2>
+        <p class="text-muted" style="font-size:.9rem">Worker {os.getpid()} · umbral de lenta: {SQL_LENTO_MS:g} ms · ordenado por tiempo total</p></div>
+    <div class="card"><form method="POST" style="margin-bottom:.75rem"><button type="submit" class="btn btn-sm btn-secondary">🔄 Reiniciar</button></form>
+    <div class="table-wrapper"><table class="citas-table"><thead><tr><th>Sentencia / plan</th><th>Llamadas</th><th>Total ms</th><th>Prom. ms</th><th>Máx. ms</th><th>Lentas</th><th>Parámetros</th></tr></thead>
+    <tbody>{rows}</tbody></table></div></div>'''
+    flash_msgs = session.pop('_flashes', [])
+    return page('Perfil SQL - Sistema de Citas', content, flash_msgs)
+
+# ==============================================================================
+# PERFILES cProfile POR SOLICITUD
+# ==============================================================================
+def _firmador_perfil():
+    return URLSafeTimedSerializer(app.secret_key, salt='perfil')
+
+def _debe_perfilar():
+    if request.endpoint in (None, 'static', 'perfiles', 'ver_perfil', 'descargar_perfil'): return False
+    firma = request.args.get('_perfil')
+    if firma:
+        try:
+            url = _firmador_perfil().loads(firma, max_age=3600)
+        except BadSignature:
+            return False
+        return url.split('?', 1)[0] == request.path
+    if session.get('perfil_una'):
+        session.pop('perfil_una')
+        return True
+    if session.get('perfil_siempre'): return True
+    return PERFIL_MUESTREO > 0 and random.random() < PERFIL_MUESTREO
+
+@app.before_request
+def _perfil_inicio():
+    if not _debe_perfilar(): return
+    g.perfil = cProfile.Profile()
+    g.perfil_t0 = time.perf_counter()
+    g.perfil.enable()
+
+@app.teardown_request
+def _perfil_fin(_exc=None):
+    prof = g.pop('perfil', None)
+    if prof is None: return
+    prof.disable()
+    ms = int((time.perf_counter() - g.perfil_t0) * 1000)
+    os.makedirs(PERFILES_DIR, exist_ok=True)
+    nombre = f"{datetime.now().strftime('%Y%m%d_%H%M%S_%f')}_{request.endpoint}_{ms}ms_{os.getpid()}.pstats"
+    prof.dump_stats(os.path.join(PERFILES_DIR, nombre))
+    for viejo in _listar_perfiles()[PERFILES_MAX:]:
+        try: os.remove(os.path.join(PERFILES_DIR, viejo))
+        except OSError: pass
+
+def _listar_perfiles():
+    if not os.path.isdir(PERFILES_DIR): return []
+    return sorted((f for f in os.listdir(PERFILES_DIR) if f.endswith('.pstats')), reverse=True)
+
+@app.route('/perfiles', methods=['GET', 'POST'])
+@admin_required
+def perfiles():
+    enlace = ''
+    if request.method == 'POST':
+        accion = request.form.get('accion')
+        if accion == 'una':
+            session['perfil_una'] = True
+            flash('Se perfilará su próxima solicitud', 'info')
+        elif accion == 'siempre':
+            session['perfil_siempre'] = not session.get('perfil_siempre')
+            flash('Perfilado de su sesión ' + ('activado' if session['perfil_siempre'] else 'desactivado'), 'info')
+        elif accion == 'enlace':
+            url = request.form.get('url', '/').strip() or '/'
+            sep = '&' if '?' in url else '?'
+            enlace = f'{url}{sep}_perfil={_firmador_perfil().dumps(url)}'
+        if accion != 'enlace': return redirect('/perfiles')
+    rows = ''
+    for f in _listar_perfiles():
+        rows += f'<tr><td><a href="/perfiles/{f}">{f}</a></td><td>{os.path.getsize(os.path.join(PERFILES_DIR, f)) // 1024} KB</td><td><a href="/perfiles/{f}/descargar" class="btn btn-sm btn-secondary">📥</a></td></tr>'
+    if not rows: rows = '<tr><td colspan="3" class="text-center">Sin perfiles</td></tr>'
+    estado = 'ACTIVADO' if session.get('perfil_siempre') else 'desactivado'
+    enlace_html = f'<p style="margin-top:.5rem">Enlace válido por 1 hora: <code>{Markup.escape(enlace)}</code></p>' if enlace else ''
+    content = f'''<div class="page-header"><h2>⏱️ Perfiles cProfile</h2>
+        <p class="text-muted" style="font-size:.9rem">Muestreo global: {PERFIL_MUESTREO:g} · se conservan {PERFILES_MAX} en {PERFILES_DIR}</p></div>
+    <div class="card"><h3>Activar</h3><div class="filter-row">
+        <form method="POST"><input type="hidden" name="accion" value="una"><button class="btn btn-primary">1️⃣ Perfilar mi próxima solicitud</button></form>
+        <form method="POST"><input type="hidden" name="accion" value="siempre"><button class="btn btn-warning">🔁 Perfilar toda mi sesión ({estado})</button></form>
+    </div>
+    <form method="POST" class="filter-row" style="margin-top:1rem"><input type="hidden" name="accion" value="enlace">
+        <div class="filter-group"><label>Generar enlace firmado para perfilar una URL (cualquier usuario)</label><input type="text" name="url" class="form-input" placeholder="/reporte_diario?fecha=2026-03-02"></div>
+        <div class="filter-group" style="align-self:flex-end;flex:0"><button class="btn btn-secondary">🔗 Generar</button></div>
+    </form>{enlace_html}</div>
+    <div class="card"><h3>Perfiles guardados</h3><div class="table-wrapper"><table class="citas-table"><thead><tr><th>Archivo</th><th>Tamaño</th><th></th></tr></thead>
+    <tbody>{rows}</tbody></table></div></div>'''
+    flash_msgs = session.pop('_flashes', [])
+    return page('Perfiles - Sistema de Citas', content, flash_msgs)
+
+@app.route('/perfiles/<nombre>')
+@admin_required
+def ver_perfil(nombre):
+    if nombre not in _listar_perfiles(): abort(404)
+    orden = request.args.get('orden', 'cumulative')
+    if orden not in ('cumulative', 'tottime', 'ncalls'): orden = 'cumulative'
+    n = min(int(request.args.get('n', 40)), 500)
+    buf = io.StringIO()
+    pstats.Stats(os.path.join(PERFILES_DIR, nombre), stream=buf).strip_dirs().sort_stats(orden).print_stats(n)
+    opciones = ' '.join(f'<a href="?orden={o}&n={n}" class="btn btn-sm {"btn-primary" if o == orden else "btn-secondary"}">{o}</a>' for o in ('cumulative', 'tottime', 'ncalls'))
+    content = f'''<div class="page-header"><h2>⏱️ {nombre}</h2></div>
+    <div class="card"><div style="margin-bottom:.75rem">{opciones} <a href="/perfiles/{nombre}/descargar" class="btn btn-sm btn-success">📥 .pstats</a> <a href="/perfiles" class="btn btn-sm btn-secondary">← Volver</a></div>
+    <pre style="font-size:.72rem;overflow-x:auto">{Markup.escape(buf.getvalue())}</pre></div>'''
+    return page('Perfil - Sistema de Citas', content)
+
+@app.route('/perfiles/<nombre>/descargar')
+@admin_required
+def descargar_perfil(nombre):
+    if nombre not in _listar_perfiles(): abort(404)
+    return send_file(os.path.join(PERFILES_DIR, nombre), as_attachment=True, download_name=nombre)
+
+# ==============================================================================
+# MANTENIMIENTO - WAL, optimize y respaldos en línea
+# ==============================================================================
+def _tarea_checkpoint(conn):
+    busy, log, done = conn.execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchone()
+    if busy: raise RuntimeError(f'Checkpoint bloqueado por lectores ({done}/{log} páginas)')
+    return f'{done} páginas copiadas, WAL truncado'
+
+def _tarea_optimizar(conn):
+    conn.execute("PRAGMA optimize")
+    return 'PRAGMA optimize'
+
+def _tarea_analizar(conn):
+    conn.execute("ANALYZE")
+    return 'ANALYZE completo'
+
+def _tarea_vacuum(conn):
+    ruta = sede_actual().db_path
+    antes = os.path.getsize(ruta)
+    conn.execute("VACUUM")
+    return f'{antes // 1024} KB → {os.path.getsize(ruta) // 1024} KB'
+
+def _tarea_backup(conn):
+    os.makedirs(BACKUP_DIR, exist_ok=True)
+    nombre = f"{sede_actual().prefijo}citas_{datetime.now().strftime('%Y%m%d_%H%M%S')}.db"
+    destino = sqlite3.connect(os.path.join(BACKUP_DIR, nombre + '.tmp'))
+    # Copia por bloques de páginas para no retener el lock de lectura todo el tiempo
+    conn.backup(destino, pages=256, sleep=0.01)
+    destino.close()
+    os.replace(os.path.join(BACKUP_DIR, nombre + '.tmp'), os.path.join(BACKUP_DIR, nombre))
+    previos = _listar_backups()
+    for viejo in previos[BACKUP_ROTACION:]:
+        os.remove(os.path.join(BACKUP_DIR, viejo['nombre']))
+    return f'{nombre} ({len(previos[BACKUP_ROTACION:])} rotados)'
+
+def _tarea_resumen(conn):
+    return f'{refrescar_resumen(conn)} días recalculados'
+
+def _tarea_idempotencia(conn):
+    n = conn.execute("DELETE FROM idempotencia WHERE creado_en <= datetime('now', ?)", (f'-{IDEMPOTENCIA_HORAS} hours',)).rowcount
+    return f'{n} claves vencidas borradas'
+
+TAREAS_MANTENIMIENTO = {
+    'checkpoint': ('Checkpoint WAL (TRUNCATE)', _tarea_checkpoint),
+    'optimizar':  ('PRAGMA optimize', _tarea_optimizar),
+    'analizar':   ('ANALYZE', _tarea_analizar),
+    'backup':     ('Respaldo en línea', _tarea_backup),
+    'resumen':    ('Resumen diario (días pendientes)', _tarea_resumen),
+    'idempotencia': ('Claves de idempotencia vencidas', _tarea_idempotencia),
+    'vacuum':     ('VACUUM (bloquea la BD)', _tarea_vacuum),
+}
+
+def _listar_backups():
+    if not os.path.isdir(BACKUP_DIR): return []
+    prefijo = sede_actual().prefijo + 'citas_'
+    archivos = [f for f in os.listdir(BACKUP_DIR) if f.startswith(prefijo) and f.endswith('.db')]
+    return [{'nombre': f, 'bytes': os.path.getsize(os.path.join(BACKUP_DIR, f))} for f in sorted(archivos, reverse=True)]
+
+def ejecutar_tarea(tarea):
+    """Run one maintenance task and record its outcome in `mantenimiento`"""
+    _, fn = TAREAS_MANTENIMIENTO[tarea]
+    inicio = datetime.now()
+    conn = get_db()
+    try:
+        detalle = fn(conn); ok = 1
+    except Exception as e:
+        detalle = f'ERROR: {e}'; ok = 0
+    ms = int((datetime.now() - inicio).total_seconds() * 1000)
+    conn.execute("INSERT OR REPLACE INTO mantenimiento (tarea, inicio, fin, ok, duracion_ms, detalle) VALUES (?,?,?,?,?,?)",
+        (tarea, inicio.strftime('%Y-%m-%d %H:%M:%S'), datetime.now().strftime('%Y-%m-%d %H:%M:%S'), ok, ms, detalle))
+    conn.commit(); conn.close()
+    return ok, detalle
+
+def _horas_desde(conn, tarea):
+    r = conn.execute("SELECT (julianday('now','localtime') - julianday(inicio)) * 24 FROM mantenimiento WHERE tarea=? AND ok=1", (tarea,)).fetchone()
+    return r[0] if r and r[0] is not None else None
+
+def _mantener_sede(vigias, sede):
+    """One scheduler tick for the site bound with con_sede()"""
+    if sede.clave not in vigias:
+        vigia = get_db()
+        vigias[sede.clave] = [vigia, vigia.execute("PRAGMA data_version").fetchone()[0], False]
+        return
+    vigia, ultima_version, limpio = vigias[sede.clave]
+    wal = sede.db_path + '-wal'
+    version = vigia.execute("PRAGMA data_version").fetchone()[0]
+    if version != ultima_version: limpio = False
+    # Ventana tranquila: nadie escribió durante el último tick. Tras el checkpoint el WAL
+    # solo tiene la fila de mantenimiento que lo registra; no se repite hasta que otro escriba
+    elif not limpio and os.path.exists(wal) and os.path.getsize(wal) > 0:
+        ejecutar_tarea('checkpoint')
+        limpio = True
+    vigias[sede.clave][2] = limpio
+    if vigia.execute("SELECT 1 FROM resumen_pendiente LIMIT 1").fetchone(): ejecutar_tarea('resumen')
+    vigias[sede.clave][1] = vigia.execute("PRAGMA data_version").fetchone()[0]
+    h = _horas_desde(vigia, 'optimizar')
+    if h is None or h >= 24: ejecutar_tarea('optimizar')
+    h = _horas_desde(vigia, 'idempotencia')
+    if h is None or h >= 1: ejecutar_tarea('idempotencia')
+    h = _horas_desde(vigia, 'backup')
+    if BACKUP_HORAS > 0 and (h is None or h >= BACKUP_HORAS): ejecutar_tarea('backup')
+
+def _ciclo_mantenimiento():
+    vigias = {}
+    while True:
+        ahora = time.time()
+        for sede in SEDES_REGISTRO.values():
+            # Sin solicitudes web no hay quien cierre las sedes inactivas: lo hace este hilo
+            if _sede_inactiva(sede, ahora): sede.cerrar()
+            if MULTISEDE and not sede.abierta:
+                vigia = vigias.pop(sede.clave, None)
+                if vigia: vigia[0].close()
+                continue
+            try:
+                with con_sede(sede): _mantener_sede(vigias, sede)
+            except Exception as e:
+                app.logger.error('Mantenimiento %s: %s', sede.clave, e)
+        time.sleep(MANTENIMIENTO_TICK)
+
+_mantenimiento_iniciado = False
+
+@app.before_request
+def _iniciar_mantenimiento():
+    """Start the scheduler in one web worker (the one that wins the file lock)"""
+    global _mantenimiento_iniciado
+    if _mantenimiento_iniciado or MANTENIMIENTO_TICK <= 0: return
+    _mantenimiento_iniciado = True
+    try:
+        import fcntl
+        lock = open(DB_PATH + '.mant.lock', 'w')
+        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        app.config['_MANT_LOCK'] = lock
+    except ImportError:
+        pass
+    except OSError:
+        return  # Otro worker ya es el encargado
+    threading.Thread(target=_ciclo_mantenimiento, name='mantenimiento', daemon=True).start()
+
+@app.route('/mantenimiento')
+@admin_required
+def mantenimiento():
+    conn = get_db()
+    estado = {r['tarea']: r for r in conn.execute("SELECT * FROM mantenimiento").fetchall()}
+    conn.close()
+    ruta = sede_actual().db_path
+    wal = os.path.getsize(ruta + '-wal') if os.path.exists(ruta + '-wal') else 0
+    rows = ''
+    for tarea, (titulo, _) in TAREAS_MANTENIMIENTO.items():
+        e = estado.get(tarea)
+        if e:
+            badge = '<span class="badge badge-success">OK</span>' if e['ok'] else '<span class="badge badge-danger">Error</span>'
+            info = f'{e["fin"]} · {e["duracion_ms"]} ms'
+            detalle = e['detalle']
+        else:
+            badge = '<span class="badge badge-info">Nunca</span>'; info = '—'; detalle = ''
+        confirm = ' onsubmit="return confirm(\'VACUUM bloquea la base de datos. ¿Continuar?\')"' if tarea == 'vacuum' else ''
+        rows += f'''<tr><td><strong>{titulo}</strong></td><td>{badge}</td><td>{info}</td><td><small>{detalle}</small></td>
+            <td><form method="POST" action="/mantenimiento/{tarea}"{confirm}><button type="submit" class="btn btn-sm btn-primary">▶️ Ejecutar</button></form></td></tr>'''
+    backups = ''.join(f'<tr><td><a href="/mantenimiento/backup/{b["nombre"]}">{b["nombre"]}</a></td><td>{b["bytes"] // 1024} KB</td></tr>' for b in _listar_backups())
+    if not backups: backups = '<tr><td colspan="2" class="text-center">Sin respaldos</td></tr>'
+    programado = f'cada {MANTENIMIENTO_TICK} s (respaldo cada {BACKUP_HORAS} h, se conservan {BACKUP_ROTACION})' if MANTENIMIENTO_TICK > 0 else 'desactivado'
+    content = f'''<div class="page-header"><h2>🛠️ Mantenimiento de Base de Datos</h2></div>
+    <div class="stats-grid">
+        <div class="stat-card stat-total"><div class="stat-number">{os.path.getsize(ruta) // 1024}</div><div class="stat-label">BD (KB)</div></div>
+        <div class="stat-card stat-confirmed"><div class="stat-number">{wal // 1024}</div><div class="stat-label">WAL (KB)</div></div>
+        <div class="stat-card stat-available"><div class="stat-number">{auditoria.pendientes()}</div><div class="stat-label">Auditoría en cola</div></div>
+    </div>
+    <div class="card"><h3>Tareas</h3><p class="text-muted" style="margin-bottom:.5rem">Programador automático: {programado}</p>
+    <div class="table-wrapper"><table class="citas-table"><thead><tr><th>Tarea</th><th>Estado</th><th>Última ejecución</th><th>Detalle</th><th></th></tr></thead>
+    <tbody>{rows}</tbody></table></div></div>
+    <div class="card"><h3>Respaldos en {BACKUP_DIR}</h3><div class="table-wrapper"><table class="citas-table"><thead><tr><th>Archivo</th><th>Tamaño</th></tr></thead>
+    <tbody>{backups}</tbody></table></div></div>'''
+    flash_msgs = session.pop('_flashes', [])
+    return page('Mantenimiento - Sistema de Citas', content, flash_msgs)
+
+@app.route('/mantenimiento/<tarea>', methods=['POST'])
+@admin_required
+def ejecutar_mantenimiento(tarea):
+    if tarea not in TAREAS_MANTENIMIENTO: abort(404)
+    ok, detalle = ejecutar_tarea(tarea)
+    flash(f'{TAREAS_MANTENIMIENTO[tarea][0]}: {detalle}', 'success' if ok else 'danger')
+    return redirect('/mantenimiento')
+
+@app.route('/mantenimiento/backup/<nombre>')
+@admin_required
+def descargar_backup(nombre):
+    if nombre not in [b['nombre'] for b in _listar_backups()]: abort(404)
+    return send_file(os.path.join(BACKUP_DIR, nombre), as_attachment=True, download_name=nombre)
+
+# ==============================================================================
+# CLI DE ADMINISTRACIÓN - trabajos largos fuera de los workers web
+# ==============================================================================
+#   flask --app app init-db | migrate
+#   flask --app app generar --anio 2026 --mes 3 --roster rol.txt
+#   flask --app app exportar --desde 2026-01-01 --hasta 2026-06-30 --out agenda.xlsx
+#   flask --app app reindex
+#   flask --app app archivar [--anio 2024]
+#   flask --app app stats rebuild
+def _cronometro():
+    t0 = time.perf_counter()
+    return lambda: f'{time.perf_counter() - t0:.2f} s'
+
+@app.cli.command('init-db')
+def init_db_cmd():
+    """Crear las tablas e índices que falten"""
+    t = _cronometro()
+    init_db()
+    click.echo(f'BD lista: {sede_actual().db_path} ({t()})')
+
+@app.cli.command('migrate')
+def migrate_cmd():
+    """Aplicar columnas, tablas e índices nuevos a una BD existente"""
+    # Conexión directa: get_db() prepararía la sede y aplicaría la migración antes de medirla
+    conn = sqlite3.connect(sede_actual().db_path)
+    antes = {r[0] for r in conn.execute("SELECT name FROM sqlite_master")}
+    conn.close()
+    t = _cronometro()
+    init_db()
+    conn = get_db()
+    nuevos = sorted({r['name'] for r in conn.execute("SELECT name FROM sqlite_master")} - antes)
+    conn.close()
+    click.echo(f'Migración completa ({t()}). Objetos nuevos: {", ".join(nuevos) or "ninguno"}')
+
+@app.cli.command('generar')
+@click.option('--anio', type=int, required=True)
+@click.option('--mes', type=click.IntRange(1, 12), required=True)
+@click.option('--meses', type=click.IntRange(1, 24), default=1, show_default=True, help='Meses consecutivos a generar')
+@click.option('--roster', type=click.File(encoding='utf-8'), help='Archivo con el texto del rol (por defecto, el rol guardado de cada mes)')
+def generar_cmd(anio, mes, meses, roster):
+    """Generar (o regenerar) los cupos de uno o varios meses en una sola transacción"""
+    texto = roster.read() if roster else None
+    rango = list(meses_consecutivos(anio, mes, meses))
+    errores = _revisar_texto_rol(texto, rango) if texto else []
+    total = _cronometro()
+    conn = get_db()
+    # Las mismas comprobaciones que la vista previa de /generar, mes por mes
+    plan = _planificar_meses(conn, rango, (lambda a, m: parse_roster_text(texto, a, m)) if texto
+                             else (lambda a, m: repositorio(conn).rol_guardado(a, m)))
+    errores += plan['errores']
+    if errores:
+        conn.close()
+        raise click.ClickException('Rol con errores, no se generó nada:\n' + '\n'.join(errores))
+    if plan['perdidas']:
+        click.echo(f'Aviso: {len(plan["perdidas"])} cita(s) agendada(s) quedan sin cupo en el nuevo rol')
+    res = generar_meses(conn, plan['roles'])
+    conn.close()
+    for (a, m), n in res.items():
+        click.echo(f'{MESES_ES[m]} {a}: {n} cupos')
+    click.echo(f'Listo: {sum(res.values())} cupos ({total()})')
+
+@app.cli.command('exportar')
+@click.option('--desde', type=click.DateTime(['%Y-%m-%d']), required=True)
+@click.option('--hasta', type=click.DateTime(['%Y-%m-%d']), required=True)
+@click.option('--out', 'salida', type=click.Path(dir_okay=False, writable=True), required=True, help='Archivo .xlsx de salida')
+def exportar_cmd(desde, hasta, salida):
+    """Exportar la agenda de un rango de fechas a Excel, fila por fila desde el cursor"""
+    if hasta < desde: raise click.BadParameter('--hasta es anterior a --desde')
+    t = _cronometro()
+
+    def filas():
+        for anio in range(desde.year, hasta.year + 1):
+            d = max(desde.date(), datetime(anio, 1, 1).date()).isoformat()
+            h = min(hasta.date(), datetime(anio, 12, 31).date()).isoformat()
+            with conexion_periodo(anio) as (conn, citas_t):
+                yield from conn.execute(_SQL_EXPORTAR.format(citas_t=citas_t), (d, h))
+
+    wb = xlsxwriter.Workbook(salida, {'constant_memory': True})
+    n = _escribir_agenda(wb, filas(), f'AGENDA DE CITAS - {desde:%d/%m/%Y} AL {hasta:%d/%m/%Y}',
+                         progreso=lambda k: click.echo(f'  {k} filas… ({t()})'))
+    wb.close()
+    click.echo(f'{n} filas → {salida} ({t()})')
+
+@app.cli.command('reindex')
+def reindex_cmd():
+    """Reconstruir todos los índices y actualizar las estadísticas del planificador"""
+    conn = get_db()
+    indices = [r['name'] for r in conn.execute("SELECT name FROM sqlite_master WHERE type='index' AND sql IS NOT NULL ORDER BY name")]
+    total = _cronometro()
+    for nombre in indices:
+        t = _cronometro()
+        conn.execute(f'REINDEX "{nombre}"')
+        click.echo(f'  {nombre} ({t()})')
+    conn.execute("ANALYZE")
+    conn.close()
+    click.echo(f'{len(indices)} índices reconstruidos + ANALYZE ({total()})')
+
+@app.cli.group('stats')
+def stats_cmd():
+    """Estadísticas derivadas"""
+
+@stats_cmd.command('rebuild')
+def stats_rebuild_cmd():
+    """Recalcular las estadísticas del planificador (ANALYZE completo)"""
+    conn = get_db()
+    t = _cronometro()
+    conn.execute("PRAGMA analysis_limit=0")
+    conn.execute("ANALYZE")
+    for tabla in ('citas', 'historial', 'roles_mensuales', 'profesionales'):
+        n = conn.execute(f"SELECT COUNT(*) FROM {tabla}").fetchone()[0]
+        click.echo(f'  {tabla}: {n} filas')
+    click.echo(f'ANALYZE completo ({t()})')
+    t = _cronometro()
+    n = reconstruir_resumen(conn)
+    conn.close()
+    click.echo(f'Resumen diario: {n} filas ({t()})')
 
 # ==============================================================================
 # INICIALIZACIÓN
 # ==============================================================================
-init_db()
+# Bajo `flask <comando>` no: init-db/migrate deben ver la BD tal como está, y el resto la prepara al usarla
+if click.get_current_context(silent=True) is None:
+    sede_actual().preparar()
 
 if __name__ == '__main__':
     port = int(os.environ.get('PORT', 8080))
@@ -0,0 +1,7 @@
+"""
+BENCHMARK DEL SISTEMA DE CITAS
+Siembra una BD temporal con datos sintéticos y mide las rutas más usadas.
+
+    python -m bench --profesionales 11 --meses 3 --densidad 0.7 --salida bench.json
+    python -m bench --comparar bench_antes.json bench.json
+"""
@@ -0,0 +1,195 @@
+"""Ejecuta el benchmark: python -m bench --help"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import shutil
+import platform
+import sqlite3
+import tempfile
+from datetime import datetime
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+
+def percentil(valores, p):
+    orden = sorted(valores)
+    return orden[min(len(orden) - 1, max(0, int(round(p / 100 * len(orden) + 0.5)) - 1))]
+
+
+def rss_pico_kb():
+    if not resource: return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss // 1024 if sys.platform == 'darwin' else rss
+
+
+class Contador:
+    """Counts SQL statements on every connection handed out by the app"""
+
+    def __init__(self, A):
+        self.n = 0
+        get_db, get_db_lectura = A.get_db, A.get_db_lectura
+
+        def traza(_sql):
+            self.n += 1
+
+        def con_traza(fn):
+            def envuelta():
+                conn = fn()
+                conn.set_trace_callback(traza)
+                return conn
+            return envuelta
+
+        A.get_db = con_traza(get_db)
+        A.get_db_lectura = con_traza(get_db_lectura)
+
+
+def medir(nombre, fn, iteraciones, contador):
+    tiempos = []; consultas = []; bytes_ = 0
+    fn()  # calentamiento
+    for _ in range(iteraciones):
+        contador.n = 0
+        t0 = time.perf_counter()
+        bytes_ = fn() or 0
+        tiempos.append((time.perf_counter() - t0) * 1000)
+        consultas.append(contador.n)
+    res = {
+        'n': iteraciones,
+        'p50_ms': round(percentil(tiempos, 50), 2),
+        'p95_ms': round(percentil(tiempos, 95), 2),
+        'media_ms': round(sum(tiempos) / len(tiempos), 2),
+        'consultas': round(sum(consultas) / len(consultas), 1),
+        'bytes': bytes_,
+        'rss_pico_kb': rss_pico_kb(),
+    }
+    print(f"  {nombre:<22} p50 {res['p50_ms']:>8.2f} ms  p95 {res['p95_ms']:>8.2f} ms  {res['consultas']:>7} consultas  {bytes_:>9} B")
+    return res
+
+
+def ejecutar(args, tmp):
+    os.environ['CITAS_DB'] = os.path.join(tmp, 'citas.db')
+    os.environ.setdefault('MANTENIMIENTO_TICK', '0')
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    import app as A
+    from bench.semilla import sembrar
+
+    t0 = time.perf_counter()
+    meses = sembrar(A, args.profesionales, args.meses, args.densidad, semilla=args.semilla)
+    print(f'Semilla: {args.profesionales} profesionales, {args.meses} meses, densidad {args.densidad} '
+          f'({time.perf_counter() - t0:.1f} s)')
+
+    conn = A.get_db()
+    total = conn.execute("SELECT COUNT(*) FROM citas").fetchone()[0]
+    fecha = conn.execute("""SELECT fecha FROM citas WHERE estado='Confirmado'
+        GROUP BY fecha ORDER BY COUNT(*) DESC LIMIT 1""").fetchone()['fecha']
+    prof_id = conn.execute("""SELECT profesional_id FROM citas WHERE fecha=? AND estado='Confirmado'
+        GROUP BY profesional_id ORDER BY COUNT(*) DESC LIMIT 1""", (fecha,)).fetchone()[0]
+    mt = conn.execute("SELECT profesional_id, anio, mes, dia FROM roles_mensuales WHERE turno='MT' LIMIT 1").fetchone()
+    conn.close()
+    print(f'{total} cupos. Día más cargado: {fecha}, profesional {prof_id}\n')
+
+    A.app.testing = True
+    cli = A.app.test_client()
+    cli.post('/login', data={'username': 'admin', 'password': 'admin123'})
+    contador = Contador(A)
+    anio, mes = meses[0]
+
+    def get(url):
+        def fn():
+            r = cli.get(url)
+            assert r.status_code == 200, (url, r.status_code)
+            return len(r.data)
+        return fn
+
+    def regenerar():
+        c = A.get_db()
+        A.generate_slots(c, anio, mes)
+        c.close()
+
+    def cambiar(confirmar):
+        fecha_mt = f"{mt['anio']}-{mt['mes']:02d}-{mt['dia']:02d}"
+        datos = {'accion': 'cambiar', 'prof_id': mt['profesional_id'], 'fecha': fecha_mt,
+                 'fecha_destino': fecha_mt, 'nuevo_turno': 'MT'}
+        if confirmar: datos['confirmar'] = '1'
+
+        def fn():
+            r = cli.post('/cambiar_turno', data=datos)
+            assert r.status_code in (200, 302), r.status_code
+            return len(r.data)
+        return fn
+
+    it = args.iteraciones
+    rutas = {
+        'agenda': get(f'/?prof_id={prof_id}&fecha={fecha}'),
+        'api_fechas': get(f'/api/fechas/{prof_id}'),
+        'reporte_diario': get(f'/reporte_diario?fecha={fecha}'),
+        'reportes': get(f'/reportes?year={anio}&month={mes}'),
+        'exportar_excel': get(f'/exportar?year={anio}&month={mes}'),
+        'generate_slots': regenerar,
+        'cambiar_turno_preview': cambiar(False),
+        'cambiar_turno': cambiar(True),
+    }
+    if mt is None:
+        del rutas['cambiar_turno_preview'], rutas['cambiar_turno']
+    resultados = {}
+    for nombre, fn in rutas.items():
+        if args.rutas and nombre not in args.rutas: continue
+        resultados[nombre] = medir(nombre, fn, max(1, it // 5) if nombre in ('generate_slots', 'exportar_excel') else it, contador)
+
+    return {
+        'meta': {
+            'fecha': datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'sqlite': sqlite3.sqlite_version,
+            'profesionales': args.profesionales, 'meses': args.meses, 'densidad': args.densidad,
+            'iteraciones': it, 'cupos': total,
+        },
+        'rutas': resultados,
+    }
+
+
+def comparar(antes, despues):
+    a = json.load(open(antes))['rutas']; d = json.load(open(despues))['rutas']
+    print(f"{'ruta':<22} {'p50 antes':>10} {'p50 ahora':>10} {'Δ':>7}   {'p95 antes':>10} {'p95 ahora':>10} {'Δ':>7}")
+    for ruta in d:
+        if ruta not in a: continue
+        fila = [ruta]
+        for k in ('p50_ms', 'p95_ms'):
+            x, y = a[ruta][k], d[ruta][k]
+            fila += [x, y, f'{(y - x) / x * 100:+.0f}%' if x else '—']
+        print('{:<22} {:>10} {:>10} {:>7}   {:>10} {:>10} {:>7}'.format(*fila))
+
+
+def main():
+    ap = argparse.ArgumentParser(prog='python -m bench', description='Benchmark de las rutas principales')
+    ap.add_argument('--profesionales', type=int, default=11)
+    ap.add_argument('--meses', type=int, default=2)
+    ap.add_argument('--densidad', type=float, default=0.7, help='Fracción de cupos agendados (0-1)')
+    ap.add_argument('--iteraciones', type=int, default=20)
+    ap.add_argument('--semilla', type=int, default=42)
+    ap.add_argument('--rutas', nargs='*', help='Medir solo estas rutas')
+    ap.add_argument('--salida', help='Guardar resultados en JSON')
+    ap.add_argument('--comparar', nargs=2, metavar=('ANTES', 'AHORA'), help='Comparar dos resultados JSON')
+    args = ap.parse_args()
+    if args.comparar:
+        comparar(*args.comparar); return
+    tmp = tempfile.mkdtemp(prefix='citas-bench-')
+    try:
+        res = ejecutar(args, tmp)
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+    texto = json.dumps(res, indent=2, ensure_ascii=False)
+    if args.salida:
+        with open(args.salida, 'w', encoding='utf-8') as f: f.write(texto)
+        print(f'\nResultados en {args.salida}')
+    else:
+        print(texto)
+
+
+if __name__ == '__main__':
+    main()
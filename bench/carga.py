@@ -0,0 +1,242 @@
+"""
+Prueba de carga multi-terminal: levanta la app con gunicorn y simula
+operadores de admisión trabajando al mismo tiempo.
+
+    python -m bench.carga --operadores 8 --workers 1 2 4 --duracion 30 --salida carga.json
+
+Cada operador repite una sesión realista: login, elegir profesional,
+/api/fechas, abrir un día, agendar un cupo libre, marcar asistencia y,
+de vez en cuando, exportar el Excel del mes.
+"""
+
+import os
+import re
+import sys
+import json
+import time
+import random
+import shutil
+import socket
+import sqlite3
+import argparse
+import tempfile
+import threading
+import subprocess
+import http.cookiejar
+import urllib.error
+import urllib.parse
+import urllib.request
+from datetime import datetime
+
+from bench.__main__ import percentil
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CLAVE = 'carga123'
+
+
+def puerto_libre():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def preparar_bd(ruta, args):
+    """Seed the DB in a child process so this one never imports the app"""
+    codigo = f"""
+import sys; sys.path.insert(0, {RAIZ!r})
+import app as A
+from bench.semilla import sembrar
+from werkzeug.security import generate_password_hash
+sembrar(A, {args.profesionales}, {args.meses}, {args.densidad})
+conn = A.get_db()
+h = generate_password_hash({CLAVE!r})
+conn.executemany("INSERT INTO usuarios (username, password_hash, nombre, rol) VALUES (?,?,?,'operador')",
+    [(f'op{{i}}', h, f'Operador {{i}}') for i in range({args.operadores})])
+conn.commit(); conn.close()
+"""
+    env = dict(os.environ, CITAS_DB=ruta, MANTENIMIENTO_TICK='0')
+    subprocess.run([sys.executable, '-c', codigo], env=env, check=True, cwd=RAIZ)
+
+
+class Servidor:
+    def __init__(self, ruta_bd, workers, threads, extra, log):
+        self.puerto = puerto_libre()
+        env = dict(os.environ, CITAS_DB=ruta_bd)
+        env.setdefault('MANTENIMIENTO_TICK', '0')
+        # Sin SECRET_KEY fija cada worker firma la sesión con su propia clave
+        env.setdefault('SECRET_KEY', 'carga-' + os.urandom(8).hex())
+        cmd = [sys.executable, '-m', 'gunicorn', 'app:app', '--bind', f'127.0.0.1:{self.puerto}',
+               '--workers', str(workers), '--threads', str(threads), '--timeout', '120'] + extra
+        self.log = open(log, 'w')
+        self.proc = subprocess.Popen(cmd, cwd=RAIZ, env=env, stdout=self.log, stderr=subprocess.STDOUT)
+        self.url = f'http://127.0.0.1:{self.puerto}'
+        limite = time.time() + 30
+        while time.time() < limite:
+            try:
+                urllib.request.urlopen(self.url + '/login', timeout=1); return
+            except (urllib.error.URLError, ConnectionError):
+                time.sleep(0.2)
+        self.cerrar()
+        raise RuntimeError('gunicorn no respondió en 30 s')
+
+    def cerrar(self):
+        self.proc.terminate()
+        try: self.proc.wait(10)
+        except subprocess.TimeoutExpired: self.proc.kill()
+        self.log.close()
+
+
+class Operador(threading.Thread):
+    def __init__(self, n, url, hasta, stats, rnd):
+        super().__init__(daemon=True)
+        self.usuario = f'op{n}'
+        self.url = url
+        self.hasta = hasta
+        self.stats = stats
+        self.rnd = rnd
+        cj = http.cookiejar.CookieJar()
+        self.http = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(cj))
+
+    def pedir(self, op, ruta, datos=None, headers=None):
+        req = urllib.request.Request(self.url + ruta, data=urllib.parse.urlencode(datos).encode() if datos is not None else None,
+                                     headers=headers or {})
+        t0 = time.perf_counter()
+        try:
+            with self.http.open(req, timeout=60) as r:
+                cuerpo = r.read()
+                status = r.status
+        except urllib.error.HTTPError as e:
+            cuerpo = e.read(); status = e.code
+        except (urllib.error.URLError, ConnectionError, TimeoutError) as e:
+            cuerpo = str(e).encode(); status = 0
+        self.stats.registrar(op, (time.perf_counter() - t0) * 1000, status)
+        return status, cuerpo.decode('utf-8', 'replace')
+
+    def run(self):
+        self.pedir('login', '/login', {'username': self.usuario, 'password': CLAVE})
+        while time.time() < self.hasta:
+            _, html = self.pedir('agenda', '/')
+            profs = re.findall(r'<option value="(\d+)"', html)
+            if not profs: continue
+            prof = self.rnd.choice(profs)
+            _, js = self.pedir('api_fechas', f'/api/fechas/{prof}')
+            try: fechas = [f['value'] for f in json.loads(js)]
+            except ValueError: fechas = []
+            if not fechas: continue
+            fecha = self.rnd.choice(fechas)
+            dia = f'/?prof_id={prof}&fecha={fecha}'
+            _, html = self.pedir('agenda_dia', dia)
+            libres = re.findall(r'openModal\((\d+),', html)
+            if libres:
+                cita = self.rnd.choice(libres)
+                st, r = self.pedir('retener', f'/cita/retener/{cita}', {})
+                if st == 200:
+                    paciente = f'{self.usuario} {self.rnd.randrange(10**6)}'.upper()
+                    _, html = self.pedir('agendar', '/cita/agendar',
+                                         {'cita_id': cita, 'paciente': paciente, 'tipo_paciente': 'NUEVO',
+                                          '_idem': f'{self.usuario}-{time.time_ns()}'},
+                                         {'Referer': self.url + dia})
+                    if f'Cita agendada: {paciente}' in html:
+                        self.stats.reserva(int(cita), paciente)
+                    else:
+                        self.stats.conflicto()
+                else:
+                    self.stats.conflicto()
+            ocupadas = re.findall(r"marcarAsistencia\((\d+),", html)
+            if ocupadas:
+                self.pedir('asistencia', f'/cita/asistencia/{self.rnd.choice(ocupadas)}/Asisti%C3%B3', {},
+                           {'Idempotency-Key': f'{self.usuario}-{time.time_ns()}'})
+            if self.rnd.random() < 0.05:
+                y, m = fecha[:4], int(fecha[5:7])
+                self.pedir('exportar', f'/exportar?year={y}&month={m}')
+
+
+class Estadisticas:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.tiempos = {}
+        self.errores = {}
+        self.reservas = {}
+        self.conflictos = 0
+
+    def registrar(self, op, ms, status):
+        with self.lock:
+            self.tiempos.setdefault(op, []).append(ms)
+            if status == 0 or status >= 500:
+                self.errores[op] = self.errores.get(op, 0) + 1
+
+    def reserva(self, cita, paciente):
+        with self.lock: self.reservas.setdefault(cita, []).append(paciente)
+
+    def conflicto(self):
+        with self.lock: self.conflictos += 1
+
+
+def una_corrida(args, workers):
+    tmp = tempfile.mkdtemp(prefix='citas-carga-')
+    try:
+        ruta = os.path.join(tmp, 'citas.db')
+        preparar_bd(ruta, args)
+        log = os.path.join(tmp, 'gunicorn.log')
+        srv = Servidor(ruta, workers, args.threads, args.gunicorn or [], log)
+        stats = Estadisticas()
+        try:
+            t0 = time.time()
+            ops = [Operador(i, srv.url, t0 + args.duracion, stats, random.Random(i)) for i in range(args.operadores)]
+            for o in ops: o.start()
+            for o in ops: o.join()
+            duracion = time.time() - t0
+        finally:
+            srv.cerrar()
+        bloqueos = open(log, encoding='utf-8', errors='replace').read().count('database is locked')
+        conn = sqlite3.connect(ruta)
+        finales = dict(conn.execute("SELECT id, paciente FROM citas WHERE estado='Confirmado'").fetchall())
+        conn.close()
+        # Doble reserva: dos operadores recibieron "Cita agendada" para el mismo cupo,
+        # o el paciente guardado no es el que el operador cree haber agendado.
+        dobles = sum(1 for cita, pacs in stats.reservas.items() if len(pacs) > 1 or finales.get(cita) != pacs[-1])
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+    total = sum(len(v) for v in stats.tiempos.values())
+    res = {
+        'workers': workers, 'threads': args.threads, 'operadores': args.operadores,
+        'duracion_s': round(duracion, 1),
+        'solicitudes': total,
+        'rps': round(total / duracion, 1),
+        'reservas': sum(len(v) for v in stats.reservas.values()),
+        'conflictos': stats.conflictos,
+        'doble_reserva': dobles,
+        'database_is_locked': bloqueos,
+        'errores': stats.errores,
+        'operaciones': {op: {'n': len(v), 'p50_ms': round(percentil(v, 50), 1), 'p95_ms': round(percentil(v, 95), 1),
+                             'p99_ms': round(percentil(v, 99), 1)} for op, v in sorted(stats.tiempos.items())},
+    }
+    print(f"workers={workers:<2} threads={args.threads:<2} {res['rps']:>7} req/s  reservas {res['reservas']:<5} "
+          f"conflictos {res['conflictos']:<4} doble_reserva {dobles:<3} locked {bloqueos:<3} errores {sum(stats.errores.values())}")
+    for op, d in res['operaciones'].items():
+        print(f"    {op:<12} n={d['n']:<6} p50 {d['p50_ms']:>7} ms  p95 {d['p95_ms']:>7} ms  p99 {d['p99_ms']:>7} ms")
+    return res
+
+
+def main():
+    ap = argparse.ArgumentParser(prog='python -m bench.carga', description='Prueba de carga con operadores simultáneos')
+    ap.add_argument('--operadores', type=int, default=4)
+    ap.add_argument('--workers', type=int, nargs='+', default=[2], help='Uno o más valores para comparar')
+    ap.add_argument('--threads', type=int, default=1)
+    ap.add_argument('--duracion', type=int, default=30, help='Segundos por corrida')
+    ap.add_argument('--profesionales', type=int, default=11)
+    ap.add_argument('--meses', type=int, default=1)
+    ap.add_argument('--densidad', type=float, default=0.3)
+    ap.add_argument('--gunicorn', nargs=argparse.REMAINDER, help='Argumentos extra para gunicorn')
+    ap.add_argument('--salida', help='Guardar resultados en JSON')
+    args = ap.parse_args()
+    corridas = [una_corrida(args, w) for w in args.workers]
+    if args.salida:
+        with open(args.salida, 'w', encoding='utf-8') as f:
+            json.dump({'fecha': datetime.now().isoformat(timespec='seconds'), 'corridas': corridas}, f, indent=2, ensure_ascii=False)
+        print(f'\nResultados en {args.salida}')
+
+
+if __name__ == '__main__':
+    main()
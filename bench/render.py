@@ -0,0 +1,87 @@
+"""
+Costo de renderizado de tablas grandes: un solo profesional con un día de
+muchos cupos, medido en tiempo y en memoria asignada (tracemalloc).
+
+    python -m bench.render --filas 500 --iteraciones 20
+"""
+
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+import tracemalloc
+
+from bench.__main__ import percentil
+
+FECHA = '2030-01-07'
+
+
+def sembrar_dia(A, filas):
+    conn = A.get_db()
+    prof_id, area = conn.execute("SELECT id, especialidad FROM profesionales WHERE activo=1 ORDER BY orden LIMIT 1").fetchone()
+    otro = conn.execute("SELECT id FROM profesionales WHERE id!=? LIMIT 1", (prof_id,)).fetchone()[0]
+    cupos = []
+    for i in range(filas):
+        h0 = 7 * 60 + i
+        inicio, fin = f'{h0 // 60:02d}:{h0 % 60:02d}', f'{(h0 + 1) // 60:02d}:{(h0 + 1) % 60:02d}'
+        ocupado = i % 4 != 3
+        cupos.append((prof_id, FECHA, area, 'MAÑANA' if i < filas // 2 else 'TARDE', inicio, fin,
+                      f"PACIENTE <{i}> O'HARA" if ocupado else '', f'{10**7 + i}' if ocupado else '',
+                      'Confirmado' if ocupado else 'Disponible', 'NUEVO' if i % 2 else 'CONTINUADOR',
+                      1 if ocupado and i % 5 == 0 else 0, otro if i % 10 == 0 else None,
+                      'obs & "notas"' if i % 3 == 0 else ''))
+    conn.executemany("""INSERT INTO citas (profesional_id, fecha, area, turno, hora_inicio, hora_fin, paciente, dni, estado,
+        tipo_paciente, sihce, sihce_prof_id, observaciones) VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?)""", cupos)
+    conn.commit(); conn.close()
+    return prof_id
+
+
+def medir(nombre, fn, iteraciones):
+    fn()
+    tiempos = []
+    for _ in range(iteraciones):
+        t0 = time.perf_counter(); fn(); tiempos.append((time.perf_counter() - t0) * 1000)
+    tracemalloc.start()
+    fn()
+    _, pico = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f"  {nombre:<16} p50 {percentil(tiempos, 50):>8.2f} ms  p95 {percentil(tiempos, 95):>8.2f} ms  "
+          f"pico {pico / 1024:>8.0f} KiB")
+
+
+def main():
+    ap = argparse.ArgumentParser(prog='python -m bench.render', description='Renderizado de tablas con muchas filas')
+    ap.add_argument('--filas', type=int, default=500)
+    ap.add_argument('--iteraciones', type=int, default=20)
+    args = ap.parse_args()
+    tmp = tempfile.mkdtemp(prefix='citas-render-')
+    try:
+        os.environ['CITAS_DB'] = os.path.join(tmp, 'citas.db')
+        os.environ.setdefault('MANTENIMIENTO_TICK', '0')
+        sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        import app as A
+        prof_id = sembrar_dia(A, args.filas)
+        A.app.testing = True
+        cli = A.app.test_client()
+        cli.post('/login', data={'username': 'admin', 'password': 'admin123'})
+
+        def get(url):
+            def fn():
+                r = cli.get(url)
+                assert r.status_code == 200, (url, r.status_code)
+                r.get_data()  # consume streamed bodies too
+            return fn
+
+        print(f'{args.filas} filas en {FECHA}')
+        medir('agenda', get(f'/?prof_id={prof_id}&fecha={FECHA}'), args.iteraciones)
+        medir('reporte_diario', get(f'/reporte_diario?fecha={FECHA}'), args.iteraciones)
+        medir('reporte_rango', get(f'/reporte_diario?fecha={FECHA}&hasta=2030-02-06'), args.iteraciones)
+        medir('reportes', get('/reportes?year=2030&month=1'), args.iteraciones)
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,62 @@
+"""Datos sintéticos: profesionales, roles mensuales y pacientes agendados."""
+
+import random
+import calendar
+from datetime import date
+
+NOMBRES = ['ANA', 'LUIS', 'ROSA', 'JUAN', 'CARMEN', 'PEDRO', 'LUCIA', 'JORGE', 'ELENA', 'MARIO', 'SOFIA', 'DIEGO']
+APELLIDOS = ['QUISPE', 'MAMANI', 'FLORES', 'HUAMAN', 'CONDORI', 'CHOQUE', 'RAMOS', 'TORRES', 'VARGAS', 'ROJAS']
+TURNOS = ['M', 'T', 'MT', 'GD']
+
+
+def _meses(anio, mes, n):
+    for _ in range(n):
+        yield anio, mes
+        mes += 1
+        if mes > 12:
+            anio += 1; mes = 1
+
+
+def sembrar(A, profesionales=11, meses=3, densidad=0.7, anio=None, mes=None, semilla=42):
+    """Fill the app DB and return the (anio, mes) list that was generated.
+
+    Uses the real generate_slots() so slot layouts follow SPECIALTY_MAP and
+    the per-specialty shift rules exactly as production does.
+    """
+    rnd = random.Random(semilla)
+    hoy = date.today()
+    anio = anio or hoy.year
+    mes = mes or hoy.month
+    conn = A.get_db()
+    actuales = conn.execute("SELECT COUNT(*) FROM profesionales").fetchone()[0]
+    especialidades = list(A.SPECIALTY_MAP) + ['PSICOLOGÍA'] * 3
+    for i in range(actuales, profesionales):
+        conn.execute("INSERT INTO profesionales (nombre, especialidad, color_bg, color_font, orden) VALUES (?,?,?,?,?)",
+            (f'PROFESIONAL SINTETICO {i:03d}', especialidades[i % len(especialidades)], '#%06X' % rnd.randrange(0xFFFFFF), 'black', i))
+    conn.execute("UPDATE profesionales SET activo = CASE WHEN orden < ? THEN 1 ELSE 0 END", (profesionales,))
+    conn.commit()
+    nombres = [r['nombre'] for r in conn.execute("SELECT nombre FROM profesionales WHERE activo=1 ORDER BY orden")]
+
+    generados = []
+    for a, m in _meses(anio, mes, meses):
+        dias = [d for d in range(1, calendar.monthrange(a, m)[1] + 1) if date(a, m, d).weekday() < 5]
+        lineas = []
+        for nombre in nombres:
+            plan = ', '.join(f'Día {d} {rnd.choice(TURNOS)}' for d in dias if rnd.random() < 0.8)
+            if plan: lineas.append(f'{nombre}: {plan}')
+        A.generate_slots(conn, a, m, '\n'.join(lineas))
+        generados.append((a, m))
+
+    libres = conn.execute("SELECT id, fecha FROM citas WHERE estado='Disponible' AND turno!='ADMINISTRATIVA'").fetchall()
+    reservas = []
+    for r in libres:
+        if rnd.random() >= densidad: continue
+        paciente = f'{rnd.choice(APELLIDOS)} {rnd.choice(APELLIDOS)} {rnd.choice(NOMBRES)}'
+        asistencia = rnd.choice(['Asistió', 'Asistió', 'No asistió']) if r['fecha'] < hoy.isoformat() else 'Pendiente'
+        reservas.append((paciente, f'{rnd.randrange(10**7, 10**8)}', str(rnd.randrange(5, 80)), f'9{rnd.randrange(10**7, 10**8)}',
+                         rnd.choice(['NUEVO', 'CONTINUADOR']), asistencia, 1 if rnd.random() < 0.1 else 0, r['id']))
+    conn.executemany("""UPDATE citas SET paciente=?, dni=?, edad=?, celular=?, estado='Confirmado',
+        tipo_paciente=?, asistencia=?, sihce=?, creado_por=1 WHERE id=?""", reservas)
+    conn.commit()
+    conn.close()
+    return generados
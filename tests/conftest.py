@@ -0,0 +1,94 @@
+import atexit
+import os
+import shutil
+import sys
+import tempfile
+
+import pytest
+
+# La configuración se lee al importar app: BD temporal, sin hilo de mantenimiento
+# y con el historial escrito en la misma solicitud para poder revisarlo enseguida
+_DIR = tempfile.mkdtemp(prefix='citas-tests-')
+atexit.register(shutil.rmtree, _DIR, True)
+os.environ['CITAS_DB'] = os.path.join(_DIR, 'citas.db')
+os.environ.pop('DATABASE_URL', None)
+os.environ.pop('SEDES', None)
+os.environ['MANTENIMIENTO_TICK'] = '0'
+os.environ['HISTORIAL_ASYNC'] = '0'
+os.environ['SNAPSHOT_SEGUNDOS'] = '0'
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app as citas  # noqa: E402
+
+citas.app.testing = True
+
+SALAS = 'SALAS MORALES GONZALO AUGUSTO'
+
+
+@pytest.fixture(autouse=True)
+def bd_limpia():
+    """Every test starts with no slots, rosters, holds, idempotency keys or history"""
+    conn = citas.get_db()
+    for tabla in ('citas', 'roles_mensuales', 'retenciones', 'idempotencia', 'historial'):
+        conn.execute(f'DELETE FROM {tabla}')
+    citas.marcar_cambio(conn)
+    conn.commit()
+    conn.close()
+    yield
+
+
+def _cliente(username, password):
+    c = citas.app.test_client()
+    r = c.post('/login', data={'username': username, 'password': password})
+    assert r.status_code == 302, r.status_code
+    return c
+
+
+@pytest.fixture
+def cliente():
+    return _cliente('admin', 'admin123')
+
+
+@pytest.fixture
+def operador():
+    """A second logged-in user, for holds and idempotency keys that belong to someone else"""
+    conn = citas.get_db()
+    citas.repositorio(conn).crear_usuario('operador', citas.generate_password_hash('clave'), 'Operador', 'operador')
+    conn.commit()
+    conn.close()
+    return _cliente('operador', 'clave')
+
+
+@pytest.fixture
+def conn():
+    c = citas.get_db()
+    yield c
+    c.close()
+
+
+def prof_id(conn, nombre=SALAS):
+    return conn.execute('SELECT id FROM profesionales WHERE nombre=?', (nombre,)).fetchone()[0]
+
+
+def generar(cliente, texto, year=2026, month=10, meses=1):
+    r = cliente.post('/generar', data={'year': year, 'month': month, 'meses': meses,
+                                       'roster_text': texto, 'confirmar': '1'})
+    assert r.status_code == 302, r.get_data(as_text=True)
+    assert avisos(cliente)[0].startswith('✅ Generados')
+    return r
+
+
+def cupos(conn, pid, fecha):
+    """Patient slots (no administrative hour) of one professional-day, in time order"""
+    return conn.execute("SELECT * FROM citas WHERE profesional_id=? AND fecha=? AND turno!='ADMINISTRATIVA' "
+                        "ORDER BY hora_inicio", (pid, fecha)).fetchall()
+
+
+def agendar(cliente, cita_id, paciente, **extra):
+    return cliente.post('/cita/agendar', data={'cita_id': cita_id, 'paciente': paciente, **extra})
+
+
+def avisos(cliente):
+    """Pop the pending flash messages, as the next page would"""
+    with cliente.session_transaction() as s:
+        return [m for _, m in s.pop('_flashes', [])]
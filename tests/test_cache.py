@@ -0,0 +1,49 @@
+from conftest import SALAS, agendar, avisos, citas, cupos, generar, prof_id
+
+URL = '/reporte_diario?fecha=2026-10-05'
+
+
+def test_etag_y_304(cliente, conn):
+    generar(cliente, f'{SALAS}: Día 5 M')
+    r1 = cliente.get(URL)
+    assert r1.status_code == 200 and r1.headers['ETag']
+    r2 = cliente.get(URL, headers={'If-None-Match': r1.headers['ETag']})
+    assert r2.status_code == 304
+    assert cliente.get(URL).get_data() == r1.get_data()
+
+
+def test_escritura_invalida_la_cache(cliente, conn):
+    generar(cliente, f'{SALAS}: Día 5 M')
+    r1 = cliente.get(URL)
+    assert 'ANA' not in r1.get_data(as_text=True)
+
+    agendar(cliente, cupos(conn, prof_id(conn), '2026-10-05')[0]['id'], 'ana')
+    assert avisos(cliente) == ['Cita agendada: ANA']
+    r2 = cliente.get(URL, headers={'If-None-Match': r1.headers['ETag']})
+    assert r2.status_code == 200
+    assert r2.headers['ETag'] != r1.headers['ETag']
+    assert 'ANA' in r2.get_data(as_text=True)
+
+
+def test_version_sigue_a_marcar_cambio(conn):
+    antes = citas.version_datos()
+    citas.marcar_cambio(conn)
+    assert citas.version_datos() == antes  # aún sin commit
+    conn.commit()
+    assert citas.version_datos() == antes + 1
+
+
+def test_cache_compartida_entre_usuarios(cliente, operador, conn):
+    generar(cliente, f'{SALAS}: Día 5 M')
+    pid = prof_id(conn)
+    r1 = cliente.get(f'/api/fechas/{pid}')
+    r2 = operador.get(f'/api/fechas/{pid}')
+    assert r1.headers['ETag'] == r2.headers['ETag']
+    # Las páginas con la barra de navegación van por usuario
+    assert cliente.get(URL).headers['ETag'] != operador.get(URL).headers['ETag']
+
+
+def test_sin_cache_con_snapshot(cliente, monkeypatch):
+    monkeypatch.setattr(citas, 'SNAPSHOT_SEGUNDOS', 30)
+    r = cliente.get(URL)
+    assert r.status_code == 200 and 'ETag' not in r.headers
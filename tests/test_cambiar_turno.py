@@ -0,0 +1,123 @@
+from conftest import SALAS, agendar, avisos, citas, cupos, generar, prof_id
+
+# Octubre 2026: el 5 es lunes
+ROL = f'{SALAS}: Día 5 M, Día 6 M, Día 7 T'
+
+
+def _mover(cliente, movimientos, confirmar=True):
+    data = {'accion': 'cambiar', 'prof_id': [], 'fecha': [], 'fecha_destino': [], 'nuevo_turno': []}
+    for pid, fecha, destino, turno in movimientos:
+        data['prof_id'].append(pid); data['fecha'].append(fecha)
+        data['fecha_destino'].append(destino); data['nuevo_turno'].append(turno)
+    if confirmar: data['confirmar'] = '1'
+    return cliente.post('/cambiar_turno', data=data)
+
+
+def _pacientes(conn, pid, fecha):
+    return [c['paciente'] for c in cupos(conn, pid, fecha) if c['estado'] == 'Confirmado']
+
+
+def _turno_rol(conn, pid, dia):
+    r = conn.execute('SELECT turno FROM roles_mensuales WHERE profesional_id=? AND anio=2026 AND mes=10 AND dia=?',
+                     (pid, dia)).fetchone()
+    return r and r['turno']
+
+
+def test_cadena_de_cambios(cliente, conn):
+    """A→B while B→C: every move reads the state before the batch"""
+    generar(cliente, ROL)
+    pid = prof_id(conn)
+    agendar(cliente, cupos(conn, pid, '2026-10-05')[0]['id'], 'ANA')
+    agendar(cliente, cupos(conn, pid, '2026-10-06')[1]['id'], 'BETO')
+    agendar(cliente, cupos(conn, pid, '2026-10-07')[0]['id'], 'CARLA')
+
+    r = _mover(cliente, [(pid, '2026-10-05', '2026-10-06', '='),
+                         (pid, '2026-10-06', '2026-10-07', '='),
+                         (pid, '2026-10-07', '2026-10-08', 'M')])
+    assert r.status_code == 302
+
+    assert cupos(conn, pid, '2026-10-05') == []
+    assert _pacientes(conn, pid, '2026-10-06') == ['ANA']
+    assert _pacientes(conn, pid, '2026-10-07') == ['BETO']
+    assert _pacientes(conn, pid, '2026-10-08') == ['CARLA']
+    # Los pacientes se reacomodan desde el primer cupo del nuevo turno
+    assert cupos(conn, pid, '2026-10-07')[0]['paciente'] == 'BETO'
+    assert {c['turno'] for c in cupos(conn, pid, '2026-10-07')} == {'MAÑANA'}
+    assert {c['turno'] for c in cupos(conn, pid, '2026-10-08')} == {'MAÑANA'}
+    assert [_turno_rol(conn, pid, d) for d in (5, 6, 7, 8)] == [None, 'M', 'M', 'M']
+    n = conn.execute("SELECT COUNT(*) FROM historial WHERE accion='CAMBIO_TURNO'").fetchone()[0]
+    assert n == 3
+
+
+def test_igual_y_turno_explicito_en_el_mismo_lote(cliente, conn):
+    generar(cliente, ROL)
+    pid = prof_id(conn)
+    r = _mover(cliente, [(pid, '2026-10-05', '2026-10-05', 'MT'),
+                         (pid, '2026-10-07', '2026-10-09', '=')])
+    assert r.status_code == 302
+    assert {c['turno'] for c in cupos(conn, pid, '2026-10-05')} == {'MAÑANA', 'TARDE'}
+    assert cupos(conn, pid, '2026-10-07') == []
+    assert {c['turno'] for c in cupos(conn, pid, '2026-10-09')} == {'TARDE'}
+    assert (_turno_rol(conn, pid, 5), _turno_rol(conn, pid, 9)) == ('MT', 'T')
+
+
+def test_un_error_cancela_todo_el_lote(cliente, conn):
+    generar(cliente, ROL + ', Día 12 M')
+    pid = prof_id(conn)
+    agendar(cliente, cupos(conn, pid, '2026-10-05')[0]['id'], 'ANA')
+    agendar(cliente, cupos(conn, pid, '2026-10-12')[0]['id'], 'OCUPA')
+    antes = conn.execute('SELECT COUNT(*) FROM citas').fetchone()[0]
+
+    # El primer movimiento es válido; el segundo cae sobre un día con pacientes que no se mueve
+    r = _mover(cliente, [(pid, '2026-10-05', '2026-10-06', '='),
+                         (pid, '2026-10-07', '2026-10-12', 'M')])
+    assert r.status_code == 302
+    assert any('2026-10-12' in m and 'ya tiene 1 pacientes' in m for m in avisos(cliente))
+    assert _pacientes(conn, pid, '2026-10-05') == ['ANA']
+    assert _pacientes(conn, pid, '2026-10-06') == []
+    assert conn.execute('SELECT COUNT(*) FROM citas').fetchone()[0] == antes
+    assert conn.execute("SELECT COUNT(*) FROM historial WHERE accion='CAMBIO_TURNO'").fetchone()[0] == 0
+
+
+def test_errores_del_plan(cliente, conn):
+    generar(cliente, ROL)
+    pid = prof_id(conn)
+    planes, errores = citas._planificar_cambios(conn, [
+        (pid, '2026-10-05', '2026-10-06', '='),
+        (pid, '2026-10-05', '2026-10-08', 'M'),    # mismo origen dos veces
+        (pid, '2026-10-07', '2026-10-06', 'T'),    # mismo destino dos veces
+        (pid, '2026-10-20', '2026-10-21', '='),    # sin cupos ni rol: no hay turno que copiar
+        (pid, '2026-13-01', '2026-10-21', 'M'),
+        (999999, '2026-10-05', '2026-10-06', 'M'),
+    ])
+    assert [(p['fecha'], p['destino'], p['turno']) for p in planes] == [('2026-10-05', '2026-10-06', 'M')]
+    assert len(errores) == 5
+    assert 'aparece dos veces como origen' in errores[0]
+    assert 'aparece dos veces como destino' in errores[1]
+    assert 'no se pudo determinar el turno' in errores[2]
+    assert 'fecha inválida' in errores[3]
+    assert errores[4] == 'Profesional no encontrado'
+
+
+def test_vista_previa_no_escribe(cliente, conn):
+    generar(cliente, ROL)
+    pid = prof_id(conn)
+    agendar(cliente, cupos(conn, pid, '2026-10-05')[0]['id'], 'ANA')
+    r = _mover(cliente, [(pid, '2026-10-05', '2026-10-06', '='), (pid, '2026-10-06', '2026-10-07', '=')],
+               confirmar=False)
+    html = r.get_data(as_text=True)
+    assert r.status_code == 200 and '2 movimientos' in html and 'Confirmar Cambio' in html
+    assert _pacientes(conn, pid, '2026-10-05') == ['ANA']
+    assert _turno_rol(conn, pid, 7) == 'T'
+
+
+def test_pacientes_que_no_caben(cliente, conn):
+    generar(cliente, f'{SALAS}: Día 5 MT')
+    pid = prof_id(conn)
+    for i, c in enumerate(cupos(conn, pid, '2026-10-05')):
+        agendar(cliente, c['id'], f'PAC {i:02d}')
+    n_mt = len(cupos(conn, pid, '2026-10-05'))
+    planes, errores = citas._planificar_cambios(conn, [(pid, '2026-10-05', '2026-10-05', 'T')])
+    n_t = sum(1 for sl in citas._slots_turno('MEDICINA', 'T') if sl['turno'] != 'ADMINISTRATIVA')
+    assert errores == []
+    assert (len(planes[0]['colocados']), len(planes[0]['sin_cupo'])) == (n_t, n_mt - n_t)
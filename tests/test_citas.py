@@ -0,0 +1,152 @@
+from conftest import SALAS, agendar, avisos, citas, cupos, generar, prof_id
+
+
+def _cupo(cliente, conn, dia='2026-10-05'):
+    generar(cliente, f'{SALAS}: Día 5 M')
+    return cupos(conn, prof_id(conn), dia)[0]['id']
+
+
+def _estado(conn, cita_id):
+    return conn.execute('SELECT estado, paciente FROM citas WHERE id=?', (cita_id,)).fetchone()[:]
+
+
+# ==============================================================================
+# RETENCIONES
+# ==============================================================================
+def test_retencion_bloquea_a_otro_usuario(cliente, operador, conn):
+    cid = _cupo(cliente, conn)
+    r = cliente.post(f'/cita/retener/{cid}')
+    assert r.status_code == 200 and r.get_json()['ok']
+
+    r = operador.post(f'/cita/retener/{cid}')
+    assert r.status_code == 409
+    assert r.get_json()['error'] == 'Cupo en uso por Administrador'
+
+    agendar(operador, cid, 'intruso')
+    assert 'Cupo en uso por Administrador' in avisos(operador)
+    assert _estado(conn, cid) == ('Disponible', '')
+
+    agendar(cliente, cid, 'ana')
+    assert _estado(conn, cid) == ('Confirmado', 'ANA')
+    assert conn.execute('SELECT COUNT(*) FROM retenciones').fetchone()[0] == 0
+
+
+def test_retencion_se_renueva_y_vence(cliente, operador, conn):
+    cid = _cupo(cliente, conn)
+    cliente.post(f'/cita/retener/{cid}')
+    assert cliente.post(f'/cita/retener/{cid}').status_code == 200
+
+    conn.execute("UPDATE retenciones SET expira_en=datetime('now', '-1 second')")
+    conn.commit()
+    r = operador.post(f'/cita/retener/{cid}')
+    assert r.status_code == 200 and r.get_json()['ok']
+    assert cliente.post(f'/cita/retener/{cid}').status_code == 409
+
+
+def test_liberar_solo_la_propia(cliente, operador, conn):
+    cid = _cupo(cliente, conn)
+    cliente.post(f'/cita/retener/{cid}')
+    operador.post(f'/cita/liberar/{cid}')
+    assert operador.post(f'/cita/retener/{cid}').status_code == 409
+    cliente.post(f'/cita/liberar/{cid}')
+    assert operador.post(f'/cita/retener/{cid}').status_code == 200
+
+
+def test_retener_cupo_agendado(cliente, conn):
+    cid = _cupo(cliente, conn)
+    agendar(cliente, cid, 'ana')
+    r = cliente.post(f'/cita/retener/{cid}')
+    assert r.status_code == 409 and r.get_json()['error'] == 'Cupo no disponible'
+
+
+# ==============================================================================
+# IDEMPOTENCIA
+# ==============================================================================
+def test_reenvio_del_formulario_repite_la_respuesta(cliente, conn):
+    cid = _cupo(cliente, conn)
+    origen = {'Referer': '/?prof_id=1&fecha=2026-10-05'}
+    r1 = cliente.post('/cita/agendar', data={'cita_id': cid, 'paciente': 'ana', '_idem': 'k1'}, headers=origen)
+    r2 = cliente.post('/cita/agendar', data={'cita_id': cid, 'paciente': 'otro', '_idem': 'k1'}, headers=origen)
+    assert r1.status_code == r2.status_code == 302
+    assert r2.headers['Location'] == r1.headers['Location']
+    assert _estado(conn, cid) == ('Confirmado', 'ANA')
+    assert conn.execute("SELECT COUNT(*) FROM historial WHERE accion='AGENDAR'").fetchone()[0] == 1
+
+
+def test_clave_distinta_se_procesa(cliente, conn):
+    cid = _cupo(cliente, conn)
+    cliente.post('/cita/agendar', data={'cita_id': cid, 'paciente': 'ana', '_idem': 'k1'})
+    cliente.post('/cita/eliminar/%d' % cid, data={'_idem': 'k2'})
+    assert _estado(conn, cid) == ('Disponible', '')
+
+
+def test_fetch_repite_cuerpo_json(cliente, conn):
+    cid = _cupo(cliente, conn)
+    agendar(cliente, cid, 'ana')
+    url = f'/cita/asistencia/{cid}/Asisti%C3%B3'
+    r1 = cliente.post(url, headers={'Idempotency-Key': 'a1'})
+    r2 = cliente.post(url, headers={'Idempotency-Key': 'a1'})
+    assert (r1.status_code, r2.status_code) == (200, 200)
+    assert r2.get_json() == r1.get_json() == {'ok': True}
+    assert r2.content_type == r1.content_type
+    assert conn.execute("SELECT COUNT(*) FROM historial WHERE accion='ASISTENCIA'").fetchone()[0] == 1
+
+
+def test_envio_en_proceso(cliente, conn):
+    cid = _cupo(cliente, conn)
+    uid = conn.execute("SELECT id FROM usuarios WHERE username='admin'").fetchone()[0]
+    conn.execute("INSERT INTO idempotencia (clave, usuario_id, ruta) VALUES ('p1', ?, '/cita/agendar')", (uid,))
+    conn.commit()
+
+    r = cliente.post('/cita/agendar', data={'cita_id': cid, 'paciente': 'ana', '_idem': 'p1'},
+                     headers={'Referer': '/agenda'})
+    assert r.status_code == 302 and r.headers['Location'] == '/agenda'
+    assert any('Solicitud en proceso' in m for m in avisos(cliente))
+
+    r = cliente.post('/cita/agendar', data={'cita_id': cid, 'paciente': 'ana'}, headers={'Idempotency-Key': 'p1'})
+    assert r.status_code == 409 and 'Solicitud en proceso' in r.get_json()['error']
+    assert _estado(conn, cid) == ('Disponible', '')
+
+
+def test_clave_reutilizada_en_otra_ruta(cliente, conn):
+    cid = _cupo(cliente, conn)
+    cliente.post('/cita/agendar', data={'cita_id': cid, 'paciente': 'ana'}, headers={'Idempotency-Key': 'x1'})
+    r = cliente.post(f'/cita/eliminar/{cid}', headers={'Idempotency-Key': 'x1'})
+    assert r.status_code == 422
+    assert _estado(conn, cid) == ('Confirmado', 'ANA')
+
+
+def test_claves_por_usuario(cliente, operador, conn):
+    cid = _cupo(cliente, conn)
+    cliente.post('/cita/agendar', data={'cita_id': cid, 'paciente': 'ana', '_idem': 'u1'})
+    operador.post(f'/cita/eliminar/{cid}', data={'_idem': 'u1'})
+    assert _estado(conn, cid) == ('Disponible', '')
+
+
+def test_error_libera_la_clave(cliente, conn, monkeypatch):
+    cid = _cupo(cliente, conn)
+
+    def falla(*a, **k): raise RuntimeError('falla')
+    monkeypatch.setattr(citas.DatosSQLite, 'agendar', falla)
+    citas.app.testing = False
+    try:
+        r = cliente.post('/cita/agendar', data={'cita_id': cid, 'paciente': 'ana', '_idem': 'e1'})
+    finally:
+        citas.app.testing = True
+    assert r.status_code == 500
+    assert conn.execute("SELECT COUNT(*) FROM idempotencia WHERE clave='e1'").fetchone()[0] == 0
+    monkeypatch.undo()
+    cliente.post('/cita/agendar', data={'cita_id': cid, 'paciente': 'ana', '_idem': 'e1'})
+    assert _estado(conn, cid) == ('Confirmado', 'ANA')
+
+
+def test_mantenimiento_borra_claves_vencidas(cliente, conn):
+    cid = _cupo(cliente, conn)
+    cliente.post('/cita/agendar', data={'cita_id': cid, 'paciente': 'ana', '_idem': 'v1'})
+    cliente.post(f'/cita/eliminar/{cid}', data={'_idem': 'v2'})
+    conn.execute("UPDATE idempotencia SET creado_en=datetime('now', ?) WHERE clave='v1'",
+                 (f'-{citas.IDEMPOTENCIA_HORAS + 1} hours',))
+    conn.commit()
+    assert citas._tarea_idempotencia(conn) == '1 claves vencidas borradas'
+    conn.commit()
+    assert [r[0] for r in conn.execute('SELECT clave FROM idempotencia')] == ['v2']
@@ -0,0 +1,107 @@
+import calendar
+import io
+
+from conftest import SALAS, citas, generar, prof_id
+
+
+def _dias_semana(year, month, semana):
+    return [d for d in range(1, calendar.monthrange(year, month)[1] + 1) if calendar.weekday(year, month, d) in semana]
+
+
+def _fechas(conn, pid):
+    return sorted({r[0] for r in conn.execute('SELECT fecha FROM citas WHERE profesional_id=?', (pid,))})
+
+
+def _estimar(cliente, texto, meses, **extra):
+    r = cliente.post('/api/generar/estimar', data={'year': 2026, 'month': 10, 'meses': meses,
+                                                   'roster_text': texto, **extra})
+    assert r.status_code == 200
+    return r.get_json()
+
+
+# ==============================================================================
+# PATRONES SEMANALES
+# ==============================================================================
+def test_patron_semanal_y_dia_libre():
+    rol = citas.parse_roster_text('Fulano: LUN-VIE M, SÁB T, Día 6 L', 2026, 10)['FULANO']
+    habiles = _dias_semana(2026, 10, {0, 1, 2, 3, 4})
+    assert {d for d, c in rol.items() if c == 'M'} == set(habiles) - {6}
+    assert {d for d, c in rol.items() if c == 'T'} == set(_dias_semana(2026, 10, {5}))
+    assert rol[6] == 'L'
+
+
+def test_rango_que_cruza_el_domingo():
+    rol = citas.parse_roster_text('Fulano: VIE-LUN MT', 2026, 2)['FULANO']
+    assert sorted(rol) == _dias_semana(2026, 2, {4, 5, 6, 0})
+
+
+def test_nombre_repetido():
+    errores = []
+    rol = citas.parse_roster_text('Fulano: LUN M\nfulano: MAR T', 2026, 10, errores)
+    assert rol == {'FULANO': {d: 'M' for d in _dias_semana(2026, 10, {0})}}
+    assert errores == ['FULANO: aparece más de una vez en el rol']
+
+
+def test_varios_meses_con_patron(cliente, conn):
+    generar(cliente, f'{SALAS}: LUN MT, MIÉ M', meses=3)
+    esperadas = [f'{a}-{m:02d}-{d:02d}' for a, m in ((2026, 10), (2026, 11), (2026, 12))
+                 for d in _dias_semana(a, m, {0, 2})]
+    assert _fechas(conn, prof_id(conn)) == sorted(esperadas)
+    assert conn.execute('SELECT COUNT(DISTINCT mes) FROM roles_mensuales').fetchone()[0] == 3
+
+
+def test_estimar_varios_meses(cliente):
+    r = _estimar(cliente, f'{SALAS}: LUN-VIE M', 2)
+    assert r['errores'] == []
+    assert [(x['anio'], x['mes']) for x in r['meses']] == [(2026, 10), (2026, 11)]
+    assert r['cupos'] == sum(x['cupos'] for x in r['meses']) > 0
+
+
+# ==============================================================================
+# RECHAZOS CON VARIOS MESES
+# ==============================================================================
+def test_dia_fijo_con_varios_meses_se_rechaza(cliente, conn):
+    texto = f'{SALAS}: LUN M, Día 3 T'
+    assert any('«Día N» vale para un solo mes' in e for e in _estimar(cliente, texto, 2)['errores'])
+    assert _estimar(cliente, texto, 1)['errores'] == []
+
+    r = cliente.post('/generar', data={'year': 2026, 'month': 10, 'meses': 2, 'roster_text': texto, 'confirmar': '1'})
+    assert r.status_code == 200 and 'vale para un solo mes' in r.get_data(as_text=True)
+    assert conn.execute('SELECT COUNT(*) FROM citas').fetchone()[0] == 0
+
+
+def test_grilla_con_varios_meses_se_rechaza(cliente):
+    grilla = 'Profesional;' + ';'.join(str(d) for d in range(1, 32)) + f'\n{SALAS};M;T;MT\n'
+    archivo = (io.BytesIO(grilla.encode('utf-8')), 'rol.csv')
+    r = _estimar(cliente, '', 2, grilla=archivo)
+    assert 'La grilla es de un solo mes: genere un mes a la vez o use patrones semanales' in r['errores']
+    archivo = (io.BytesIO(grilla.encode('utf-8')), 'rol.csv')
+    assert _estimar(cliente, '', 1, grilla=archivo)['errores'] == []
+
+
+def test_errores_de_un_mes_del_rango(cliente):
+    r = _estimar(cliente, f'{SALAS}: LUN Z', 2)
+    assert any('turno «Z» desconocido' in e for e in r['errores'])
+    # Día 31 existe en octubre pero no en noviembre
+    assert _estimar(cliente, f'{SALAS}: Día 31 M', 1)['errores'] == []
+    r = cliente.post('/api/generar/estimar', data={'year': 2026, 'month': 11, 'roster_text': f'{SALAS}: Día 31 M'})
+    assert f'{SALAS}: Noviembre no tiene día 31' in r.get_json()['errores']
+
+
+def test_linea_sin_turnos(cliente):
+    r = _estimar(cliente, f'{SALAS}: turno por confirmar', 1)
+    assert f'{SALAS}: no se reconoció ningún «Día N TURNO» ni patrón semanal' in r['errores']
+
+
+def test_cli_valida_cada_mes(tmp_path, conn):
+    runner = citas.app.test_cli_runner()
+    rol = tmp_path / 'rol.txt'
+    rol.write_text(f'{SALAS}: Día 3 M', encoding='utf-8')
+    r = runner.invoke(args=['generar', '--anio', '2026', '--mes', '10', '--meses', '2', '--roster', str(rol)])
+    assert r.exit_code != 0 and 'vale para un solo mes' in r.output
+    assert conn.execute('SELECT COUNT(*) FROM citas').fetchone()[0] == 0
+
+    rol.write_text(f'{SALAS}: LUN M', encoding='utf-8')
+    r = runner.invoke(args=['generar', '--anio', '2026', '--mes', '10', '--meses', '2', '--roster', str(rol)])
+    assert r.exit_code == 0, r.output
+    assert _fechas(conn, prof_id(conn)) == [f'2026-{m:02d}-{d:02d}' for m in (10, 11) for d in _dias_semana(2026, m, {0})]
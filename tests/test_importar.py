@@ -0,0 +1,138 @@
+import io
+import re
+
+import openpyxl
+import pytest
+from werkzeug.datastructures import FileStorage
+
+from conftest import SALAS, agendar, avisos, citas, cupos, generar, prof_id
+
+ENCABEZADO = ['Profesional', 'Fecha', 'Hora', 'Paciente', 'DNI', 'Tipo']
+
+
+@pytest.fixture
+def octubre(cliente, conn):
+    """SALAS on 5 and 6 October, morning shift; returns (prof_id, free slots of the 5th)"""
+    generar(cliente, f'{SALAS}: Día 5 M, Día 6 M')
+    pid = prof_id(conn)
+    return pid, cupos(conn, pid, '2026-10-05')
+
+
+def _csv(filas, sep=',', codificacion='utf-8'):
+    texto = '\n'.join(sep.join(f) for f in [ENCABEZADO] + filas) + '\n'
+    return FileStorage(io.BytesIO(texto.encode(codificacion)), filename='pacientes.csv')
+
+
+def _xlsx(filas):
+    wb = openpyxl.Workbook()
+    for f in [ENCABEZADO] + filas: wb.active.append(f)
+    buf = io.BytesIO(); wb.save(buf); buf.seek(0)
+    return FileStorage(buf, filename='pacientes.xlsx')
+
+
+def _validar(conn, archivo):
+    return citas._validar_importacion(conn, citas._leer_planilla(archivo))
+
+
+def test_filas_validas_y_con_errores(conn, octubre):
+    pid, libres = octubre
+    admin = conn.execute("SELECT hora_inicio FROM citas WHERE profesional_id=? AND fecha='2026-10-05' "
+                         "AND turno='ADMINISTRATIVA'", (pid,)).fetchone()[0]
+    listas, errores, omitidas = _validar(conn, _csv([
+        [SALAS, '05/10/2026', libres[0]['hora_inicio'], 'ana', '111', 'NUEVO'],
+        [str(pid), '2026-10-05', libres[1]['hora_inicio'] + ' - x', 'beto', '', 'continuador'],
+        ['NADIE', '2026-10-05', '08:00', 'carla', '', ''],
+        [SALAS, '31/02/2026', 'tarde', 'dario', '', 'OTRO'],
+        [SALAS, '2026-10-05', admin, 'eva', '', ''],
+        [SALAS, '2026-10-07', '07:30', 'fabio', '', ''],
+        [SALAS, '2026-10-05', libres[0]['hora_inicio'], 'gina', '', ''],
+        [SALAS, '2026-10-05', '07:30', '', '', ''],
+    ]))
+    assert [(f['paciente'], f['cita_id'], f['tipo_paciente']) for f in listas] == [
+        ('ANA', libres[0]['id'], 'NUEVO'), ('BETO', libres[1]['id'], 'CONTINUADOR')]
+    assert omitidas == 1
+    assert [n for n, _ in errores] == [4, 5, 6, 7, 8]
+    detalle = dict(errores)
+    assert detalle[4] == 'Profesional desconocido: NADIE'
+    assert 'Fecha inválida: 31/02/2026' in detalle[5] and 'Hora inválida: tarde' in detalle[5] \
+        and 'Tipo de paciente inválido: OTRO' in detalle[5]
+    assert 'horario administrativo' in detalle[6]
+    assert '¿falta generar el mes?' in detalle[7]
+    assert detalle[8] == 'Mismo cupo que la fila 2'
+
+
+def test_ya_agendado_se_omite(cliente, conn, octubre):
+    pid, libres = octubre
+    agendar(cliente, libres[0]['id'], 'ana', dni='111')
+    agendar(cliente, libres[1]['id'], 'beto')
+    listas, errores, omitidas = _validar(conn, _csv([
+        [SALAS, '2026-10-05', libres[0]['hora_inicio'], 'Ana María', '111', ''],
+        [SALAS, '2026-10-05', libres[1]['hora_inicio'], 'otro', '', ''],
+    ]))
+    assert (listas, omitidas) == ([], 1)
+    assert errores == [(3, 'Cupo ocupado por BETO')]
+
+
+def test_encabezado(conn):
+    sin = FileStorage(io.BytesIO(b'a,b\n1,2\n'), filename='x.csv')
+    assert _validar(conn, sin)[1][0][1].startswith('No se encontró la fila de encabezados')
+    incompleto = FileStorage(io.BytesIO(b'Fecha,Paciente\n2026-10-05,ana\n'), filename='x.csv')
+    assert _validar(conn, incompleto)[1] == [(1, 'Faltan columnas: PROFESIONAL, HORA')]
+
+
+def test_maximo_de_filas(conn, octubre, monkeypatch):
+    monkeypatch.setattr(citas, 'IMPORTAR_MAX_FILAS', 2)
+    filas = [[SALAS, '2026-10-05', c['hora_inicio'], f'p{i}', '', ''] for i, c in enumerate(octubre[1][:3])]
+    listas, errores, _ = _validar(conn, _csv(filas))
+    assert len(listas) == 2 and errores == [(4, 'Se superó el máximo de 2 filas por archivo')]
+
+
+def test_csv_de_excel_en_windows(conn, octubre):
+    _, libres = octubre
+    listas, errores, _ = _validar(conn, _csv([[SALAS, '05/10/2026', libres[0]['hora_inicio'], 'Peña', '', '']],
+                                             sep=';', codificacion='cp1252'))
+    assert errores == [] and listas[0]['paciente'] == 'PEÑA'
+
+
+def test_xlsx(conn, octubre):
+    _, libres = octubre
+    listas, errores, _ = _validar(conn, _xlsx([[SALAS, '2026-10-05', libres[0]['hora_inicio'], 'ana', 111, 'NUEVO']]))
+    assert errores == [] and (listas[0]['paciente'], listas[0]['dni']) == ('ANA', '111')
+
+
+@pytest.mark.parametrize('nombre, contenido, mensaje', [
+    ('roto.xlsx', b'no es un zip', 'No se pudo leer el archivo .xlsx'),
+    ('planilla.ods', b'', 'Formato no soportado: use .csv o .xlsx'),
+])
+def test_archivo_ilegible(conn, nombre, contenido, mensaje):
+    with pytest.raises(ValueError, match=re.escape(mensaje)):
+        _validar(conn, FileStorage(io.BytesIO(contenido), filename=nombre))
+
+
+def test_importar_de_punta_a_punta(cliente, conn, octubre):
+    _, libres = octubre
+    archivo = _csv([[SALAS, '2026-10-05', libres[0]['hora_inicio'], 'ana', '111', ''],
+                    [SALAS, '2026-10-05', libres[1]['hora_inicio'], 'beto', '', '']])
+    r = cliente.post('/importar', data={'archivo': (archivo.stream, archivo.filename)})
+    html = r.get_data(as_text=True)
+    assert r.status_code == 200 and '<strong>2</strong> fila(s) listas' in html
+    lote = re.search(r'name="lote" value="([^"]+)"', html).group(1)
+
+    # Alguien agenda uno de los cupos entre la validación y la confirmación: no se importa nada
+    agendar(cliente, libres[1]['id'], 'intruso')
+    avisos(cliente)
+    cliente.post('/importar', data={'lote': lote})
+    assert any('no se importó nada' in m for m in avisos(cliente))
+    assert conn.execute("SELECT estado FROM citas WHERE id=?", (libres[0]['id'],)).fetchone()[0] == 'Disponible'
+
+    cliente.post(f'/cita/eliminar/{libres[1]["id"]}')
+    avisos(cliente)
+    cliente.post('/importar', data={'lote': lote})
+    assert avisos(cliente)[0].startswith('2 cita(s) importadas')
+    assert [c['paciente'] for c in cupos(conn, prof_id(conn), '2026-10-05')[:2]] == ['ANA', 'BETO']
+    assert conn.execute("SELECT COUNT(*) FROM historial WHERE accion='IMPORTAR'").fetchone()[0] == 2
+
+
+def test_lote_alterado(cliente):
+    cliente.post('/importar', data={'lote': 'no-firmado'})
+    assert avisos(cliente) == ['La validación expiró; vuelva a subir el archivo']